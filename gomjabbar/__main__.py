@@ -0,0 +1,5 @@
+import sys
+
+from gomjabbar.cli import main
+
+sys.exit(main())
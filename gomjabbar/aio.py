@@ -0,0 +1,151 @@
+""" asyncio counterparts of `gomjabbar.generate.build_test` and of running
+the resulting test programs.
+
+All subprocesses (cmpp, cc and the test programs themselves) are started with
+`asyncio.create_subprocess_exec` and never change the working directory of
+the Python process, so many builds and runs can overlap in a single event
+loop. The number of subprocesses running at once is limited by a semaphore.
+"""
+import asyncio
+import contextlib
+import os
+import os.path as op
+from subprocess import PIPE, STDOUT, CalledProcessError
+import sys
+import weakref
+
+from gomjabbar.generate import (
+    build_model_library, _compile_cmd, _get_pch_flags, _link_cmd,
+    _preprocess_cmd, _render_test, _test_workspace
+)
+
+#: The default number of subprocesses which may run at once per event loop
+MAX_JOBS = os.cpu_count() or 1
+
+_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+@contextlib.asynccontextmanager
+async def build_test(code_model_dir, code, parameters, semaphore=None,
+                     build_root=None, keep_failed=None, sources=None,
+                     state=None, instances=None):
+    """ Build some code model source into a program which can be used to test
+    part of a code model.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model being tested.
+    code : str
+        Source code which will be linked with the code model into a program.
+    parameters : dict
+        A dictionary of values which will be assigned to the PARAMETER_TABLE
+        variables defined by the code model.
+    semaphore : asyncio.Semaphore, optional
+        Limits the number of concurrent subprocesses. Defaults to a
+        semaphore shared by the running event loop which allows `MAX_JOBS`.
+    build_root : str, optional
+        See `gomjabbar.generate.build_test`.
+    keep_failed : bool, optional
+        See `gomjabbar.generate.build_test`.
+    sources : list of str, optional
+        See `gomjabbar.generate.build_test`.
+    state : bool, optional
+        See `gomjabbar.generate.build_test`.
+    instances : bool, optional
+        See `gomjabbar.generate.build_test`.
+    """
+    code_model_dir = op.abspath(code_model_dir)
+    source = _render_test(code_model_dir, code, parameters, state=state,
+                          instances=instances)
+    with _test_workspace(code_model_dir, source, build_root,
+                         keep_failed) as path:
+        yield await _compile_test(path, code_model_dir, semaphore, sources)
+
+
+async def run_test(path, args=(), input=None, semaphore=None):
+    """ Run a test program built by `build_test` and return its output.
+
+    Parameters
+    ----------
+    path : str
+        The path of the test program.
+    args : sequence of str
+        Command line arguments for the program.
+    input : bytes, optional
+        Data which is written to the standard input of the program.
+    semaphore : asyncio.Semaphore, optional
+        Limits the number of concurrent subprocesses.
+
+    Raises `subprocess.CalledProcessError` if the program exits with a
+    non-zero status.
+    """
+    cmd = [path] + list(args)
+    async with _get_semaphore(semaphore):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=None if input is None else PIPE, stdout=PIPE
+        )
+        stdout, _ = await proc.communicate(input)
+
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd, output=stdout)
+    return stdout.decode('utf8')
+
+
+async def _check_call(cmd, cwd, semaphore):
+    """ Run a build command, as `gomjabbar.generate._check_call` does.
+    """
+    async with _get_semaphore(semaphore):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd, stdout=PIPE, stderr=STDOUT
+        )
+        output = (await proc.communicate())[0].decode('utf8', 'replace')
+
+    if output:
+        sys.stderr.write(output)
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd, output=output)
+
+
+async def _compile_test(path, code_model_dir, semaphore, sources=None):
+    """ Build an executable for a code model test.
+
+    Returns the path of the resulting executable.
+    """
+    workspace, mod_file = op.split(op.abspath(path))
+    module_path = op.splitext(mod_file)[0]
+    # The precompiled header is built at most once per process. It and the
+    # code model library are built in threads, each running one compiler at
+    # a time, which take their turn in the semaphore like every subprocess.
+    loop = asyncio.get_running_loop()
+    async with _get_semaphore(semaphore):
+        pch_flags = await loop.run_in_executor(None, _get_pch_flags)
+
+    # Preprocess the .mod file with cmpp
+    await _check_call(_preprocess_cmd(mod_file), workspace, semaphore)
+    # Compile the resulting .c file
+    obj_file = module_path + '.o'
+    cmd = _compile_cmd(module_path + '.c', obj_file, code_model_dir, pch_flags)
+    await _check_call(cmd, workspace, semaphore)
+
+    # Make sure the code model library is up to date. It is locked by
+    # `build_model_library` itself.
+    async with _get_semaphore(semaphore):
+        archive = await loop.run_in_executor(None, build_model_library,
+                                             code_model_dir, sources, 1)
+
+    # Link the resulting .o file with the code model into an executable
+    cmd = _link_cmd(module_path, [obj_file, archive])
+    await _check_call(cmd, workspace, semaphore)
+
+    return op.join(workspace, module_path)
+
+
+def _get_semaphore(semaphore):
+    if semaphore is not None:
+        return semaphore
+
+    loop = asyncio.get_running_loop()
+    if loop not in _SEMAPHORES:
+        _SEMAPHORES[loop] = asyncio.Semaphore(MAX_JOBS)
+    return _SEMAPHORES[loop]
@@ -0,0 +1,161 @@
+""" A content-addressed cache of compiled test programs.
+
+Programs are keyed by a hash of everything which goes into them: the code
+model's rendered harness, its source files, the test code and the build
+profile (the gomjabbar version and templates, the compiler and the ngspice
+installation). A cache directory can be shared by several processes; a file
+lock makes sure each program is only built once and an atomic rename makes
+sure no process sees a partially written program.
+"""
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import threading
+import time
+import uuid
+from subprocess import PIPE, STDOUT, Popen
+
+from gomjabbar.util import file_lock, hash_files
+
+
+class ProgramCache(object):
+    """ Build test programs into `cache_dir`, reusing identical programs.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory where programs are stored. It is created if needed.
+    """
+    def __init__(self, cache_dir):
+        # Deferred so that merely importing this module stays cheap
+        from gomjabbar import generate
+
+        self._generate = generate
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._harnesses = {}
+        self._profile = None
+        self.stats = {'builds': 0, 'hits': 0, 'harness_hits': 0,
+                      'build_time': 0.0}
+        if not op.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def build(self, code_model_dir, code, parameters):
+        """ Return the path of the program built from `code`, building it
+        only if it is not in the cache already.
+        """
+        def build_source(code_model_dir, harness):
+            return self._generate._build_source(code_model_dir,
+                                                harness + code)
+
+        options = self._generate._harness_options(code_model_dir, [code])
+        return self._build(code_model_dir, parameters, code, options,
+                           build_source)
+
+    def build_unity(self, code_model_dir, snippets, parameters):
+        """ Return the path of the unity program built from `snippets`, a
+        mapping of names to test code. See
+        `gomjabbar.generate.build_unity_test`.
+        """
+        def build_source(code_model_dir, harness):
+            return self._generate._build_unity_source(code_model_dir,
+                                                      harness, snippets)
+
+        snippets_key = json.dumps(snippets, sort_keys=True)
+        options = self._generate._harness_options(code_model_dir,
+                                                  snippets.values())
+        return self._build(code_model_dir, parameters, snippets_key, options,
+                           build_source)
+
+    def _build(self, code_model_dir, parameters, code_key, options,
+               build_source):
+        generate = self._generate
+        code_model_dir = op.abspath(code_model_dir)
+        context = generate._get_template_context(code_model_dir, parameters)
+        harness_key = _hash_strings(json.dumps([context, options],
+                                               sort_keys=True))
+        with self._lock:
+            harness = self._harnesses.get(harness_key)
+        if harness is None:
+            harness = generate._render_harness(*context, **options)
+            with self._lock:
+                self._harnesses[harness_key] = harness
+        else:
+            self._count('harness_hits')
+
+        # The rendered harness and the build profile make sure that programs
+        # built by another gomjabbar, compiler or ngspice are never reused
+        key = _hash_strings(
+            code_model_dir, harness, self._get_profile(),
+            _hash_sources(code_model_dir), code_key,
+        )
+        program = op.join(self.cache_dir, key)
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock, file_lock(program + '.lock'):
+            if op.exists(program):
+                self._count('hits')
+                return program
+
+            start = time.time()
+            with build_source(code_model_dir, harness) as path:
+                tmp_program = '{}.{}.tmp'.format(program, uuid.uuid4().hex)
+                shutil.copy2(path, tmp_program)
+                os.rename(tmp_program, program)
+            self._count('builds')
+            self._count('build_time', time.time() - start)
+
+        return program
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def _get_profile(self):
+        with self._lock:
+            if self._profile is None:
+                self._profile = _build_profile(self._generate)
+            return self._profile
+
+
+def _build_profile(generate):
+    """ Return a hash of everything outside of a test which goes into its
+    program: the gomjabbar version and templates, the compiler and the
+    ngspice installation.
+    """
+    from gomjabbar import __version__
+
+    cc = generate._compiler()
+    try:
+        version = Popen([cc, '--version'], stdout=PIPE,
+                        stderr=STDOUT).communicate()[0]
+    except OSError:
+        version = b''
+    data_dir = op.join(op.dirname(op.abspath(generate.__file__)), 'data')
+    paths = [op.join(data_dir, name) for name in sorted(os.listdir(data_dir))
+             if op.isfile(op.join(data_dir, name))]
+    return _hash_strings(
+        __version__, cc, version.decode('utf8', 'replace'),
+        generate.INCLUDE_DIR, generate.BIN_DIR, hash_files(paths),
+    )
+
+
+def _hash_sources(code_model_dir):
+    from gomjabbar.generate import discover_sources
+
+    names = sorted(os.listdir(code_model_dir))
+    paths = discover_sources(code_model_dir)
+    paths += [op.join(code_model_dir, n) for n in names if n.endswith('.h')]
+    return hash_files(paths)
+
+
+def _hash_strings(*strings):
+    sha = hashlib.sha1()
+    for s in strings:
+        sha.update(s.encode('utf8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
@@ -0,0 +1,330 @@
+""" The ``gomjabbar`` command.
+
+Subcommands::
+
+    lex PATH              Show the tokens of an .ifs file
+    parse PATH            Show the AST of an .ifs file
+    index DIR [DIR ...]   Write model descriptors for all ifspec.ifs files
+    build DIR             Build a code model library, or a test program
+    run DIR TEST          Build and run a test program
+    bench DIR TEST        Build a test program and time repeated runs
+    worker SPOOL          Build and run jobs from a shared spool directory
+
+Only the standard library is imported until a subcommand needs more, so
+``--help`` and lookups which are answered by up to date model descriptors
+(see `gomjabbar.ifs.model`) start quickly. jinja2 is only imported to build
+programs and ply only to parse .ifs files which changed.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import os.path as op
+import sys
+
+# The directory where `run` keeps built programs between invocations
+CACHE_DIR_ENV_VAR = 'GOMJABBAR_CACHE_DIR'
+IFS_FILENAME = 'ifspec.ifs'
+
+
+def main(argv=None):
+    """ Run the command with `argv` (defaults to ``sys.argv[1:]``) and
+    return its exit status.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    # Everything after -- is for the test program
+    program_args = []
+    if '--' in argv:
+        index = argv.index('--')
+        argv, program_args = argv[:index], argv[index + 1:]
+
+    parser = _make_parser()
+    args = parser.parse_args(argv)
+    args.args = program_args
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    from subprocess import CalledProcessError
+
+    try:
+        return args.func(args)
+    except ValueError as exc:
+        # ParameterError is not imported up front, as that would load ply
+        build = sys.modules.get('gomjabbar.ifs.build')
+        if build is None or not isinstance(exc, build.ParameterError):
+            raise
+        print('gomjabbar: {}'.format(exc), file=sys.stderr)
+        return 2
+    except CalledProcessError as exc:
+        # The build's output has already been passed on to stderr
+        print('gomjabbar: {}'.format(exc), file=sys.stderr)
+        return 1
+    except (IOError, OSError) as exc:
+        print('gomjabbar: {}'.format(exc), file=sys.stderr)
+        return 1
+
+
+def _add_parameter_argument(parser):
+    parser.add_argument('-p', '--parameter', dest='parameters',
+                        action='append', type=_parse_parameter, default=[],
+                        metavar='NAME=VALUE',
+                        help='a PARAMETER_TABLE value; VALUE is JSON or a '
+                             'string')
+
+
+def _add_test_arguments(parser):
+    parser.add_argument('code_model_dir', metavar='DIR')
+    parser.add_argument('test', metavar='TEST',
+                        help='the test code; - reads it from stdin')
+    _add_parameter_argument(parser)
+    parser.epilog = 'Arguments after -- are passed to the test program.'
+
+
+def _bench(args):
+    import subprocess
+    import time
+
+    from gomjabbar.generate import build_test
+
+    code, parameters = _read_test(args)
+    cmd_args = list(args.args)
+    with build_test(args.code_model_dir, code, parameters) as path:
+        with open(os.devnull, 'wb') as devnull:
+            for _ in range(args.warmup):
+                subprocess.call([path] + cmd_args, stdout=devnull)
+            times = []
+            for _ in range(args.repeat):
+                start = time.time()
+                returncode = subprocess.call([path] + cmd_args,
+                                             stdout=devnull)
+                times.append(time.time() - start)
+                if returncode != 0:
+                    msg = 'gomjabbar: the test program failed with status {}'
+                    print(msg.format(returncode), file=sys.stderr)
+                    return returncode
+
+    times.sort()
+    median = times[len(times) // 2]
+    msg = '{} runs: min {:.6f} s, median {:.6f} s, mean {:.6f} s'
+    print(msg.format(len(times), times[0], median, sum(times) / len(times)))
+    return 0
+
+
+def _build(args):
+    import shutil
+
+    if args.test is None:
+        from gomjabbar.generate import build_model_library
+
+        print(build_model_library(args.code_model_dir, jobs=args.jobs))
+        return 0
+
+    from gomjabbar.generate import build_test
+
+    if args.output is None:
+        print('gomjabbar: --output is required with --test', file=sys.stderr)
+        return 2
+    code, parameters = _read_test(args)
+    with build_test(args.code_model_dir, code, parameters) as path:
+        shutil.copy2(path, args.output)
+    print(args.output)
+    return 0
+
+
+def _find_ifs_files(directories):
+    for directory in directories:
+        if op.isfile(directory):
+            yield directory
+            continue
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            if IFS_FILENAME in files:
+                yield op.join(root, IFS_FILENAME)
+
+
+def _index(args):
+    from gomjabbar.ifs.model import StaleModelError, export_model, import_model
+
+    status = 0
+    for ifs_path in _find_ifs_files(args.directories):
+        if not args.force:
+            try:
+                import_model(ifs_path)
+                if args.verbose:
+                    print('up to date', ifs_path)
+                continue
+            except (IOError, OSError, StaleModelError):
+                pass
+        try:
+            export_model(ifs_path)
+        except (IOError, OSError, RuntimeError) as exc:
+            print('failed    ', ifs_path, exc, file=sys.stderr)
+            status = 1
+        else:
+            print('indexed   ', ifs_path)
+    return status
+
+
+def _lex(args):
+    from gomjabbar.ifs.build import tokenize_file
+
+    tokenize_file(args.path)
+    return 0
+
+
+def _make_parser():
+    parser = argparse.ArgumentParser(
+        prog='gomjabbar', description='Build and run ngspice code model tests.'
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    sub = subparsers.add_parser('lex', help='show the tokens of an .ifs file')
+    sub.add_argument('path')
+    sub.set_defaults(func=_lex)
+
+    sub = subparsers.add_parser('parse', help='show the AST of an .ifs file')
+    sub.add_argument('path')
+    sub.add_argument('--no-descriptor', action='store_true',
+                     help='always parse the file, ignoring its descriptor')
+    sub.set_defaults(func=_parse)
+
+    sub = subparsers.add_parser(
+        'index', help='write model descriptors for all ifspec.ifs files'
+    )
+    sub.add_argument('directories', nargs='+', metavar='DIR')
+    sub.add_argument('-f', '--force', action='store_true',
+                     help='rewrite descriptors which are up to date')
+    sub.add_argument('-v', '--verbose', action='store_true')
+    sub.set_defaults(func=_index)
+
+    sub = subparsers.add_parser(
+        'build', help='build a code model library, or a test program'
+    )
+    sub.add_argument('code_model_dir', metavar='DIR')
+    sub.add_argument('-t', '--test', metavar='TEST',
+                     help='the test code; - reads it from stdin')
+    sub.add_argument('-o', '--output', help='where to put the test program')
+    sub.add_argument('-j', '--jobs', type=int, default=None)
+    _add_parameter_argument(sub)
+    sub.set_defaults(func=_build)
+
+    sub = subparsers.add_parser('run', help='build and run a test program')
+    _add_test_arguments(sub)
+    sub.add_argument('--cache-dir', default=os.environ.get(CACHE_DIR_ENV_VAR),
+                     help='reuse programs built in this directory')
+    sub.add_argument('--timeout', type=float, metavar='SECONDS',
+                     help='kill the test program after this wall-clock time')
+    sub.add_argument('--cpu-time', type=int, metavar='SECONDS',
+                     help='limit the CPU time of the test program')
+    sub.add_argument('--memory', type=int, metavar='BYTES',
+                     help='limit the address space of the test program')
+    sub.set_defaults(func=_run)
+
+    sub = subparsers.add_parser(
+        'bench', help='build a test program and time repeated runs'
+    )
+    _add_test_arguments(sub)
+    sub.add_argument('-n', '--repeat', type=int, default=10)
+    sub.add_argument('-w', '--warmup', type=int, default=1)
+    sub.set_defaults(func=_bench)
+
+    sub = subparsers.add_parser(
+        'worker', help='build and run jobs from a shared spool directory'
+    )
+    sub.add_argument('spool_dir', metavar='SPOOL')
+    sub.add_argument('-n', '--max-jobs', type=int, default=None,
+                     help='exit after running this many jobs')
+    sub.add_argument('--idle-timeout', type=float, default=None,
+                     metavar='SECONDS',
+                     help='exit after finding no job for this long')
+    sub.set_defaults(func=_worker)
+
+    return parser
+
+
+def _parse(args):
+    if args.no_descriptor:
+        from gomjabbar.ifs.build import parse_file
+        print(parse_file(args.path))
+    else:
+        from gomjabbar.ifs.model import load_model
+        print(load_model(args.path))
+    return 0
+
+
+def _parse_parameter(text):
+    """ Split NAME=VALUE, where VALUE is JSON (e.g. 2.5, true, [1, 2]) or
+    otherwise a string.
+    """
+    import json
+
+    name, sep, value = text.partition('=')
+    if not sep or not name:
+        raise argparse.ArgumentTypeError('expected NAME=VALUE, not ' + text)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return name, value
+
+
+def _read_test(args):
+    if args.test == '-':
+        code = sys.stdin.read()
+    else:
+        with open(args.test, 'r') as fp:
+            code = fp.read()
+    return code, dict(args.parameters)
+
+
+def _run(args):
+    code, parameters = _read_test(args)
+    cmd_args = list(args.args)
+    if args.cache_dir:
+        from gomjabbar.cache import ProgramCache
+
+        path = ProgramCache(args.cache_dir).build(args.code_model_dir, code,
+                                                  parameters)
+        return _run_program(args, [path] + cmd_args)
+
+    from gomjabbar.generate import build_test
+
+    with build_test(args.code_model_dir, code, parameters) as path:
+        return _run_program(args, [path] + cmd_args)
+
+
+def _run_program(args, cmd):
+    import subprocess
+
+    if args.timeout is None and args.cpu_time is None and args.memory is None:
+        return subprocess.call(cmd)
+
+    from gomjabbar.watchdog import run_program
+
+    result = run_program(cmd, timeout=args.timeout, cpu_time=args.cpu_time,
+                         memory=args.memory, capture=False)
+    if result.timed_out:
+        msg = 'gomjabbar: the test program was killed after {:.1f} s'
+        print(msg.format(result.elapsed), file=sys.stderr)
+    elif result.signal is not None:
+        msg = 'gomjabbar: the test program was killed by signal {}'
+        print(msg.format(result.signal), file=sys.stderr)
+    if result.signal is None:
+        return result.returncode
+    # As a shell reports a program killed by a signal
+    return 128 + result.signal
+
+
+def _worker(args):
+    from gomjabbar.spool import run_worker
+
+    num_jobs = run_worker(args.spool_dir, max_jobs=args.max_jobs,
+                          idle_timeout=args.idle_timeout)
+    print('ran {} jobs'.format(num_jobs))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+
+#include <stdlib.h>
+
+/* The harness allocates instance data with gj_calloc. While gj_arena is
+set, that memory comes from the arena instead of the heap, so that the
+instances created meanwhile are laid out contiguously. Memory in an arena is
+only released by gj_arena_free, all at once. */
+
+#define GJ_ARENA
+#define GJ_ARENA_CHUNK_SIZE (1 << 20)
+#define GJ_ARENA_ALIGN 16
+
+typedef struct gj_arena_chunk {
+    struct gj_arena_chunk* next;
+    size_t size;
+    size_t used;
+} gj_arena_chunk_t;
+
+typedef struct {
+    gj_arena_chunk_t* chunks;
+    size_t size;
+} gj_arena_t;
+
+static gj_arena_t* gj_arena = NULL;
+
+#define GJ_ARENA_ROUND(size) \
+    (((size) + GJ_ARENA_ALIGN - 1) & ~(size_t)(GJ_ARENA_ALIGN - 1))
+
+static gj_arena_t*
+gj_arena_create(void)
+{
+    return (gj_arena_t*)calloc(1, sizeof(gj_arena_t));
+}
+
+static void*
+gj_arena_alloc(gj_arena_t* arena, size_t size)
+{
+    gj_arena_chunk_t* chunk = arena->chunks;
+    size_t header = GJ_ARENA_ROUND(sizeof(gj_arena_chunk_t));
+    size_t capacity;
+    void* ptr;
+
+    size = GJ_ARENA_ROUND(size > 0 ? size : 1);
+    if (chunk == NULL || chunk->used + size > chunk->size) {
+        /* The rest of the previous chunk is abandoned */
+        capacity = size > GJ_ARENA_CHUNK_SIZE ? size : GJ_ARENA_CHUNK_SIZE;
+        chunk = (gj_arena_chunk_t*)calloc(1, header + capacity);
+        if (chunk == NULL)
+            return NULL;
+        chunk->size = capacity;
+        chunk->next = arena->chunks;
+        arena->chunks = chunk;
+    }
+    ptr = (unsigned char*)chunk + header + chunk->used;
+    chunk->used += size;
+    arena->size += size;
+    return ptr;
+}
+
+static void
+gj_arena_free(gj_arena_t* arena)
+{
+    gj_arena_chunk_t* chunk;
+
+    if (arena == NULL)
+        return;
+    while ((chunk = arena->chunks) != NULL) {
+        arena->chunks = chunk->next;
+        free(chunk);
+    }
+    free(arena);
+}
+
+static void*
+gj_calloc(size_t count, size_t size)
+{
+    if (gj_arena == NULL)
+        return calloc(count, size);
+    return gj_arena_alloc(gj_arena, count * size);
+}
@@ -0,0 +1,205 @@
+
+#include <errno.h>
+#include <signal.h>
+#include <stdint.h>
+#include <string.h>
+#include <sys/time.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+int gj_case(Mif_Private_t* data, const char* input, size_t size);
+
+/* The child of the running case, which SIGALRM kills at its timeout */
+static volatile pid_t gj_case_pid = 0;
+static volatile sig_atomic_t gj_case_timed_out = 0;
+
+static void
+gj_case_expire(int signum)
+{
+    (void)signum;
+    if (gj_case_pid > 0) {
+        kill(gj_case_pid, SIGKILL);
+        gj_case_timed_out = 1;
+    }
+}
+
+static void
+gj_case_timer(double seconds)
+{
+    /* Arm the timeout of the running case, or disarm it with 0 */
+    struct itimerval timer;
+
+    memset(&timer, 0, sizeof(timer));
+    if (seconds > 0) {
+        timer.it_value.tv_sec = (time_t)seconds;
+        timer.it_value.tv_usec = (suseconds_t)(
+            (seconds - (double)timer.it_value.tv_sec) * 1e6);
+        if (timer.it_value.tv_sec == 0 && timer.it_value.tv_usec == 0)
+            timer.it_value.tv_usec = 1;
+    }
+    setitimer(ITIMER_REAL, &timer, NULL);
+}
+
+static int
+gj_read_exact(int fd, void* buffer, size_t size)
+{
+    char* bytes = (char*)buffer;
+    ssize_t count;
+
+    while (size > 0) {
+        count = read(fd, bytes, size);
+        if (count < 0 && errno == EINTR)
+            continue;
+        if (count <= 0)
+            return -1;
+        bytes += count;
+        size -= count;
+    }
+    return 0;
+}
+
+static int
+gj_write_exact(int fd, const void* buffer, size_t size)
+{
+    const char* bytes = (const char*)buffer;
+    ssize_t count;
+
+    while (size > 0) {
+        count = write(fd, bytes, size);
+        if (count < 0 && errno == EINTR)
+            continue;
+        if (count <= 0)
+            return -1;
+        bytes += count;
+        size -= count;
+    }
+    return 0;
+}
+
+static int
+gj_run_case(Mif_Private_t* data, const char* input, uint32_t size,
+            double timeout, int reply_fd, char** output, size_t* output_size,
+            int* timed_out)
+{
+    /* Run one case in a forked child and collect its standard output. The
+    child is killed with SIGKILL if it runs longer than `timeout` seconds
+    (unless that is 0). Returns the exit status of the child, or minus the
+    signal which killed it. */
+    char chunk[4096];
+    char* grown;
+    size_t capacity = 0;
+    ssize_t count;
+    siginfo_t info;
+    int fds[2], status;
+    pid_t pid;
+
+    if (pipe(fds) != 0)
+        return -SIGABRT;
+    fflush(stdout);
+    pid = fork();
+    if (pid < 0)
+        return -SIGABRT;
+    if (pid == 0) {
+        signal(SIGALRM, SIG_DFL);
+        close(fds[0]);
+        close(reply_fd);
+        dup2(fds[1], 1);
+        close(fds[1]);
+        status = gj_case(data, input, size);
+        fflush(stdout);
+        _exit(status & 0xff);
+    }
+
+    close(fds[1]);
+    gj_case_timed_out = 0;
+    gj_case_pid = pid;
+    gj_case_timer(timeout);
+    *output_size = 0;
+    for (;;) {
+        count = read(fds[0], chunk, sizeof(chunk));
+        if (count < 0 && errno == EINTR)
+            continue;
+        if (count <= 0)
+            break;
+        if (*output_size + count > capacity) {
+            capacity = 2 * (*output_size + count);
+            grown = (char*)realloc(*output, capacity);
+            if (grown == NULL)
+                break;
+            *output = grown;
+        }
+        memcpy(*output + *output_size, chunk, count);
+        *output_size += count;
+    }
+    close(fds[0]);
+
+    /* The child is only reaped once the timer can no longer kill it, so
+    that its pid cannot be reused meanwhile */
+    while (waitid(P_PID, pid, &info, WEXITED | WNOWAIT) < 0) {
+        if (errno != EINTR)
+            break;
+    }
+    gj_case_timer(0);
+    gj_case_pid = 0;
+    *timed_out = gj_case_timed_out;
+    while (waitpid(pid, &status, 0) < 0) {
+        if (errno != EINTR)
+            return -SIGABRT;
+    }
+    if (WIFSIGNALED(status))
+        return -WTERMSIG(status);
+    return WEXITSTATUS(status);
+}
+
+int
+main(void)
+{
+    struct sigaction action;
+    char* input = NULL;
+    char* output = NULL;
+    size_t output_size = 0;
+    uint32_t size, header[3];
+    double timeout;
+    int reply_fd, timed_out;
+
+    GJ_SETUP(data)
+#ifdef GJ_CASE_INIT
+    GJ_CASE_INIT(data);
+#endif
+
+    /* Without SA_RESTART, so that the timeout interrupts reads and waits */
+    memset(&action, 0, sizeof(action));
+    action.sa_handler = gj_case_expire;
+    sigemptyset(&action.sa_mask);
+    sigaction(SIGALRM, &action, NULL);
+
+    /* Replies go to the original standard output; each child's standard
+    output is captured and sent back as the reply's payload. */
+    fflush(stdout);
+    reply_fd = dup(1);
+    dup2(2, 1);
+
+    while (gj_read_exact(0, &size, sizeof(size)) == 0 &&
+           gj_read_exact(0, &timeout, sizeof(timeout)) == 0) {
+        input = (char*)realloc(input, size + 1);
+        if (input == NULL || gj_read_exact(0, input, size) != 0)
+            break;
+        input[size] = '\0';
+
+        timed_out = 0;
+        header[0] = (uint32_t)gj_run_case(data, input, size, timeout,
+                                          reply_fd, &output, &output_size,
+                                          &timed_out);
+        header[1] = (uint32_t)timed_out;
+        header[2] = (uint32_t)output_size;
+        if (gj_write_exact(reply_fd, header, sizeof(header)) != 0 ||
+                gj_write_exact(reply_fd, output, output_size) != 0)
+            break;
+    }
+
+    free(input);
+    free(output);
+    GJ_TEARDOWN(data)
+    return 0;
+}
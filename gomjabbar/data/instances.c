@@ -0,0 +1,194 @@
+
+#include <stdlib.h>
+#include <time.h>
+
+/* A set of instances of the code model which are evaluated together, as in
+a circuit which instantiates the model many times. The instances of a
+contiguous set are allocated from one arena, in order. Each instance has its
+own runtime and starts with INIT set, which is cleared after its first
+call. */
+
+typedef void (*gj_entry_t)(Mif_Private_t*);
+
+typedef struct {
+    int num_instances;
+    Mif_Private_t** instances;
+    gj_runtime_t** runtimes;
+    /* The arena of a contiguous set, or NULL */
+    gj_arena_t* arena;
+    /* When set, the time spent in the calls of each instance is added up
+    in nanoseconds */
+    int timed;
+    long long* nanoseconds;
+    long num_calls;
+} gj_instances_t;
+
+static long long
+gj_instances_clock(void)
+{
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (long long)now.tv_sec * 1000000000LL + now.tv_nsec;
+}
+
+void
+gj_instances_destroy(gj_instances_t* set)
+{
+    int i;
+
+    if (set == NULL)
+        return;
+    /* In reverse order, each runtime is at the head of the list */
+    for (i = set->num_instances - 1; i >= 0; --i) {
+        if (set->arena != NULL)
+            gj_runtime_detach(set->instances[i]);
+        else
+            free_mif_private(set->instances[i]);
+    }
+    gj_arena_free(set->arena);
+    free(set->instances);
+    free(set->runtimes);
+    free(set->nanoseconds);
+    free(set);
+}
+
+gj_instances_t*
+gj_instances_create(int num_instances, int contiguous)
+{
+    gj_instances_t* set = (gj_instances_t*)calloc(1, sizeof(gj_instances_t));
+    size_t count = num_instances > 0 ? (size_t)num_instances : 1;
+    Mif_Private_t* data;
+    int i;
+
+    if (set == NULL)
+        return NULL;
+    set->instances = (Mif_Private_t**)calloc(count, sizeof(Mif_Private_t*));
+    set->runtimes = (gj_runtime_t**)calloc(count, sizeof(gj_runtime_t*));
+    set->nanoseconds = (long long*)calloc(count, sizeof(long long));
+    if (set->instances == NULL || set->runtimes == NULL ||
+        set->nanoseconds == NULL) {
+        gj_instances_destroy(set);
+        return NULL;
+    }
+    if (contiguous && (set->arena = gj_arena_create()) == NULL) {
+        gj_instances_destroy(set);
+        return NULL;
+    }
+
+    gj_arena = set->arena;
+    for (i = 0; i < num_instances; ++i) {
+        data = allocate_mif_private();
+        init_connections(data);
+        init_params(data);
+        data->circuit.init = MIF_TRUE;
+        set->instances[i] = data;
+        /* The runtime was just attached, at the head of the list */
+        set->runtimes[i] = gj_runtimes;
+        set->num_instances = i + 1;
+    }
+    gj_arena = NULL;
+    return set;
+}
+
+void
+gj_instances_call(gj_instances_t* set, gj_entry_t entry)
+{
+    /* Call every instance once */
+    Mif_Private_t* data;
+    long long start;
+    int i;
+
+    for (i = 0; i < set->num_instances; ++i) {
+        data = set->instances[i];
+        gj_runtime_current = set->runtimes[i];
+        if (set->timed) {
+            start = gj_instances_clock();
+            entry(data);
+            set->nanoseconds[i] += gj_instances_clock() - start;
+        }
+        else {
+            entry(data);
+        }
+        data->circuit.init = MIF_FALSE;
+    }
+    set->num_calls++;
+}
+
+void
+gj_instances_step(gj_instances_t* set, gj_entry_t entry, double time)
+{
+    /* Move every instance on to `time`, then call them */
+    int i;
+
+    for (i = 0; i < set->num_instances; ++i)
+        gj_runtime_advance(set->instances[i], set->runtimes[i], time);
+    gj_instances_call(set, entry);
+}
+
+void
+gj_instances_set_analysis(gj_instances_t* set, Mif_Analysis_t anal_type)
+{
+    int i;
+
+    for (i = 0; i < set->num_instances; ++i)
+        set->instances[i]->circuit.anal_type = anal_type;
+}
+
+void
+gj_instances_set_inputs(gj_instances_t* set, const double* inputs,
+                        int broadcast)
+{
+    /* One row of inputs per instance, or one row for all of them */
+    const double* row = inputs;
+    Mif_Private_t* data;
+    int i, j, n;
+
+    for (n = 0; n < set->num_instances; ++n) {
+        data = set->instances[n];
+        if (broadcast)
+            inputs = row;
+        for (i = 0; i < data->num_conn; ++i) {
+            if (data->conn[i]->is_null || !data->conn[i]->is_input)
+                continue;
+            for (j = 0; j < data->conn[i]->size; ++j) {
+                if (GJ_IS_ANALOG(data->conn[i]->port[j]))
+                    data->conn[i]->port[j]->input.rvalue = *inputs++;
+            }
+        }
+    }
+}
+
+void
+gj_instances_get_outputs(gj_instances_t* set, double* outputs)
+{
+    Mif_Private_t* data;
+    int i, j, n;
+
+    for (n = 0; n < set->num_instances; ++n) {
+        data = set->instances[n];
+        for (i = 0; i < data->num_conn; ++i) {
+            if (data->conn[i]->is_null || !data->conn[i]->is_output)
+                continue;
+            for (j = 0; j < data->conn[i]->size; ++j) {
+                if (GJ_IS_ANALOG(data->conn[i]->port[j]))
+                    *outputs++ = data->conn[i]->port[j]->output.rvalue;
+            }
+        }
+    }
+}
+
+void
+gj_instances_get_nanoseconds(gj_instances_t* set, long long* nanoseconds)
+{
+    int n;
+
+    for (n = 0; n < set->num_instances; ++n)
+        nanoseconds[n] = set->nanoseconds[n];
+}
+
+size_t
+gj_instances_arena_size(gj_instances_t* set)
+{
+    return set->arena != NULL ? set->arena->size : 0;
+}
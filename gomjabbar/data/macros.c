@@ -6,3 +6,28 @@ init_params(name);
 
 #define GJ_TEARDOWN(name) \
 free_mif_private(name);
+
+#define GJ_SNAPSHOT(name) gj_state_snapshot(name)
+#define GJ_RESTORE(name, state) gj_state_restore(name, state)
+#define GJ_SAVE_STATE(name, path) gj_state_save_file(name, path)
+#define GJ_LOAD_STATE(name, path) gj_state_load_file(name, path)
+
+#define GJ_STEP(name, time) gj_runtime_step(name, time)
+#define GJ_NUM_MESSAGES(name) gj_runtime_num_messages(name)
+#define GJ_MESSAGE(name, index) gj_runtime_message(name, index)
+#define GJ_NUM_BREAKPOINTS(name) gj_runtime_num_breakpoints(name)
+#define GJ_BREAKPOINT(name, index) gj_runtime_breakpoint(name, index)
+#define GJ_NOT_CONVERGED(name) gj_runtime_not_converged(name)
+#define GJ_CLEAR_RECORDS(name) gj_runtime_clear(name)
+
+#define GJ_SETUP_INSTANCES(name, count) \
+gj_instances_t* name = gj_instances_create(count, 1);
+
+#define GJ_TEARDOWN_INSTANCES(name) \
+gj_instances_destroy(name);
+
+#define GJ_INSTANCE(name, index) ((name)->instances[index])
+#define GJ_TIME_INSTANCES(name, on) ((name)->timed = (on))
+#define GJ_INSTANCE_NANOSECONDS(name, index) ((name)->nanoseconds[index])
+#define GJ_CALL_INSTANCES(name, entry) gj_instances_call(name, entry)
+#define GJ_STEP_INSTANCES(name, entry, time) gj_instances_step(name, entry, time)
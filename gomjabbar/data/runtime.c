@@ -0,0 +1,510 @@
+#include <stdlib.h>
+#include <string.h>
+
+/* Local implementations of the services which ngspice provides to code
+models. Each Mif_Private_t has a runtime; the services act on the current
+one, which is the instance being evaluated (see gj_runtime_enter), or else
+the most recently allocated instance or the one last passed to
+gj_runtime_step. */
+
+#define GJ_RUNTIME
+
+#ifndef MIF_OK
+#define MIF_OK 0
+#endif
+#ifndef MIF_ERROR
+#define MIF_ERROR 1
+#endif
+
+/* The number of timepoints of state kept, as cm_analog_get_ptr only gives
+access to the current (0) and the previous (1) timepoint */
+#define GJ_RUNTIME_DEPTH 2
+
+#define GJ_BREAKPOINT_TEMPORARY 0
+#define GJ_BREAKPOINT_PERMANENT 1
+#define GJ_BREAKPOINT_EVENT 2
+
+typedef struct {
+    int tag;
+    size_t offset;
+    size_t size;
+} gj_runtime_tag_t;
+
+typedef struct {
+    gj_runtime_tag_t* tags;
+    int num_tags;
+    size_t size;
+    /* A ring buffer of timepoints; head is the current one */
+    unsigned char* timepoints[GJ_RUNTIME_DEPTH];
+    int head;
+} gj_runtime_states_t;
+
+typedef struct {
+    double time;
+    int kind;
+} gj_breakpoint_t;
+
+typedef struct gj_runtime {
+    Mif_Private_t* data;
+    gj_runtime_states_t analog;
+    gj_runtime_states_t event;
+    char** messages;
+    int num_messages;
+    int messages_capacity;
+    gj_breakpoint_t* breakpoints;
+    int num_breakpoints;
+    int breakpoints_capacity;
+    int not_converged;
+    char* errmsg;
+    struct gj_runtime* next;
+} gj_runtime_t;
+
+static gj_runtime_t* gj_runtimes = NULL;
+static gj_runtime_t* gj_runtime_current = NULL;
+
+static gj_runtime_t*
+gj_runtime_find(Mif_Private_t* data)
+{
+    gj_runtime_t* runtime;
+
+    for (runtime = gj_runtimes; runtime != NULL; runtime = runtime->next) {
+        if (runtime->data == data)
+            return runtime;
+    }
+    return NULL;
+}
+
+static void
+gj_runtime_attach(Mif_Private_t* data)
+{
+    gj_runtime_t* runtime = (gj_runtime_t*)calloc(1, sizeof(gj_runtime_t));
+
+    runtime->data = data;
+    runtime->next = gj_runtimes;
+    gj_runtimes = runtime;
+    gj_runtime_current = runtime;
+}
+
+static void
+gj_runtime_enter(Mif_Private_t* data)
+{
+    /* Make the runtime of `data` the current one before it is evaluated.
+    Evaluating the same instance again, as in a loop, skips the lookup. */
+    gj_runtime_t* runtime;
+
+    if (gj_runtime_current != NULL && gj_runtime_current->data == data)
+        return;
+    if ((runtime = gj_runtime_find(data)) != NULL)
+        gj_runtime_current = runtime;
+}
+
+static void
+gj_runtime_free_states(gj_runtime_states_t* states)
+{
+    int i;
+
+    free(states->tags);
+    for (i = 0; i < GJ_RUNTIME_DEPTH; ++i)
+        free(states->timepoints[i]);
+}
+
+void
+gj_runtime_clear(Mif_Private_t* data)
+{
+    /* Forget the recorded messages and breakpoints */
+    gj_runtime_t* runtime = gj_runtime_find(data);
+    int i;
+
+    if (runtime == NULL)
+        return;
+    for (i = 0; i < runtime->num_messages; ++i)
+        free(runtime->messages[i]);
+    free(runtime->messages);
+    free(runtime->breakpoints);
+    runtime->messages = NULL;
+    runtime->num_messages = 0;
+    runtime->messages_capacity = 0;
+    runtime->breakpoints = NULL;
+    runtime->num_breakpoints = 0;
+    runtime->breakpoints_capacity = 0;
+    runtime->not_converged = 0;
+}
+
+static void
+gj_runtime_detach(Mif_Private_t* data)
+{
+    gj_runtime_t** link;
+    gj_runtime_t* runtime;
+
+    for (link = &gj_runtimes; *link != NULL; link = &(*link)->next) {
+        if ((*link)->data != data)
+            continue;
+        runtime = *link;
+        gj_runtime_clear(data);
+        gj_runtime_free_states(&runtime->analog);
+        gj_runtime_free_states(&runtime->event);
+        *link = runtime->next;
+        if (gj_runtime_current == runtime)
+            gj_runtime_current = gj_runtimes;
+        free(runtime);
+        return;
+    }
+}
+
+static void
+gj_runtime_rotate(gj_runtime_states_t* states)
+{
+    /* The new timepoint starts as a copy of the previous one, as in
+    ngspice */
+    int previous = states->head;
+
+    states->head = (states->head + 1) % GJ_RUNTIME_DEPTH;
+    if (states->size > 0) {
+        memcpy(states->timepoints[states->head],
+               states->timepoints[previous], states->size);
+    }
+}
+
+static void
+gj_runtime_advance(Mif_Private_t* data, gj_runtime_t* runtime, double time)
+{
+    int i;
+
+    for (i = 7; i > 0; --i)
+        data->circuit.t[i] = data->circuit.t[i - 1];
+    data->circuit.t[0] = time;
+    data->circuit.time = time;
+    if (runtime == NULL)
+        return;
+    gj_runtime_current = runtime;
+    gj_runtime_rotate(&runtime->analog);
+    gj_runtime_rotate(&runtime->event);
+}
+
+void
+gj_runtime_step(Mif_Private_t* data, double time)
+{
+    /* Accept the current timepoint and move on to `time` */
+    gj_runtime_advance(data, gj_runtime_find(data), time);
+}
+
+int
+gj_runtime_num_messages(Mif_Private_t* data)
+{
+    gj_runtime_t* runtime = gj_runtime_find(data);
+
+    return runtime != NULL ? runtime->num_messages : 0;
+}
+
+const char*
+gj_runtime_message(Mif_Private_t* data, int index)
+{
+    gj_runtime_t* runtime = gj_runtime_find(data);
+
+    if (runtime == NULL || index < 0 || index >= runtime->num_messages)
+        return NULL;
+    return runtime->messages[index];
+}
+
+int
+gj_runtime_num_breakpoints(Mif_Private_t* data)
+{
+    gj_runtime_t* runtime = gj_runtime_find(data);
+
+    return runtime != NULL ? runtime->num_breakpoints : 0;
+}
+
+gj_breakpoint_t
+gj_runtime_breakpoint(Mif_Private_t* data, int index)
+{
+    gj_runtime_t* runtime = gj_runtime_find(data);
+    gj_breakpoint_t none = {-1.0, -1};
+
+    if (runtime == NULL || index < 0 || index >= runtime->num_breakpoints)
+        return none;
+    return runtime->breakpoints[index];
+}
+
+int
+gj_runtime_not_converged(Mif_Private_t* data)
+{
+    gj_runtime_t* runtime = gj_runtime_find(data);
+
+    return runtime != NULL ? runtime->not_converged : 0;
+}
+
+static void
+gj_runtime_error(const char* errmsg)
+{
+    if (gj_runtime_current != NULL)
+        gj_runtime_current->errmsg = (char*)errmsg;
+}
+
+static void
+gj_runtime_alloc(gj_runtime_states_t* states, int tag, int bytes)
+{
+    gj_runtime_tag_t* tags;
+    unsigned char* timepoint;
+    size_t size;
+    int i;
+
+    if (bytes < 0) {
+        gj_runtime_error("Invalid number of bytes");
+        return;
+    }
+    for (i = 0; i < states->num_tags; ++i) {
+        /* Allocating a tag again (e.g. on a second INIT) keeps its state */
+        if (states->tags[i].tag != tag)
+            continue;
+        if (states->tags[i].size != (size_t)bytes)
+            gj_runtime_error("Tag already allocated with a different size");
+        return;
+    }
+
+    size = states->size + (size_t)bytes;
+    tags = (gj_runtime_tag_t*)realloc(
+        states->tags, (states->num_tags + 1) * sizeof(gj_runtime_tag_t)
+    );
+    if (tags == NULL) {
+        gj_runtime_error("Out of memory");
+        return;
+    }
+    states->tags = tags;
+    for (i = 0; i < GJ_RUNTIME_DEPTH; ++i) {
+        timepoint = (unsigned char*)realloc(states->timepoints[i],
+                                            size > 0 ? size : 1);
+        if (timepoint == NULL) {
+            gj_runtime_error("Out of memory");
+            return;
+        }
+        memset(timepoint + states->size, 0, (size_t)bytes);
+        states->timepoints[i] = timepoint;
+    }
+    tags[states->num_tags].tag = tag;
+    tags[states->num_tags].offset = states->size;
+    tags[states->num_tags].size = (size_t)bytes;
+    states->num_tags++;
+    states->size = size;
+}
+
+static void*
+gj_runtime_get_ptr(gj_runtime_states_t* states, int tag, int timepoint)
+{
+    int i;
+
+    if (timepoint < 0 || timepoint >= GJ_RUNTIME_DEPTH) {
+        gj_runtime_error("Invalid timepoint");
+        return NULL;
+    }
+    for (i = 0; i < states->num_tags; ++i) {
+        if (states->tags[i].tag != tag)
+            continue;
+        return states->timepoints[(states->head - timepoint +
+                                   GJ_RUNTIME_DEPTH) % GJ_RUNTIME_DEPTH] +
+            states->tags[i].offset;
+    }
+    gj_runtime_error("Unknown tag");
+    return NULL;
+}
+
+static int
+gj_runtime_breakpoint_add(double time, int kind)
+{
+    gj_runtime_t* runtime = gj_runtime_current;
+    gj_breakpoint_t* breakpoints;
+    int capacity;
+
+    if (runtime == NULL)
+        return MIF_ERROR;
+    if (time < runtime->data->circuit.time) {
+        gj_runtime_error("Breakpoint is in the past");
+        return MIF_ERROR;
+    }
+    if (runtime->num_breakpoints == runtime->breakpoints_capacity) {
+        capacity = runtime->breakpoints_capacity ?
+            runtime->breakpoints_capacity * 2 : 16;
+        breakpoints = (gj_breakpoint_t*)realloc(
+            runtime->breakpoints, capacity * sizeof(gj_breakpoint_t)
+        );
+        if (breakpoints == NULL)
+            return MIF_ERROR;
+        runtime->breakpoints = breakpoints;
+        runtime->breakpoints_capacity = capacity;
+    }
+    runtime->breakpoints[runtime->num_breakpoints].time = time;
+    runtime->breakpoints[runtime->num_breakpoints].kind = kind;
+    runtime->num_breakpoints++;
+    return MIF_OK;
+}
+
+void
+cm_analog_alloc(int tag, int bytes)
+{
+    if (gj_runtime_current == NULL)
+        return;
+    if (!gj_runtime_current->data->circuit.init) {
+        gj_runtime_error("cm_analog_alloc called outside of INIT");
+        return;
+    }
+    gj_runtime_alloc(&gj_runtime_current->analog, tag, bytes);
+}
+
+void
+cm_event_alloc(int tag, int bytes)
+{
+    if (gj_runtime_current == NULL)
+        return;
+    if (!gj_runtime_current->data->circuit.init) {
+        gj_runtime_error("cm_event_alloc called outside of INIT");
+        return;
+    }
+    gj_runtime_alloc(&gj_runtime_current->event, tag, bytes);
+}
+
+void*
+cm_analog_get_ptr(int tag, int timepoint)
+{
+    if (gj_runtime_current == NULL)
+        return NULL;
+    return gj_runtime_get_ptr(&gj_runtime_current->analog, tag, timepoint);
+}
+
+void*
+cm_event_get_ptr(int tag, int timepoint)
+{
+    if (gj_runtime_current == NULL)
+        return NULL;
+    return gj_runtime_get_ptr(&gj_runtime_current->event, tag, timepoint);
+}
+
+int
+cm_analog_set_temp_bkpt(double time)
+{
+    return gj_runtime_breakpoint_add(time, GJ_BREAKPOINT_TEMPORARY);
+}
+
+int
+cm_analog_set_perm_bkpt(double time)
+{
+    return gj_runtime_breakpoint_add(time, GJ_BREAKPOINT_PERMANENT);
+}
+
+int
+cm_event_queue(double time)
+{
+    return gj_runtime_breakpoint_add(time, GJ_BREAKPOINT_EVENT);
+}
+
+void
+cm_analog_not_converged(void)
+{
+    if (gj_runtime_current != NULL)
+        gj_runtime_current->not_converged++;
+}
+
+void
+cm_analog_auto_partial(void)
+{
+}
+
+static double*
+gj_runtime_previous(gj_runtime_states_t* states, double* state)
+{
+    /* Return the value at the previous timepoint of a value in the state of
+    the current one, or NULL if `state` is not in it */
+    unsigned char* current = states->timepoints[states->head];
+    unsigned char* pointer = (unsigned char*)state;
+    int previous;
+
+    if (current == NULL || pointer < current ||
+            pointer + sizeof(double) > current + states->size)
+        return NULL;
+    previous = (states->head - 1 + GJ_RUNTIME_DEPTH) % GJ_RUNTIME_DEPTH;
+    return (double*)(states->timepoints[previous] + (pointer - current));
+}
+
+int
+cm_analog_integrate(double integrand, double* integral, double* partial)
+{
+    /* Integrate with backward Euler from the value of `integral`, which is
+    in the analog state, at the previous timepoint. The integral stays put
+    at the DC operating point. */
+    gj_runtime_t* runtime = gj_runtime_current;
+    double* previous;
+    double delta;
+
+    if (runtime == NULL || integral == NULL)
+        return MIF_ERROR;
+    previous = gj_runtime_previous(&runtime->analog, integral);
+    if (previous == NULL) {
+        gj_runtime_error("cm_analog_integrate needs a pointer into the "
+                         "analog state");
+        return MIF_ERROR;
+    }
+    delta = 0.0;
+    if (runtime->data->circuit.anal_type != MIF_DC)
+        delta = runtime->data->circuit.t[0] - runtime->data->circuit.t[1];
+    *integral = *previous + integrand * delta;
+    if (partial != NULL)
+        *partial = delta;
+    return MIF_OK;
+}
+
+int
+cm_analog_converge(double* state)
+{
+    /* Convergence is not iterated on, so only the pointer is checked */
+    if (gj_runtime_current == NULL ||
+            gj_runtime_previous(&gj_runtime_current->analog, state) == NULL) {
+        gj_runtime_error("cm_analog_converge needs a pointer into the "
+                         "analog state");
+        return MIF_ERROR;
+    }
+    return MIF_OK;
+}
+
+double
+cm_analog_ramp_factor(void)
+{
+    /* Sources are never ramped up */
+    return 1.0;
+}
+
+char*
+cm_message_get_errmsg(void)
+{
+    char* errmsg;
+
+    if (gj_runtime_current == NULL)
+        return NULL;
+    errmsg = gj_runtime_current->errmsg;
+    gj_runtime_current->errmsg = NULL;
+    return errmsg;
+}
+
+int
+cm_message_send(const char* msg)
+{
+    gj_runtime_t* runtime = gj_runtime_current;
+    char** messages;
+    char* copy;
+    int capacity;
+
+    if (runtime == NULL || msg == NULL)
+        return MIF_ERROR;
+    if (runtime->num_messages == runtime->messages_capacity) {
+        capacity = runtime->messages_capacity ?
+            runtime->messages_capacity * 2 : 16;
+        messages = (char**)realloc(runtime->messages,
+                                   capacity * sizeof(char*));
+        if (messages == NULL)
+            return MIF_ERROR;
+        runtime->messages = messages;
+        runtime->messages_capacity = capacity;
+    }
+    if ((copy = (char*)malloc(strlen(msg) + 1)) == NULL)
+        return MIF_ERROR;
+    strcpy(copy, msg);
+    runtime->messages[runtime->num_messages++] = copy;
+    return MIF_OK;
+}
@@ -0,0 +1,295 @@
+
+#include <limits.h>
+#include <stdio.h>
+#include <string.h>
+
+#define GJ_STATE_MAGIC "GJST"
+#define GJ_STATE_VERSION 2
+
+typedef struct {
+    size_t size;
+    unsigned char* bytes;
+} gj_state_t;
+
+static void
+gj_state_field(unsigned char* buffer, size_t* offset, void* field,
+               size_t size, int load)
+{
+    if (buffer != NULL && size > 0) {
+        if (load)
+            memcpy(field, buffer + *offset, size);
+        else
+            memcpy(buffer + *offset, field, size);
+    }
+    *offset += size;
+}
+
+static void
+gj_state_timepoints(unsigned char* buffer, size_t* offset,
+                    gj_runtime_states_t* states, int load)
+{
+    int i;
+
+    /* The tags come first so that gj_state_prepare can allocate them */
+    gj_state_field(buffer, offset, &states->num_tags,
+                   sizeof(states->num_tags), load);
+    gj_state_field(buffer, offset, states->tags,
+                   states->num_tags * sizeof(gj_runtime_tag_t), load);
+    gj_state_field(buffer, offset, &states->head, sizeof(states->head), load);
+    for (i = 0; i < GJ_RUNTIME_DEPTH; ++i) {
+        gj_state_field(buffer, offset, states->timepoints[i], states->size,
+                       load);
+    }
+}
+
+static size_t
+gj_state_walk(Mif_Private_t* data, unsigned char* buffer, int load)
+{
+    /* Visit every piece of instance state in a fixed order. With a NULL
+    buffer this only measures the size of the state. */
+    gj_runtime_t* runtime = gj_runtime_find(data);
+    Mif_Port_Data_t* port;
+    size_t offset = 0;
+    int i, j, k;
+
+    gj_state_field(buffer, &offset, &data->circuit, sizeof(data->circuit),
+                   load);
+
+    for (i = 0; i < data->num_inst_var; ++i) {
+        gj_state_field(buffer, &offset, data->inst_var[i]->element,
+                       sizeof(Mif_Value_t), load);
+    }
+
+    /* States allocated with cm_analog_alloc and cm_event_alloc */
+    if (runtime != NULL) {
+        gj_state_timepoints(buffer, &offset, &runtime->analog, load);
+        gj_state_timepoints(buffer, &offset, &runtime->event, load);
+    }
+
+    for (i = 0; i < data->num_conn; ++i) {
+        if (data->conn[i]->is_null)
+            continue;
+        for (j = 0; j < data->conn[i]->size; ++j) {
+            port = data->conn[i]->port[j];
+            if (port->type == MIF_DIGITAL) {
+                gj_state_field(buffer, &offset, port->input.pvalue,
+                               sizeof(Digital_t), load);
+                gj_state_field(buffer, &offset, port->output.pvalue,
+                               sizeof(Digital_t), load);
+            }
+            else {
+                gj_state_field(buffer, &offset, &port->input.rvalue,
+                               sizeof(double), load);
+                gj_state_field(buffer, &offset, &port->output.rvalue,
+                               sizeof(double), load);
+            }
+            gj_state_field(buffer, &offset, &port->changed,
+                           sizeof(port->changed), load);
+            gj_state_field(buffer, &offset, &port->delay,
+                           sizeof(port->delay), load);
+            if (!data->conn[i]->is_output)
+                continue;
+            for (k = 0; k < data->num_conn; ++k) {
+                if (data->conn[k]->is_null || !data->conn[k]->is_input)
+                    continue;
+                gj_state_field(buffer, &offset, port->partial[k].port,
+                               data->conn[k]->size * sizeof(double), load);
+                gj_state_field(buffer, &offset, port->ac_gain[k].port,
+                               data->conn[k]->size * sizeof(Mif_Complex_t),
+                               load);
+            }
+        }
+    }
+
+    return offset;
+}
+
+static size_t
+gj_state_header(Mif_Private_t* data, unsigned char* buffer)
+{
+    int header[4];
+
+    header[0] = GJ_STATE_VERSION;
+    header[1] = data->num_conn;
+    header[2] = data->num_inst_var;
+    header[3] = (int)gj_state_walk(data, NULL, 0);
+    if (buffer != NULL) {
+        memcpy(buffer, GJ_STATE_MAGIC, 4);
+        memcpy(buffer + 4, header, sizeof(header));
+    }
+    return 4 + sizeof(header);
+}
+
+static int
+gj_state_prepare_states(gj_runtime_states_t* states,
+                        const unsigned char* buffer, size_t size,
+                        size_t* offset)
+{
+    /* Allocate the tags saved at `offset` into states which have none yet,
+    e.g. those of an instance which has not run INIT, or check that they
+    match the tags which are allocated. Moves `offset` past the states. */
+    gj_runtime_tag_t tag;
+    size_t states_size = 0;
+    int num_tags, i;
+
+    if (*offset + sizeof(num_tags) > size)
+        return -1;
+    memcpy(&num_tags, buffer + *offset, sizeof(num_tags));
+    *offset += sizeof(num_tags);
+    if (num_tags < 0 ||
+            (size - *offset) / sizeof(gj_runtime_tag_t) < (size_t)num_tags)
+        return -1;
+    if (states->num_tags != 0 && states->num_tags != num_tags)
+        return -1;
+
+    for (i = 0; i < num_tags; ++i) {
+        memcpy(&tag, buffer + *offset, sizeof(tag));
+        *offset += sizeof(tag);
+        if (tag.offset != states_size || tag.size > (size_t)INT_MAX)
+            return -1;
+        states_size += tag.size;
+        if (states->num_tags < num_tags) {
+            gj_runtime_alloc(states, tag.tag, (int)tag.size);
+            if (states->num_tags != i + 1)
+                return -1;
+        }
+        else if (states->tags[i].tag != tag.tag ||
+                 states->tags[i].size != tag.size) {
+            return -1;
+        }
+    }
+
+    *offset += sizeof(states->head) + GJ_RUNTIME_DEPTH * states_size;
+    return *offset <= size ? 0 : -1;
+}
+
+static int
+gj_state_prepare(Mif_Private_t* data, const unsigned char* buffer,
+                 size_t size)
+{
+    /* Check the header of a buffer written by gj_state_save and allocate
+    the states it holds, so that its size can be compared with that of the
+    instance */
+    gj_runtime_t* runtime = gj_runtime_find(data);
+    unsigned char header[4 + 4 * sizeof(int)];
+    size_t offset = gj_state_header(data, header);
+
+    /* Everything but the size of the state */
+    if (size < offset || memcmp(buffer, header, offset - sizeof(int)) != 0)
+        return -1;
+    if (runtime == NULL)
+        return 0;
+    offset += sizeof(data->circuit) + data->num_inst_var * sizeof(Mif_Value_t);
+    if (gj_state_prepare_states(&runtime->analog, buffer, size, &offset) != 0)
+        return -1;
+    return gj_state_prepare_states(&runtime->event, buffer, size, &offset);
+}
+
+size_t
+gj_state_size(Mif_Private_t* data)
+{
+    return gj_state_header(data, NULL) + gj_state_walk(data, NULL, 0);
+}
+
+size_t
+gj_state_save(Mif_Private_t* data, void* buffer)
+{
+    /* Copy the instance state into `buffer`, which must hold at least
+    gj_state_size(data) bytes. Returns the number of bytes written. */
+    size_t offset = gj_state_header(data, (unsigned char*)buffer);
+    return offset + gj_state_walk(data, (unsigned char*)buffer + offset, 0);
+}
+
+int
+gj_state_load(Mif_Private_t* data, const void* buffer, size_t size)
+{
+    /* Restore the instance state from a buffer written by gj_state_save.
+    The states allocated with cm_analog_alloc and cm_event_alloc are
+    allocated first if the instance has none yet, so a fresh instance can be
+    restored before it runs INIT. Returns 0, or -1 if the buffer does not
+    belong to this code model. */
+    unsigned char header[4 + 4 * sizeof(int)];
+    size_t offset;
+
+    if (gj_state_prepare(data, (const unsigned char*)buffer, size) != 0)
+        return -1;
+    offset = gj_state_header(data, header);
+    if (size != gj_state_size(data) || memcmp(buffer, header, offset) != 0)
+        return -1;
+    gj_state_walk(data, (unsigned char*)buffer + offset, 1);
+    return 0;
+}
+
+gj_state_t*
+gj_state_snapshot(Mif_Private_t* data)
+{
+    gj_state_t* state = (gj_state_t*)malloc(sizeof(gj_state_t));
+
+    if (state == NULL)
+        return NULL;
+    state->size = gj_state_size(data);
+    state->bytes = (unsigned char*)malloc(state->size);
+    if (state->bytes == NULL) {
+        free(state);
+        return NULL;
+    }
+    gj_state_save(data, state->bytes);
+    return state;
+}
+
+int
+gj_state_restore(Mif_Private_t* data, const gj_state_t* state)
+{
+    return gj_state_load(data, state->bytes, state->size);
+}
+
+void
+gj_state_free(gj_state_t* state)
+{
+    if (state != NULL)
+        free(state->bytes);
+    free(state);
+}
+
+int
+gj_state_save_file(Mif_Private_t* data, const char* path)
+{
+    gj_state_t* state = gj_state_snapshot(data);
+    FILE* fp;
+    int status = -1;
+
+    if (state == NULL)
+        return -1;
+    if ((fp = fopen(path, "wb")) != NULL) {
+        if (fwrite(state->bytes, 1, state->size, fp) == state->size)
+            status = 0;
+        if (fclose(fp) != 0)
+            status = -1;
+    }
+    gj_state_free(state);
+    return status;
+}
+
+int
+gj_state_load_file(Mif_Private_t* data, const char* path)
+{
+    gj_state_t state;
+    FILE* fp;
+    long size;
+    int status = -1;
+
+    /* The file sets the size, as a fresh instance has no states yet */
+    if ((fp = fopen(path, "rb")) == NULL)
+        return -1;
+    if (fseek(fp, 0, SEEK_END) == 0 && (size = ftell(fp)) >= 0 &&
+            fseek(fp, 0, SEEK_SET) == 0) {
+        state.size = (size_t)size;
+        state.bytes = (unsigned char*)malloc(state.size > 0 ? state.size : 1);
+        if (state.bytes != NULL &&
+                fread(state.bytes, 1, state.size, fp) == state.size)
+            status = gj_state_restore(data, &state);
+        free(state.bytes);
+    }
+    fclose(fp);
+    return status;
+}
@@ -0,0 +1,162 @@
+""" Event-driven simulation of code models with digital (MIF_DIGITAL) ports.
+
+`build_digital_library` builds a code model into a `DigitalModel`, whose
+`simulate` method applies timed input events to the model's digital inputs.
+A priority queue in C calls the model whenever its inputs change, schedules
+its output changes after their ``OUTPUT_DELAY`` and records the resulting
+output event stream. Events are passed in and out as NumPy record arrays of
+`EVENT_DTYPE`, so millions of events cost a few array copies::
+
+    with build_digital_library('my_inverter', {}) as model:
+        events = np.array([(1e-9, 0, ONE, STRONG)], dtype=EVENT_DTYPE)
+        output = model.simulate(events)
+
+Requires NumPy.
+"""
+import contextlib
+import ctypes
+
+import numpy as np
+
+from gomjabbar.library import CodeModelLibrary, _build_library, _port_names
+
+#: A digital event: when it happens, the index of the port, and the new value
+EVENT_DTYPE = np.dtype([
+    ('time', np.float64),
+    ('port', np.int32),
+    ('state', np.int16),
+    ('strength', np.int16),
+], align=True)
+
+# Digital_State_t
+ZERO, ONE, UNKNOWN = 0, 1, 2
+# Digital_Strength_t
+STRONG, RESISTIVE, HI_IMPEDANCE, UNDETERMINED = 0, 1, 2, 3
+
+_ERRORS = {
+    -1: (MemoryError, 'Out of memory during the digital simulation'),
+    -2: (ValueError, 'An input event names a port which does not exist'),
+    -3: (RuntimeError, 'The code model changed an output without setting a '
+                       'positive OUTPUT_DELAY'),
+    -4: (ValueError, 'The input events are not sorted by time'),
+}
+
+
+@contextlib.contextmanager
+def build_digital_library(code_model_dir, parameters, build_root=None,
+                          keep_failed=None, sources=None):
+    """ Build a code model into a `DigitalModel`.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model.
+    parameters : dict
+        A dictionary of values which will be assigned to the PARAMETER_TABLE
+        variables defined by the code model.
+    build_root : str, optional
+        See `gomjabbar.generate.build_test`.
+    keep_failed : bool, optional
+        See `gomjabbar.generate.build_test`.
+    sources : list of str, optional
+        See `gomjabbar.generate.build_test`.
+    """
+    with _build_library(code_model_dir, parameters, DigitalModel,
+                        ('digital.c.jinja',), build_root=build_root,
+                        keep_failed=keep_failed, sources=sources) as library:
+        yield library
+
+
+class DigitalModel(CodeModelLibrary):
+    """ A code model loaded into this process which can be simulated with
+    digital events.
+
+    Digital input and output ports are numbered in PORT_TABLE order,
+    ignoring analog ports; see `digital_input_names` and
+    `digital_output_names`.
+    """
+    def __init__(self, path, connections):
+        super(DigitalModel, self).__init__(path, connections)
+        digital = [
+            dict(conn, ports=[p for p in conn['ports']
+                              if p['type'] == 'MIF_DIGITAL'])
+            for conn in connections
+        ]
+        self.digital_input_names = _digital_names(digital, 'is_input')
+        self.digital_output_names = _digital_names(digital, 'is_output')
+
+        events_p = ctypes.POINTER(_Event)
+        self._lib.gj_digital_run.argtypes = [
+            ctypes.c_void_p, ctypes.c_long, events_p, ctypes.c_double,
+            ctypes.POINTER(events_p), ctypes.POINTER(ctypes.c_long)
+        ]
+        self._lib.gj_digital_run.restype = ctypes.c_long
+        self._lib.gj_digital_free.argtypes = [events_p]
+        self._lib.gj_digital_free.restype = None
+
+    def simulate(self, events, until=None):
+        """ Run an event-driven simulation of the code model.
+
+        The model is called with ``INIT`` set and ``ANALYSIS`` of DC at time
+        0, after the input events at or before time 0 are applied; inputs
+        start at a strong zero otherwise. From then on, the model is called
+        at each time where an input changes and its output changes are
+        applied after their delay. A new output change cancels any pending
+        changes of the same output at or after its time.
+
+        Parameters
+        ----------
+        events : array_like
+            Input events of `EVENT_DTYPE`, or a sequence of
+            ``(time, port, state, strength)`` tuples. `port` indexes
+            `digital_input_names`. Events at the same time are applied
+            together, in order.
+        until : float, optional
+            Stop the simulation at this time. By default it runs until no
+            events are left.
+
+        Returns the output events as an array of `EVENT_DTYPE`, where
+        `port` indexes `digital_output_names`. The first events are the
+        initial values of the outputs at time 0; after that, only changes
+        of value are recorded.
+        """
+        self._check_open()
+        events = np.array(events, dtype=EVENT_DTYPE).ravel()
+        order = np.argsort(events['time'], kind='stable')
+        events = np.ascontiguousarray(events[order])
+        if until is None:
+            until = float('inf')
+
+        output_p = ctypes.POINTER(_Event)()
+        num_output = ctypes.c_long(0)
+        status = self._lib.gj_digital_run(
+            self._data, len(events),
+            events.ctypes.data_as(ctypes.POINTER(_Event)), until,
+            ctypes.byref(output_p), ctypes.byref(num_output)
+        )
+        if status != 0:
+            exc_type, msg = _ERRORS.get(status, (RuntimeError, status))
+            raise exc_type(msg)
+
+        try:
+            output = np.empty(num_output.value, dtype=EVENT_DTYPE)
+            if num_output.value:
+                ctypes.memmove(output.ctypes.data, output_p, output.nbytes)
+        finally:
+            self._lib.gj_digital_free(output_p)
+        return output
+
+
+class _Event(ctypes.Structure):
+    # Mirrors gj_event_t and EVENT_DTYPE
+    _fields_ = [
+        ('time', ctypes.c_double),
+        ('port', ctypes.c_int32),
+        ('state', ctypes.c_int16),
+        ('strength', ctypes.c_int16),
+    ]
+
+
+def _digital_names(connections, direction):
+    return _port_names([c for c in connections if c['ports']], direction,
+                       analog=False)
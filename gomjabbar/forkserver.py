@@ -0,0 +1,132 @@
+""" Run many test cases against one initialized test program.
+
+A fork server program is built from test code which defines::
+
+    int gj_case(Mif_Private_t* data, const char* input, size_t size);
+
+The program runs ``GJ_SETUP`` once (and ``GJ_CASE_INIT(data)`` if the test
+code defines that macro), then forks a copy-on-write child for each case it
+receives. Each child runs `gj_case` with the case's input and exits with its
+return value; its standard output is sent back as the case's output. A case
+which crashes only kills its child, a case which outlives its timeout is
+killed with SIGKILL, and no case pays for exec, dynamic loading or
+``GJ_SETUP``.
+
+Cases are framed on the program's standard input and output as a native
+uint32 length and double timeout in seconds (0 for none) followed by the
+input, and replies as a native int32 status, uint32 timed-out flag and
+uint32 length followed by the output. POSIX only.
+"""
+import collections
+import contextlib
+import struct
+import subprocess
+
+from gomjabbar.generate import (
+    TEMPLATE_ENV, TEMPLATE_LOADER, _build_source, _get_template_context,
+    _harness_options, _render_harness
+)
+
+#: The result of a case. `returncode` is the exit status of `gj_case` or,
+#: as with `subprocess`, minus the signal which killed it. `timed_out` is
+#: True if the case was killed at its timeout.
+CaseResult = collections.namedtuple('CaseResult', [
+    'returncode', 'output', 'timed_out'
+])
+
+_REQUEST = struct.Struct('=Id')
+_REPLY = struct.Struct('=iII')
+
+
+class ForkServerError(RuntimeError):
+    """ Raised when a fork server program stops unexpectedly.
+    """
+
+
+@contextlib.contextmanager
+def build_fork_server(code_model_dir, code, parameters, build_root=None,
+                      keep_failed=None, sources=None, timeout=None):
+    """ Build a fork server program from test code which defines `gj_case`
+    and yield it as a running `ForkServer`.
+
+    The arguments are the same as those of `gomjabbar.generate.build_test`,
+    and `timeout` is the default timeout of the `ForkServer`.
+    """
+    conns, params, num_vars = _get_template_context(code_model_dir, parameters)
+    main = TEMPLATE_LOADER.get_source(TEMPLATE_ENV, 'forkserver.c')[0]
+    options = _harness_options(code_model_dir, [code])
+    source = (_render_harness(conns, params, num_vars, **options) + code +
+              main)
+    with _build_source(code_model_dir, source, build_root=build_root,
+                       keep_failed=keep_failed, sources=sources) as path:
+        with ForkServer(path, timeout=timeout) as server:
+            yield server
+
+
+class ForkServer(object):
+    """ A running fork server program.
+
+    Parameters
+    ----------
+    path : str
+        The path of a program built by `build_fork_server`.
+    timeout : float, optional
+        The default wall-clock budget of a case in seconds. By default,
+        cases run until they exit.
+    """
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.process = subprocess.Popen([path], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Stop the program and wait for it to exit.
+        """
+        if self.process.stdin is not None and not self.process.stdin.closed:
+            self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def run(self, input=b'', timeout=None):
+        """ Run one case with `input` (bytes or str) and return a
+        `CaseResult`. The case is killed after `timeout` seconds, which
+        defaults to the `timeout` of the server.
+        """
+        if not isinstance(input, bytes):
+            input = input.encode('utf8')
+        if timeout is None:
+            timeout = self.timeout
+        request = _REQUEST.pack(len(input), timeout or 0.0)
+        try:
+            self.process.stdin.write(request + input)
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            raise ForkServerError(self._died_message())
+
+        header = self._read(_REPLY.size)
+        returncode, timed_out, size = _REPLY.unpack(header)
+        return CaseResult(returncode, self._read(size), bool(timed_out))
+
+    def run_many(self, inputs, timeout=None):
+        """ Run a case for each of `inputs` and return the list of
+        `CaseResult`.
+        """
+        return [self.run(input, timeout) for input in inputs]
+
+    def _died_message(self):
+        returncode = self.process.poll()
+        return 'The fork server {} stopped (status {})'.format(self.path,
+                                                               returncode)
+
+    def _read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise ForkServerError(self._died_message())
+        return data
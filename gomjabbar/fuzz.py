@@ -0,0 +1,391 @@
+""" Fuzz a code model's parameters and inputs within its IFS constraints.
+
+`build_fuzzer` builds a code model into a fork server program (see
+`gomjabbar.forkserver`) whose cases carry parameter values and input port
+values. Each case sets the parameters of the already initialized instance,
+calls the entry point at DC with and without ``INIT`` and checks that all
+outputs and partials are finite. Crashes only kill the case's child, so one
+program evaluates thousands of cases per second::
+
+    with build_fuzzer('my_model') as fuzzer:
+        report = fuzzer.fuzz(10000, seed=0)
+    for failure in report.failures:
+        print(failure.kind, failure.minimized)
+
+Values are random, boundary and edge-case values which honor the
+``DATA_TYPE``, ``LIMITS``, ``VECTOR_BOUNDS`` and ``NULL_ALLOWED`` of each
+parameter. Failing cases are minimized to simpler cases which fail in the
+same way.
+"""
+import collections
+import contextlib
+import math
+import os.path as op
+import random
+import struct
+import sys
+import time
+
+from gomjabbar.const import C_FUNCTION_NAME
+from gomjabbar.forkserver import ForkServer
+from gomjabbar.generate import (
+    TEMPLATE_ENV, TEMPLATE_LOADER, _build_source, _get_template_context,
+    _harness_options, _render_harness
+)
+from gomjabbar.ifs.build import build_parameter_specs
+from gomjabbar.ifs.model import load_model
+
+#: A failing case: `kind` is ``'crash'``, ``'timeout'``, ``'non-finite'`` or
+#: ``'error'``
+FuzzFailure = collections.namedtuple(
+    'FuzzFailure', ['kind', 'returncode', 'case', 'minimized']
+)
+#: The outcome of `Fuzzer.fuzz`
+FuzzReport = collections.namedtuple(
+    'FuzzReport', ['num_cases', 'elapsed', 'failures']
+)
+#: The outcome of a single case
+CaseOutcome = collections.namedtuple(
+    'CaseOutcome', ['kind', 'returncode', 'outputs']
+)
+
+# The types of parameters which can be fuzzed
+FUZZABLE_TYPES = ('real', 'int', 'boolean', 'complex')
+# The size range of vector parameters without VECTOR_BOUNDS
+DEFAULT_VECTOR_SIZES = (1, 8)
+
+_NON_FINITE_STATUS = 3
+_BAD_CASE_STATUS = 4
+_INT_RANGE = (-2 ** 31, 2 ** 31 - 1)
+_MAGNITUDES = (1e-300, 1e-12, 1e-6, 1e-3, 1.0, 1e3, 1e6, 1e12, 1e300)
+# math.inf is Python 3 only
+_INFINITY = float('inf')
+
+
+@contextlib.contextmanager
+def build_fuzzer(code_model_dir, parameters=None, build_root=None,
+                 keep_failed=None, sources=None, timeout=None):
+    """ Build a code model into a `Fuzzer`.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model.
+    parameters : dict, optional
+        Values for PARAMETER_TABLE variables which are not fuzzed. String
+        and pointer parameters are never fuzzed.
+    build_root : str, optional
+        See `gomjabbar.generate.build_test`.
+    keep_failed : bool, optional
+        See `gomjabbar.generate.build_test`.
+    sources : list of str, optional
+        See `gomjabbar.generate.build_test`.
+    timeout : float, optional
+        The wall-clock budget of a case in seconds; a case which exceeds it
+        fails with the ``'timeout'`` kind.
+    """
+    parameters = parameters or {}
+    ast = load_model(op.join(code_model_dir, 'ifspec.ifs'))
+    specs = []
+    if ast.parameter_table:
+        specs = build_parameter_specs(ast.parameter_table)
+    for index, spec in enumerate(specs):
+        spec['index'] = index
+    fuzzed = [spec for spec in specs if spec['name'] not in parameters and
+              spec['type'] in FUZZABLE_TYPES]
+
+    # Fuzzed parameters get their values from each case
+    conns, params, num_vars = _get_template_context(code_model_dir, parameters,
+                                                    required=False)
+    template = TEMPLATE_ENV.get_template('fuzz.c.jinja')
+    harness = _render_harness(conns, params, num_vars,
+                              **_harness_options(code_model_dir))
+    source = harness + template.render({
+        'function': ast.name_table.row(C_FUNCTION_NAME).value,
+        'fuzzed': fuzzed,
+    }) + TEMPLATE_LOADER.get_source(TEMPLATE_ENV, 'forkserver.c')[0]
+
+    with _build_source(code_model_dir, source, build_root=build_root,
+                       keep_failed=keep_failed, sources=sources) as path:
+        with ForkServer(path, timeout=timeout) as server:
+            yield Fuzzer(server, fuzzed, conns)
+
+
+class Fuzzer(object):
+    """ Generates, runs and minimizes fuzz cases for a code model.
+
+    A case is a dictionary with a ``'parameters'`` dictionary, where None is
+    a null parameter and vector parameters are lists, and an ``'inputs'``
+    list of input port values in PORT_TABLE order.
+
+    Parameters
+    ----------
+    server : `gomjabbar.forkserver.ForkServer`
+        A running fork server built by `build_fuzzer`.
+    specs : list of dict
+        The fuzzed parameters, from
+        `gomjabbar.ifs.build.build_parameter_specs`.
+    connections : list of dict
+        The connections of the code model.
+    """
+    def __init__(self, server, specs, connections):
+        self.server = server
+        self.specs = specs
+        self.input_types = [
+            port['type'] for conn in connections if conn['is_input']
+            for port in conn['ports']
+        ]
+
+    def fuzz(self, num_cases, seed=None, max_failures=10, minimize=True):
+        """ Run `num_cases` random cases and return a `FuzzReport`.
+
+        Stops early once `max_failures` cases failed. If `minimize` is True,
+        each failing case is minimized.
+        """
+        rng = random.Random(seed)
+        failures = []
+        start = time.time()
+        count = 0
+        for count in range(1, num_cases + 1):
+            case = self.generate(rng)
+            outcome = self.run_case(case)
+            if outcome.kind == 'ok':
+                continue
+            minimized = self.minimize(case, outcome.kind) if minimize else None
+            failures.append(FuzzFailure(outcome.kind, outcome.returncode,
+                                        case, minimized))
+            if len(failures) >= max_failures:
+                break
+        return FuzzReport(count, time.time() - start, failures)
+
+    def generate(self, rng):
+        """ Return a random case, using the `random.Random` instance `rng`.
+        """
+        parameters = {}
+        for spec in self.specs:
+            if spec['null_allowed'] and rng.random() < 0.1:
+                parameters[spec['name']] = None
+            elif spec['is_array']:
+                low, high = _vector_sizes(spec)
+                size = rng.choice((low, high, rng.randint(low, high)))
+                parameters[spec['name']] = [_random_value(rng, spec)
+                                            for _ in range(size)]
+            else:
+                parameters[spec['name']] = _random_value(rng, spec)
+
+        inputs = []
+        for port_type in self.input_types:
+            if port_type == 'MIF_DIGITAL':
+                inputs.append(float(rng.randint(0, 2)))
+            else:
+                inputs.append(_random_real(rng, None, None))
+        return {'parameters': parameters, 'inputs': inputs}
+
+    def minimize(self, case, kind, max_runs=1000):
+        """ Return a simpler version of a failing `case` which still fails
+        with the same `kind`, running at most `max_runs` cases.
+        """
+        runs = 0
+        improved = True
+        while improved and runs < max_runs:
+            improved = False
+            for candidate in self._simplifications(case):
+                if runs >= max_runs:
+                    break
+                runs += 1
+                if self.run_case(candidate).kind == kind:
+                    case = candidate
+                    improved = True
+                    break
+        return case
+
+    def run_case(self, case):
+        """ Run a case and return its `CaseOutcome`.
+        """
+        result = self.server.run(self._encode(case))
+        num_outputs = len(result.output) // 8
+        outputs = struct.unpack('={}d'.format(num_outputs),
+                                result.output[:8 * num_outputs])
+        if result.returncode == 0:
+            kind = 'ok'
+        elif result.timed_out:
+            kind = 'timeout'
+        elif result.returncode < 0:
+            kind = 'crash'
+        elif result.returncode == _NON_FINITE_STATUS:
+            kind = 'non-finite'
+        elif result.returncode == _BAD_CASE_STATUS:
+            raise ValueError('The case does not match the fuzzed parameters '
+                             'and inputs: {!r}'.format(case))
+        else:
+            kind = 'error'
+        return CaseOutcome(kind, result.returncode, list(outputs))
+
+    def _encode(self, case):
+        values = []
+        for spec in self.specs:
+            value = case['parameters'][spec['name']]
+            if value is None:
+                elements = [] if spec['is_array'] else [spec['default'] or 0]
+                values += [1.0, len(elements)]
+            else:
+                elements = value if spec['is_array'] else [value]
+                values += [0.0, len(elements)]
+            for element in elements:
+                if spec['type'] == 'complex':
+                    element = complex(element)
+                    values += [element.real, element.imag]
+                else:
+                    values.append(float(element))
+        values += [float(v) for v in case['inputs']]
+        return struct.pack('={}d'.format(len(values)), *values)
+
+    def _simplifications(self, case):
+        """ Yield simpler variants of `case`, one change at a time.
+        """
+        parameters, inputs = case['parameters'], case['inputs']
+        for spec in self.specs:
+            name = spec['name']
+            value = parameters[name]
+            if value is None:
+                continue
+            if spec['null_allowed']:
+                yield _replace_parameter(case, name, None)
+            if not spec['is_array']:
+                for simpler in _simpler_values(value, spec):
+                    yield _replace_parameter(case, name, simpler)
+                continue
+            if len(value) > _vector_sizes(spec)[0]:
+                yield _replace_parameter(case, name, value[:-1])
+            for i, element in enumerate(value):
+                for simpler in _simpler_values(element, spec):
+                    elements = value[:i] + [simpler] + value[i + 1:]
+                    yield _replace_parameter(case, name, elements)
+
+        input_spec = {'type': 'real', 'limits': (None, None), 'default': 0.0}
+        for i, value in enumerate(inputs):
+            for simpler in _simpler_values(value, input_spec):
+                yield {'parameters': parameters,
+                       'inputs': inputs[:i] + [simpler] + inputs[i + 1:]}
+
+
+def _complexity(value):
+    if isinstance(value, complex):
+        return (value.imag != 0,) + _complexity(value.real)
+    return (value != 0, value != int(value) if _is_finite(value) else True,
+            abs(value))
+
+
+def _is_finite(value):
+    # math.isfinite is Python 3 only
+    return not (math.isinf(value) or math.isnan(value))
+
+
+def _random_int(rng, low, high):
+    low = _INT_RANGE[0] if low is None else max(int(math.ceil(low)),
+                                                _INT_RANGE[0])
+    high = _INT_RANGE[1] if high is None else min(int(math.floor(high)),
+                                                  _INT_RANGE[1])
+    edges = [v for v in (low, high, low + 1, high - 1, 0, 1, -1)
+             if low <= v <= high]
+    if rng.random() < 0.3 and edges:
+        return rng.choice(edges)
+    return rng.randint(low, high)
+
+
+def _random_real(rng, low, high):
+    edges = [0.0, 1.0, -1.0] + [m for m in _MAGNITUDES] + [-m for m in
+                                                          _MAGNITUDES]
+    if low is not None:
+        edges += [float(low), _next_after(low, _INFINITY)]
+    if high is not None:
+        edges += [float(high), _next_after(high, -_INFINITY)]
+    edges = [v for v in edges if _within(v, low, high)]
+
+    choice = rng.random()
+    if choice < 0.3 and edges:
+        return rng.choice(edges)
+    if low is not None and high is not None:
+        return rng.uniform(low, high)
+
+    magnitude = 10.0 ** rng.uniform(-300, 300)
+    if low is not None:
+        return low + magnitude
+    if high is not None:
+        return high - magnitude
+    return magnitude if choice < 0.65 else -magnitude
+
+
+def _random_value(rng, spec):
+    low, high = spec['limits']
+    if spec['type'] == 'boolean':
+        return rng.choice((False, True))
+    if spec['type'] == 'int':
+        return _random_int(rng, low, high)
+    if spec['type'] == 'complex':
+        return complex(_random_real(rng, None, None),
+                       _random_real(rng, None, None))
+    return _random_real(rng, low, high)
+
+
+def _replace_parameter(case, name, value):
+    parameters = dict(case['parameters'])
+    parameters[name] = value
+    return {'parameters': parameters, 'inputs': case['inputs']}
+
+
+def _next_after(value, direction):
+    if hasattr(math, 'nextafter'):
+        return math.nextafter(float(value), direction)
+    # Python < 3.9: a relative step of one ulp is close enough
+    step = abs(value) * sys.float_info.epsilon or sys.float_info.min
+    return value + step if direction > value else value - step
+
+
+def _simpler_values(value, spec):
+    """ Yield values which are simpler than `value` and honor `spec`.
+    """
+    if spec['type'] == 'boolean':
+        if value:
+            yield False
+        return
+    low, high = spec['limits']
+    if spec['type'] == 'complex':
+        candidates = [0j, complex(value.real, 0)]
+    else:
+        candidates = [0, spec['default'], 1, -1, low, high]
+        if _is_finite(value) and value != 0:
+            # A power of ten is simpler than any other value of its size
+            power = 10.0 ** math.floor(math.log10(abs(value)))
+            candidates += [math.copysign(power, value), round(value)]
+        # Shrink by large factors first so that huge values shrink quickly
+        candidates += [value / 1e100, value / 1e10, value / 10, value / 2]
+    seen = set()
+    for candidate in candidates:
+        if candidate is None or isinstance(candidate, (list, str)):
+            continue
+        if spec['type'] == 'int':
+            candidate = int(candidate)
+        elif spec['type'] == 'real':
+            candidate = float(candidate)
+        if candidate in seen or candidate == value:
+            continue
+        seen.add(candidate)
+        if (spec['type'] != 'complex' and
+                not _within(candidate, low, high)):
+            continue
+        if _complexity(candidate) < _complexity(value):
+            yield candidate
+
+
+def _vector_sizes(spec):
+    low, high = spec['bounds']
+    low = max(DEFAULT_VECTOR_SIZES[0], int(low or 0))
+    if high is None:
+        high = max(low, DEFAULT_VECTOR_SIZES[1])
+    return low, max(low, int(high))
+
+
+def _within(value, low, high):
+    return ((low is None or value >= low) and
+            (high is None or value <= high))
@@ -1,29 +1,105 @@
+import atexit
 import contextlib
+import glob
+import hashlib
+import io
 import os
 import os.path as op
-from subprocess import check_call
+import re
+import shutil
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen
 import sys
+import tempfile
+import threading
 import uuid
+import warnings
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import jinja2
 
+from gomjabbar.const import C_FUNCTION_NAME, SPICE_MODEL_NAME
 from gomjabbar.ifs.build import (
     build_connections_list, build_parameters_list, count_static_vars,
-    parse_file
+    validate_parameters
 )
+from gomjabbar.ifs.model import load_model
+from gomjabbar.util import file_lock, hash_files
 
 BIN_DIR = op.join(op.abspath(sys.prefix), 'bin')
 INCLUDE_DIR = op.join(op.abspath(sys.prefix), 'include')
 
+# Where test programs are built. See `get_build_root`.
+BUILD_ROOT_ENV_VAR = 'GOMJABBAR_BUILD_ROOT'
+# Set to a non-empty value to keep the workspaces of failed builds
+KEEP_FAILED_ENV_VAR = 'GOMJABBAR_KEEP_FAILED'
+# Set to '0' to compile without a precompiled header
+PCH_ENV_VAR = 'GOMJABBAR_PCH'
+# The ngspice header included by cmpp-generated sources, in order of preference
+PCH_HEADERS = ('ngspice/cm.h', 'cm.h')
+
 DATA_DIR = op.join(op.dirname(__file__), 'data')
 TEMPLATE_LOADER = jinja2.FileSystemLoader(DATA_DIR)
 TEMPLATE_ENV = jinja2.Environment(loader=TEMPLATE_LOADER, trim_blocks=True,
                                   keep_trailing_newline=True)
 TEMPLATE_ENV.filters['array_size'] = lambda v: max(1, len(v))
+TEMPLATE_ENV.filters['c_string'] = lambda v: _c_string(v)
+
+# Harnesses of models with more ports and parameter values than this are
+# generated as tables which a fixed loop interprets, rather than as unrolled
+# code, so that they compile in about the same time however wide the model.
+TABLE_HARNESS_THRESHOLD = 64
+# The C types of the tables of parameter values of table-driven harnesses
+_TABLE_VALUE_TYPES = [
+    ('rvalue', 'double'),
+    ('ivalue', 'int'),
+    ('bvalue', 'Mif_Boolean_t'),
+    ('cvalue', 'Mif_Complex_t'),
+    ('svalue', 'const char*'),
+]
+
+# The file name suffix of shared libraries built by `_compile_test`
+SHARED_LIBRARY_SUFFIX = '.dylib' if sys.platform == 'darwin' else '.so'
+# How unity builds name the functions and files of their snippets
+UNITY_FUNCTION_FORMAT = 'gj_unity_main_{}'
+UNITY_FILENAME_FORMAT = 'gj-snippet-{}'
+
+# Test code which needs state.c or instances.c in its harness, unless told
+# otherwise
+_STATE_PATTERN = re.compile(
+    r'\b(GJ_(SNAPSHOT|RESTORE|SAVE_STATE|LOAD_STATE)|gj_state_\w+)\b'
+)
+_INSTANCES_PATTERN = re.compile(
+    r'\b(GJ_\w*INSTANCES?|gj_(instances|arena)_\w+)\b'
+)
+# Model sources or test code which need runtime.c in the harness
+_RUNTIME_PATTERN = re.compile(
+    r'\b(GJ_(STEP|NUM_MESSAGES|MESSAGE|NUM_BREAKPOINTS|BREAKPOINT|'
+    r'NOT_CONVERGED|CLEAR_RECORDS)|gj_runtime_\w+|'
+    r'cm_(analog|event|message)_\w+)\b'
+)
+
+_PCH_FLAGS = {}
+_PCH_LOCK = threading.Lock()
+# Code generation flags of `_compile_cmd`, which a precompiled header must
+# share to be usable. Everything is compiled as PIC so that objects can go
+# into both test programs and shared libraries.
+_PCH_CC_FLAGS = ['-fPIC']
+
+_CLEANUP_QUEUE = queue.Queue()
+_CLEANUP_THREAD = None
+_CLEANUP_LOCK = threading.Lock()
 
 
 @contextlib.contextmanager
-def build_test(code_model_dir, code, parameters):
+def build_test(code_model_dir, code, parameters, build_root=None,
+               keep_failed=None, sources=None, state=None, instances=None):
     """ Build some code model source into a program which can be used to test
     part of a code model.
 
@@ -36,76 +112,477 @@ def build_test(code_model_dir, code, parameters):
     parameters : dict
         A dictionary of values which will be assigned to the PARAMETER_TABLE
         variables defined by the code model.
+    build_root : str, optional
+        The directory in which a workspace for the build is created. Defaults
+        to `get_build_root()`.
+    keep_failed : bool, optional
+        If True, the workspace is left in place when building fails or the
+        body of the ``with`` block raises. Defaults to the value of the
+        ``GOMJABBAR_KEEP_FAILED`` environment variable.
+    sources : list of str, optional
+        Additional source files of the code model. See `build_model_library`.
+    state : bool, optional
+        Whether the harness includes the snapshot functions (``GJ_SNAPSHOT``
+        and friends). By default they are included if `code` names them.
+    instances : bool, optional
+        Whether the harness includes the multi-instance functions
+        (``GJ_SETUP_INSTANCES`` and friends). By default they are included
+        if `code` names them.
+    """
+    source = _render_test(code_model_dir, code, parameters, state=state,
+                          instances=instances)
+    with _build_source(code_model_dir, source, build_root=build_root,
+                       keep_failed=keep_failed, sources=sources) as path:
+        yield path
+
+
+def build_model_library(code_model_dir, sources=None, jobs=None):
+    """ Compile the sources of a code model into a static library.
+
+    The library, ``lib<model>.a``, and its objects are kept in the build
+    root and reused by later calls. Only sources which changed since the
+    previous call (or whose ifspec.ifs or headers changed) are recompiled,
+    in parallel.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model.
+    sources : list of str, optional
+        Additional .mod and .c files of the code model, relative to
+        `code_model_dir`, which are compiled along with cfunc.mod. See
+        `discover_sources`.
+    jobs : int, optional
+        The number of sources which are compiled at once. Defaults to the
+        number of CPUs.
+
+    Returns the path of the library.
+    """
+    code_model_dir = op.abspath(code_model_dir)
+    sources = discover_sources(code_model_dir, sources or ())
+
+    dir_hash = hashlib.sha1(code_model_dir.encode('utf8')).hexdigest()[:16]
+    lib_dir = op.join(get_build_root(), 'lib', dir_hash)
+    if not op.isdir(lib_dir):
+        os.makedirs(lib_dir)
+    archive = op.join(lib_dir, 'lib{}.a'.format(_model_name(code_model_dir)))
+
+    with file_lock(op.join(lib_dir, 'lock')):
+        ifs_path = op.join(lib_dir, 'ifspec.ifs')
+        if not op.lexists(ifs_path):
+            _link_ifspec(code_model_dir, lib_dir)
+
+        pch_flags = _get_pch_flags()
+        common_stamp = hash_files(
+            [op.join(code_model_dir, 'ifspec.ifs')] +
+            sorted(glob.glob(op.join(code_model_dir, '*.h')))
+        ) + repr((_compiler(), pch_flags))
+
+        objects, stale = [], []
+        for source in sources:
+            obj_file = op.join(lib_dir, op.basename(source) + '.o')
+            stamp = hash_files([source]) + common_stamp
+            objects.append((obj_file, stamp))
+            if _read_file(obj_file + '.stamp') != stamp:
+                stale.append((source, obj_file, stamp))
+
+        if stale:
+            def compile_source(args):
+                _compile_model_source(code_model_dir, lib_dir, *args,
+                                      pch_flags=pch_flags)
+
+            pool = ThreadPool(min(len(stale), jobs or cpu_count()))
+            try:
+                pool.map(compile_source, stale)
+            finally:
+                pool.close()
+                pool.join()
+
+        archive_stamp = repr(objects)
+        if stale or _read_file(archive + '.stamp') != archive_stamp:
+            tmp_archive = '{}.{}.tmp'.format(archive, uuid.uuid4().hex[:8])
+            cmd = [os.environ.get('AR', 'ar'), 'rcs', tmp_archive]
+            _check_call(cmd + [obj for obj, _ in objects], cwd=lib_dir)
+            os.rename(tmp_archive, archive)
+            with open(archive + '.stamp', 'w') as fp:
+                fp.write(archive_stamp)
+
+    return archive
+
+
+@contextlib.contextmanager
+def build_unity_test(code_model_dir, snippets, parameters, build_root=None,
+                     keep_failed=None, sources=None, state=None,
+                     instances=None):
+    """ Build many test snippets for a code model into a single program.
+
+    Each snippet is a complete test source with its own ``main`` function,
+    as passed to `build_test`. The ``main`` of each snippet is renamed and
+    all snippets are compiled together with one copy of the harness, so the
+    whole batch costs one cmpp run and one compile. Snippets therefore must
+    not define conflicting file-scope names.
+
+    Yields the path of the program. Run a snippet by passing its name as the
+    first argument; the remaining arguments are passed to its ``main``.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model being tested.
+    snippets : dict
+        A mapping of snippet names to test source code.
+    parameters : dict
+        A dictionary of values which will be assigned to the PARAMETER_TABLE
+        variables defined by the code model.
+    build_root : str, optional
+        See `build_test`.
+    keep_failed : bool, optional
+        See `build_test`.
+    sources : list of str, optional
+        See `build_test`.
+    state : bool, optional
+        See `build_test`.
+    instances : bool, optional
+        See `build_test`.
+
+    Raises `UnityBuildError` if the program cannot be built. Its
+    `snippet_errors` attribute maps the names of the offending snippets to
+    their error messages.
     """
     conns, params, num_vars = _get_template_context(code_model_dir, parameters)
-    test_name = _generate_test_name()
-    output = op.join(code_model_dir, test_name + '.mod')
+    options = _harness_options(code_model_dir, snippets.values(),
+                               state=state, instances=instances)
+    harness = _render_harness(conns, params, num_vars, **options)
+    with _build_unity_source(code_model_dir, harness, snippets,
+                             build_root=build_root,
+                             keep_failed=keep_failed,
+                             sources=sources) as path:
+        yield path
+
+
+class UnityBuildError(CalledProcessError):
+    """ Raised when a unity build fails.
+
+    `snippet_errors` maps snippet names to the build messages which were
+    attributed to them.
+    """
+    def __init__(self, returncode, cmd, output=None, snippet_errors=None):
+        CalledProcessError.__init__(self, returncode, cmd, output=output)
+        self.snippet_errors = snippet_errors or {}
+
+    def __str__(self):
+        text = CalledProcessError.__str__(self)
+        for name, messages in sorted(self.snippet_errors.items()):
+            text += '\n{}:\n    {}'.format(name, '\n    '.join(messages))
+        return text
+
+
+def discover_sources(code_model_dir, sources=()):
+    """ Return the paths of the source files of a code model.
+
+    These are cfunc.mod, from which cmpp generates the code model function,
+    followed by the .mod and .c files in `sources`, relative to
+    `code_model_dir`. Other files in the directory, such as the .mod files
+    of tests which older versions wrote next to the model, are never picked
+    up.
+    """
+    names = []
+    if op.exists(op.join(code_model_dir, 'cfunc.mod')):
+        names.append('cfunc.mod')
+    names += [n for n in sources if n not in names]
+    return [op.join(code_model_dir, n) for n in names]
+
+
+def get_build_root(build_root=None):
+    """ Return the directory in which build workspaces are created.
+
+    Unless `build_root` is given, this is the ``GOMJABBAR_BUILD_ROOT``
+    environment variable, or ``/dev/shm`` when it is a writable tmpfs which
+    allows executables, or else the system temporary directory. A per-user
+    ``gomjabbar-<uid>`` subdirectory of it is used and created if needed.
+    """
+    if build_root is None:
+        build_root = os.environ.get(BUILD_ROOT_ENV_VAR)
+    if build_root is None:
+        build_root = tempfile.gettempdir()
+        if _is_usable_tmpfs('/dev/shm'):
+            build_root = '/dev/shm'
+
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    build_root = op.join(build_root, 'gomjabbar-{}'.format(uid))
+    if not op.isdir(build_root):
+        try:
+            os.makedirs(build_root)
+        except OSError:
+            if not op.isdir(build_root):
+                raise
+    return build_root
+
+
+@contextlib.contextmanager
+def _build_source(code_model_dir, source, build_root=None, keep_failed=None,
+                  sources=None, shared=False, link_flags=()):
+    """ Build a complete test .mod source into an executable (or a shared
+    library if `shared` is True) in a fresh workspace. `link_flags` are
+    passed to the linker command.
+
+    Yields the path of the result. The workspace is removed afterwards in
+    the background.
+    """
+    code_model_dir = op.abspath(code_model_dir)
+    with _test_workspace(code_model_dir, source, build_root,
+                         keep_failed) as path:
+        yield _compile_test(path, code_model_dir, sources=sources,
+                            shared=shared, link_flags=link_flags)
+
 
+@contextlib.contextmanager
+def _build_unity_source(code_model_dir, harness, snippets, **kwargs):
+    """ Build a unity program from a rendered harness and test snippets.
+
+    Build failures are raised as `UnityBuildError`.
+    """
+    names = sorted(snippets)
+    context = {'snippets': [
+        {
+            'name': name,
+            'code': snippets[name],
+            'function': UNITY_FUNCTION_FORMAT.format(i),
+            'filename': UNITY_FILENAME_FORMAT.format(i),
+        }
+        for i, name in enumerate(names)
+    ]}
+    source = harness + TEMPLATE_ENV.get_template('unity.c.jinja').render(
+        context
+    )
+
+    built = False
     try:
-        with open(output, 'w') as fp:
-            _render_templates(fp, conns, params, num_vars)
-            fp.write(code)
+        with _build_source(code_model_dir, source, **kwargs) as path:
+            built = True
+            yield path
+    except CalledProcessError as exc:
+        if built:
+            raise
+        errors = _map_unity_errors(exc.output, names, source)
+        raise UnityBuildError(exc.returncode, exc.cmd, output=exc.output,
+                              snippet_errors=errors)
 
-        yield _compile_test(output)
-    finally:
-        _clean_test(op.join(code_model_dir, test_name))
 
+def _build_pch(cc, header):
+    """ Build a precompiled header for `header` with the compiler `cc`.
+
+    Precompiled headers are cached in the build root per compiler profile:
+    the compiler, its version and the state of the ngspice headers. Returns
+    the flags which make a compile use it, or an empty list if it could not
+    be built.
+    """
+    try:
+        version = Popen([cc, '--version'], stdout=PIPE,
+                        stderr=STDOUT).communicate()[0]
+    except OSError:
+        return []
+    is_clang = b'clang' in version
+
+    header_dir = op.dirname(op.join(INCLUDE_DIR, header))
+    stamps = []
+    for name in sorted(os.listdir(header_dir)):
+        stat = os.stat(op.join(header_dir, name))
+        stamps.append((name, stat.st_mtime, stat.st_size))
+    profile = repr((cc, version, INCLUDE_DIR, header, stamps, _PCH_CC_FLAGS))
+    profile = hashlib.sha1(profile.encode('utf8')).hexdigest()[:16]
 
-def _clean_test(path):
-    """ Clean up after a call to _compile_test
+    pch_dir = op.join(get_build_root(), 'pch', profile)
+    pch_header = op.join(pch_dir, 'gj_pch.h')
+    if is_clang:
+        pch_file = pch_header + '.pch'
+        flags = ['-include-pch', pch_file]
+    else:
+        # GCC picks up gj_pch.h.gch when gj_pch.h is included
+        pch_file = pch_header + '.gch'
+        flags = ['-include', pch_header]
+    if op.exists(pch_file):
+        return flags
+
+    if not op.isdir(pch_dir):
+        os.makedirs(pch_dir)
+    with file_lock(pch_header + '.lock'):
+        if op.exists(pch_file):
+            return flags
+
+        with open(pch_header, 'w') as fp:
+            fp.write('#include "{}"\n'.format(header))
+        tmp_file = '{}.{}.tmp'.format(pch_file, uuid.uuid4().hex[:8])
+        cmd = [cc, '-x', 'c-header', '-o', tmp_file, pch_header,
+               '-I' + INCLUDE_DIR] + _PCH_CC_FLAGS
+        try:
+            _check_call(cmd, cwd=pch_dir)
+        except (CalledProcessError, OSError):
+            warnings.warn('Could not build a precompiled header for '
+                          '{} with {}'.format(header, cc))
+            return []
+        os.rename(tmp_file, pch_file)
+
+    return flags
+
+
+def _c_string(value):
+    """ Return `value` as a C string literal. Bytes other than printable
+    ASCII are escaped in octal, so any text survives as UTF-8.
     """
-    path = op.abspath(path)
-    remove_paths = [path + ext for ext in ('', '.c', '.o', '.mod')]
-    for path in remove_paths:
-        if op.exists(path):
-            os.remove(path)
+    chars = []
+    for byte in bytearray(value.encode('utf8')):
+        char = chr(byte)
+        if char in '\\"':
+            chars.append('\\' + char)
+        elif 32 <= byte < 127:
+            chars.append(char)
+        else:
+            chars.append('\\{:03o}'.format(byte))
+    return '"{}"'.format(''.join(chars))
 
 
-def _compile_test(path):
-    """ Build an executable for a code model test.
+def _check_call(cmd, cwd):
+    """ Run a build command.
 
-    Returns the path of the resulting executable.
+    Its output is passed on to stderr and is also available as the `output`
+    of the `CalledProcessError` which is raised if the command fails.
     """
-    def _compile_obj(p):
-        base_name = op.splitext(p)[0]
-        c_file = base_name + '.c'
-        obj_file = base_name + '.o'
-        cmd = ['cc', '-c', '-o', obj_file, c_file, '-I' + INCLUDE_DIR]
-        check_call(cmd)
-        return obj_file
+    proc = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=STDOUT)
+    output = proc.communicate()[0].decode('utf8', 'replace')
+    if output:
+        sys.stderr.write(output)
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd, output=output)
 
-    def _preprocess_mod(p):
-        cmd = [op.join(BIN_DIR, 'cmpp'), '-mod', p]
-        check_call(cmd)
 
-    code_dir, path = op.split(path)
-    module_path = op.splitext(path)[0]
-    code_dir = op.abspath(code_dir)
-    with _in_dir(code_dir):
-        # Preprocess the .mod file with cmpp
-        _preprocess_mod(path)
-        # Compile the resulting .c file
-        obj_file = _compile_obj(path)
+def _clean_workspace(path):
+    """ Remove a build workspace in a background thread.
+    """
+    global _CLEANUP_THREAD
+
+    with _CLEANUP_LOCK:
+        if _CLEANUP_THREAD is None:
+            _CLEANUP_THREAD = threading.Thread(target=_cleanup_worker)
+            _CLEANUP_THREAD.daemon = True
+            _CLEANUP_THREAD.start()
+            atexit.register(_finish_cleanup)
+    _CLEANUP_QUEUE.put(path)
+
 
-        # Make sure cfunc.o exists
-        cfunc_obj_file = 'cfunc.o'
-        if not op.exists(cfunc_obj_file):
-            _preprocess_mod('cfunc.mod')
-            cfunc_obj_file = _compile_obj('cfunc.c')
+def _cleanup_worker():
+    while True:
+        path = _CLEANUP_QUEUE.get()
+        if path is None:
+            break
+        shutil.rmtree(path, ignore_errors=True)
 
-        # Link the resulting .o file with cfunc.o into an executable
-        cmd = ['cc', '-o', module_path, cfunc_obj_file, obj_file]
-        check_call(cmd)
 
-    return op.join(code_dir, module_path)
+def _compile_cmd(c_file, obj_file, code_model_dir, extra_flags=()):
+    """ Return the command which compiles `c_file` into `obj_file`.
+    """
+    cmd = [_compiler(), '-c', '-o', obj_file, c_file, '-I' + code_model_dir,
+           '-I' + INCLUDE_DIR]
+    return cmd + _PCH_CC_FLAGS + list(extra_flags)
+
+
+def _compile_model_source(code_model_dir, lib_dir, source, obj_file, stamp,
+                          pch_flags):
+    """ Compile one source file of a code model into `lib_dir`.
+
+    .mod files are copied into `lib_dir` and preprocessed there, so nothing
+    is written to the code model directory.
+    """
+    extra_flags = []
+    c_file = source
+    if source.endswith('.mod'):
+        mod_file = op.basename(source)
+        shutil.copyfile(source, op.join(lib_dir, mod_file))
+        _check_call(_preprocess_cmd(mod_file), cwd=lib_dir)
+        c_file = op.join(lib_dir, op.splitext(mod_file)[0] + '.c')
+        extra_flags += pch_flags
+
+    cmd = _compile_cmd(c_file, obj_file, code_model_dir, extra_flags)
+    _check_call(cmd, cwd=lib_dir)
+    with open(obj_file + '.stamp', 'w') as fp:
+        fp.write(stamp)
+
+
+def _compile_test(path, code_model_dir, sources=None, shared=False,
+                  link_flags=()):
+    """ Build an executable (or a shared library if `shared` is True) for a
+    code model test.
+
+    `path` is a .mod file in a workspace created by `_make_workspace`.
+    Returns the path of the result.
+    """
+    workspace, mod_file = op.split(op.abspath(path))
+    module_path = op.splitext(mod_file)[0]
+
+    # Preprocess the .mod file with cmpp
+    _check_call(_preprocess_cmd(mod_file), cwd=workspace)
+    # Compile the resulting .c file
+    obj_file = module_path + '.o'
+    cmd = _compile_cmd(module_path + '.c', obj_file, code_model_dir,
+                       _get_pch_flags())
+    _check_call(cmd, cwd=workspace)
+
+    # Make sure the code model library is up to date
+    archive = build_model_library(code_model_dir, sources=sources)
+
+    # Link the resulting .o file with the code model into an executable
+    if shared:
+        module_path += SHARED_LIBRARY_SUFFIX
+    cmd = _link_cmd(module_path, [obj_file, archive], shared=shared,
+                    flags=link_flags)
+    _check_call(cmd, cwd=workspace)
+
+    return op.join(workspace, module_path)
+
+
+def _compiler():
+    """ Return the C compiler: the ``CC`` environment variable or ``cc``.
+    """
+    return os.environ.get('CC', 'cc')
+
+
+def _finish_cleanup():
+    _CLEANUP_QUEUE.put(None)
+    _CLEANUP_THREAD.join()
 
 
 def _generate_test_name():
     return '_' + uuid.uuid4().hex[:8]
 
 
-def _get_template_context(dir_path, parameters_dict):
-    ast = parse_file(op.join(dir_path, 'ifspec.ifs'))
+def _get_pch_flags():
+    """ Return the compiler flags which make a compile of a cmpp-generated
+    source use a precompiled ngspice header, building it if needed.
+
+    Returns an empty list when the ngspice headers cannot be found or the
+    ``GOMJABBAR_PCH`` environment variable is ``0``.
+    """
+    if os.environ.get(PCH_ENV_VAR) == '0':
+        return []
+    for header in PCH_HEADERS:
+        if op.exists(op.join(INCLUDE_DIR, header)):
+            break
+    else:
+        return []
+
+    cc = _compiler()
+    key = (cc, header, os.environ.get(BUILD_ROOT_ENV_VAR))
+    with _PCH_LOCK:
+        if key not in _PCH_FLAGS:
+            _PCH_FLAGS[key] = _build_pch(cc, header)
+        return _PCH_FLAGS[key]
+
+
+def _get_template_context(dir_path, parameters_dict, required=True):
+    ast = load_model(op.join(dir_path, 'ifspec.ifs'))
+    # Reject bad parameters before anything is generated or compiled
+    validate_parameters(ast.parameter_table, parameters_dict,
+                        required=required)
     connections, parameters = [], []
     num_static_vars = 0
     if ast.port_table:
@@ -118,17 +595,159 @@ def _get_template_context(dir_path, parameters_dict):
     return connections, parameters, num_static_vars
 
 
-@contextlib.contextmanager
-def _in_dir(path):
-    restore = op.abspath(op.curdir)
+def _harness_options(code_model_dir, codes=(), state=None, instances=None):
+    """ Return the keyword arguments of `_render_harness` for the test
+    `codes` of the code model in `code_model_dir`.
+
+    Unless `state` or `instances` is given, it is found out from the names
+    which `codes` use.
+    """
+    ast = load_model(op.join(code_model_dir, 'ifspec.ifs'))
+    codes = list(codes)
+    if state is None:
+        state = any(_STATE_PATTERN.search(code) for code in codes)
+    if instances is None:
+        instances = any(_INSTANCES_PATTERN.search(code) for code in codes)
+    runtime = (any(_RUNTIME_PATTERN.search(code) for code in codes) or
+               _uses_runtime(code_model_dir))
+    return {
+        'state': state,
+        'instances': instances,
+        'runtime': runtime,
+        'function': ast.name_table.row(C_FUNCTION_NAME).value,
+    }
+
+
+def _is_usable_tmpfs(path):
+    if not (op.isdir(path) and os.access(path, os.W_OK)):
+        return False
+    # Test programs are executed from the build root
+    noexec = getattr(os, 'ST_NOEXEC', 0)
+    return not (os.statvfs(path).f_flag & noexec)
+
+
+def _link_cmd(exe_path, obj_files, shared=False, flags=()):
+    """ Return the command which links `obj_files` into an executable, or
+    into a shared library if `shared` is True. `flags` are extra linker
+    flags.
+    """
+    flags = (['-shared'] if shared else []) + list(flags)
+    return [_compiler()] + flags + ['-o', exe_path] + list(obj_files)
+
+
+def _link_ifspec(code_model_dir, directory):
+    """ Make the code model's ifspec.ifs available in `directory`, which is
+    where cmpp looks for it.
+    """
+    ifs_path = op.join(code_model_dir, 'ifspec.ifs')
+    if hasattr(os, 'symlink'):
+        os.symlink(ifs_path, op.join(directory, 'ifspec.ifs'))
+    else:
+        shutil.copy(ifs_path, directory)
+
+
+def _make_workspace(code_model_dir, build_root=None):
+    """ Create a private directory for a single build under the build root.
+    """
+    workspace = tempfile.mkdtemp(prefix='build-',
+                                 dir=get_build_root(build_root))
+    _link_ifspec(code_model_dir, workspace)
+    return workspace
+
+
+def _map_unity_errors(output, names, source):
+    """ Attribute the lines of a failed unity build's output to snippets.
+
+    Compiler messages name the file given by the snippet's ``#line``
+    directive; cmpp messages give a line number in the .mod source.
+    """
+    line_ranges = []
+    directive = re.compile(r'#line 1 "{}"$'.format(
+        UNITY_FILENAME_FORMAT.format(r'(\d+)')
+    ))
+    source_lines = source.splitlines()
+    for lineno, line in enumerate(source_lines, 1):
+        match = directive.match(line)
+        if match:
+            end = source_lines.index('#undef main', lineno)
+            line_ranges.append((lineno + 1, end, int(match.group(1))))
+
+    filename = re.compile(UNITY_FILENAME_FORMAT.format(r'(\d+)') + ':')
+    mod_line = re.compile(r'line (\d+)')
+    errors = {}
+    for line in (output or '').splitlines():
+        index = None
+        match = filename.search(line)
+        if match:
+            index = int(match.group(1))
+        else:
+            match = mod_line.search(line)
+            if match:
+                lineno = int(match.group(1))
+                for start, end, i in line_ranges:
+                    if start <= lineno <= end:
+                        index = i
+                        break
+        if index is not None:
+            errors.setdefault(names[index], []).append(line.strip())
+    return errors
+
+
+def _model_name(code_model_dir):
+    """ Return the SPICE_MODEL_NAME of a code model, or else the name of its
+    directory.
+    """
+    ast = load_model(op.join(code_model_dir, 'ifspec.ifs'))
+    if ast.name_table is not None:
+        name = ast.name_table.row(SPICE_MODEL_NAME)
+        if name is not None:
+            return name.value
+    return op.basename(code_model_dir)
+
+
+def _preprocess_cmd(path):
+    """ Return the command which runs cmpp on a .mod file.
+    """
+    return [op.join(BIN_DIR, 'cmpp'), '-mod', path]
+
+
+def _read_file(path):
     try:
-        os.chdir(path)
-        yield
-    finally:
-        os.chdir(restore)
+        with open(path, 'r') as fp:
+            return fp.read()
+    except (IOError, OSError):
+        return None
+
 
+def _render_harness(connections, parameters, num_static_vars, state=False,
+                    instances=False, runtime=False, function=None):
+    """ Return the harness source which precedes the test code in a .mod file.
+
+    The snapshot functions (``GJ_SNAPSHOT`` and friends) are only included
+    with `state`, the multi-instance functions (``GJ_SETUP_INSTANCES`` and
+    friends) only with `instances`, and the services of ngspice (``GJ_STEP``
+    and friends) only with `runtime` or either of the others, so that other
+    tests compile less. With the services, calls of the C function named
+    `function` act on the runtime of the instance they evaluate.
+    """
+    fp = io.StringIO()
+    _render_templates(fp, connections, parameters, num_static_vars,
+                      state=state, instances=instances,
+                      runtime=runtime or state or instances, function=function)
+    return fp.getvalue()
+
+
+def _render_templates(fp, connections, parameters, num_static_vars,
+                      state=False, instances=False, runtime=False,
+                      function=None):
+    def write_file(name):
+        fp.write(TEMPLATE_LOADER.get_source(TEMPLATE_ENV, name)[0])
+
+    if instances:
+        write_file('arena.c')
+    if runtime:
+        write_file('runtime.c')
 
-def _render_templates(fp, connections, parameters, num_static_vars):
     template = TEMPLATE_ENV.get_template('alloc.c.jinja')
     context = {
         'num_conns': len(connections),
@@ -137,13 +756,107 @@ def _render_templates(fp, connections, parameters, num_static_vars):
     }
     fp.write(template.render(context))
 
-    template = TEMPLATE_ENV.get_template('connections.c.jinja')
-    context = {'connections': connections}
-    fp.write(template.render(context))
+    num_entries = sum(len(conn['ports']) for conn in connections)
+    num_entries += sum(len(param['values']) for param in parameters)
+    if num_entries > TABLE_HARNESS_THRESHOLD:
+        _render_tables(fp, connections, parameters)
+    else:
+        template = TEMPLATE_ENV.get_template('connections.c.jinja')
+        context = {'connections': connections}
+        fp.write(template.render(context))
+
+        template = TEMPLATE_ENV.get_template('params.c.jinja')
+        context = {'parameters': parameters}
+        fp.write(template.render(context))
+
+    if state:
+        write_file('state.c')
+    if instances:
+        write_file('instances.c')
+    write_file('macros.c')
+    if runtime and function is not None:
+        template = TEMPLATE_ENV.get_template('entry.c.jinja')
+        fp.write(template.render({'function': function}))
 
-    template = TEMPLATE_ENV.get_template('params.c.jinja')
-    context = {'parameters': parameters}
+
+def _render_tables(fp, connections, parameters):
+    """ Write the table-driven versions of init_connections and init_params.
+    """
+    conns, port_types = [], []
+    for conn in connections:
+        conns.append(dict(conn, first_port=len(port_types)))
+        port_types.extend(port['type'] for port in conn['ports'])
+
+    params = []
+    values = {member: [] for member, _ in _TABLE_VALUE_TYPES}
+    for index, param in enumerate(parameters):
+        member = param['unionmember']
+        offset = 0
+        if member in values:
+            offset = len(values[member])
+            values[member].extend(param['values'])
+        params.append(dict(param, index=index, member='GJ_' + member.upper(),
+                           offset=offset))
+
+    template = TEMPLATE_ENV.get_template('tables.c.jinja')
+    context = {
+        'connections': conns,
+        'port_types': port_types,
+        'parameters': params,
+        'value_types': _TABLE_VALUE_TYPES,
+        'values': values,
+    }
     fp.write(template.render(context))
 
-    macros_source = TEMPLATE_LOADER.get_source(TEMPLATE_ENV, 'macros.c')[0]
-    fp.write(macros_source)
+
+def _render_test(code_model_dir, code, parameters, state=None,
+                 instances=None):
+    """ Return the .mod source of a test: its harness followed by `code`.
+    """
+    conns, params, num_vars = _get_template_context(code_model_dir, parameters)
+    options = _harness_options(code_model_dir, [code], state=state,
+                               instances=instances)
+    return _render_harness(conns, params, num_vars, **options) + code
+
+
+@contextlib.contextmanager
+def _test_workspace(code_model_dir, source, build_root=None, keep_failed=None):
+    """ Write a test .mod source into a fresh workspace and yield its path.
+
+    The workspace is removed afterwards in the background, unless the body
+    raised and `keep_failed` (or ``GOMJABBAR_KEEP_FAILED``) is set.
+    """
+    if keep_failed is None:
+        keep_failed = bool(os.environ.get(KEEP_FAILED_ENV_VAR))
+    workspace = _make_workspace(code_model_dir, build_root)
+    output = op.join(workspace, _generate_test_name() + '.mod')
+
+    succeeded = False
+    try:
+        with open(output, 'w') as fp:
+            fp.write(source)
+
+        yield output
+        succeeded = True
+    finally:
+        if succeeded or not keep_failed:
+            _clean_workspace(workspace)
+        else:
+            warnings.warn('Keeping failed build in {}'.format(workspace))
+
+
+def _uses_runtime(code_model_dir):
+    """ Return whether the sources of a code model call the services which
+    runtime.c implements.
+    """
+    # The sources given to a build are not known here, so every source in
+    # the directory is looked at. A false positive only costs compiling
+    # runtime.c into the harness.
+    for name in sorted(os.listdir(code_model_dir)):
+        if op.splitext(name)[1] not in ('.c', '.h', '.mod'):
+            continue
+        with io.open(op.join(code_model_dir, name), encoding='utf8',
+                     errors='replace') as fp:
+            if _RUNTIME_PATTERN.search(fp.read()):
+                return True
+    return False
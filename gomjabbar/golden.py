@@ -0,0 +1,160 @@
+""" Golden-output regression testing of code models.
+
+`check_golden` compares a dictionary of named outputs (scalars, waveforms,
+partials, ...) with a baseline stored in a compressed ``.npz`` file in a
+``golden`` directory beside the code model's ``ifspec.ifs``. The first run
+creates the baseline; later runs compare every value at once with absolute
+and relative tolerances and report a compact summary of the differences::
+
+    with build_library(code_model_dir, parameters) as model:
+        outputs, partials = model.evaluate_partials(inputs)
+    check_golden(code_model_dir, 'dc_sweep',
+                 {'outputs': outputs, 'partials': partials})
+
+Set the ``GOMJABBAR_UPDATE_GOLDEN`` environment variable to a non-empty
+value to rewrite baselines instead of comparing with them.
+
+Requires NumPy.
+"""
+import os
+import os.path as op
+import uuid
+
+import numpy as np
+
+#: The directory beside ifspec.ifs where baselines are stored
+GOLDEN_DIR = 'golden'
+# Set to a non-empty value to rewrite baselines instead of comparing
+UPDATE_ENV_VAR = 'GOMJABBAR_UPDATE_GOLDEN'
+
+
+class GoldenMismatchError(AssertionError):
+    """ Raised by `check_golden` when outputs differ from their baseline.
+
+    `differences` is the list of messages which make up the summary.
+    """
+    def __init__(self, path, differences):
+        self.path = path
+        self.differences = differences
+        msg = 'Outputs differ from the baseline {}:\n    {}'
+        AssertionError.__init__(self, msg.format(path,
+                                                 '\n    '.join(differences)))
+
+
+def check_golden(code_model_dir, name, outputs, rtol=1e-7, atol=1e-12,
+                 update=None):
+    """ Compare outputs with their baseline, creating it if needed.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model.
+    name : str
+        The name of the baseline, e.g. the name of the test.
+    outputs : dict
+        A mapping of names to array_like outputs.
+    rtol, atol : float
+        The relative and absolute tolerances, as in `numpy.isclose`.
+    update : bool, optional
+        If True, (re)write the baseline from `outputs`. Defaults to the
+        value of the ``GOMJABBAR_UPDATE_GOLDEN`` environment variable.
+
+    Returns True if the baseline was written and False if the outputs were
+    compared with it. Raises `GoldenMismatchError` if they differ.
+    """
+    if update is None:
+        update = bool(os.environ.get(UPDATE_ENV_VAR))
+    path = golden_path(code_model_dir, name)
+    outputs = {key: np.asarray(value) for key, value in outputs.items()}
+
+    if update or not op.exists(path):
+        _save_baseline(path, outputs)
+        return True
+
+    with np.load(path, allow_pickle=False) as baseline:
+        expected = {key: baseline[key] for key in baseline.files}
+    differences = compare_outputs(expected, outputs, rtol=rtol, atol=atol)
+    if differences:
+        raise GoldenMismatchError(path, differences)
+    return False
+
+
+def compare_outputs(expected, actual, rtol=1e-7, atol=1e-12):
+    """ Compare two dictionaries of arrays.
+
+    Returns a list of messages describing the differences, which is empty
+    if all arrays have the same names and shapes and are close. NaNs
+    compare equal to NaNs.
+    """
+    differences = []
+    for key in sorted(set(expected) - set(actual)):
+        differences.append('{}: missing'.format(key))
+    for key in sorted(set(actual) - set(expected)):
+        differences.append('{}: not in the baseline'.format(key))
+
+    for key in sorted(set(expected) & set(actual)):
+        old, new = np.asarray(expected[key]), np.asarray(actual[key])
+        if old.shape != new.shape:
+            msg = '{}: shape {} differs from {}'
+            differences.append(msg.format(key, new.shape, old.shape))
+            continue
+        if old.dtype.kind not in 'biufc' or new.dtype.kind not in 'biufc':
+            if not np.array_equal(old, new):
+                differences.append('{}: values differ'.format(key))
+            continue
+        if old.dtype.kind == 'b' or new.dtype.kind == 'b':
+            # Booleans are exact and have no subtraction
+            close = ~np.logical_xor(old, new)
+            if not close.all():
+                differences.append(_summarize_exact(key, old, new, close))
+            continue
+
+        # Unsigned differences would wrap around
+        if old.dtype.kind in 'iu':
+            old = old.astype(np.float64)
+        if new.dtype.kind in 'iu':
+            new = new.astype(np.float64)
+        close = np.isclose(new, old, rtol=rtol, atol=atol, equal_nan=True)
+        if close.all():
+            continue
+        differences.append(_summarize(key, old, new, close))
+    return differences
+
+
+def golden_path(code_model_dir, name):
+    """ Return the path of the baseline `name` of a code model.
+    """
+    return op.join(code_model_dir, GOLDEN_DIR, name + '.npz')
+
+
+def _save_baseline(path, outputs):
+    directory = op.dirname(path)
+    if not op.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
+    with open(tmp_path, 'wb') as fp:
+        np.savez_compressed(fp, **outputs)
+    os.rename(tmp_path, path)
+
+
+def _summarize(key, old, new, close):
+    num_bad = np.count_nonzero(~close)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        abs_err = np.where(close, 0, np.abs(new - old))
+        rel_err = abs_err / np.abs(old)
+    abs_err = np.nan_to_num(abs_err, nan=np.inf)
+    worst = np.unravel_index(np.argmax(abs_err), old.shape)
+    where = '[{}]'.format(', '.join(str(i) for i in worst)) if worst else ''
+    msg = ('{}: {} of {} values differ; worst at {}{}: expected {!r}, got '
+           '{!r} (abs {:.3g}, rel {:.3g})')
+    return msg.format(key, num_bad, close.size, key, where, old[worst].item(),
+                      new[worst].item(), abs_err[worst], rel_err[worst])
+
+
+def _summarize_exact(key, old, new, close):
+    num_bad = np.count_nonzero(~close)
+    first = np.unravel_index(np.argmin(close), old.shape)
+    where = '[{}]'.format(', '.join(str(i) for i in first)) if first else ''
+    msg = '{}: {} of {} values differ; first at {}{}: expected {!r}, got {!r}'
+    return msg.format(key, num_bad, close.size, key, where, old[first].item(),
+                      new[first].item())
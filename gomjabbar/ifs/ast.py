@@ -1,5 +1,12 @@
+try:
+    from sys import intern
+except ImportError:  # Python 2
+    pass
+
 
 class AstNode(object):
+    __slots__ = ()
+
     def get_children(self):
         return ()
 
@@ -9,8 +16,10 @@ class AstNode(object):
 
 
 class CType(AstNode):
+    __slots__ = ('value', 'lineno')
+
     def __init__(self, value, lineno=None):
-        self.value = value
+        self.value = intern(value)
         self.lineno = lineno
 
     def __repr__(self):
@@ -18,6 +27,8 @@ class CType(AstNode):
 
 
 class Dash(AstNode):
+    __slots__ = ('lineno',)
+
     def __init__(self, lineno=None):
         self.lineno = lineno
 
@@ -26,8 +37,10 @@ class Dash(AstNode):
 
 
 class Direction(AstNode):
+    __slots__ = ('value', 'lineno')
+
     def __init__(self, value, lineno=None):
-        self.value = value
+        self.value = intern(value)
         self.lineno = lineno
 
     def __repr__(self):
@@ -35,8 +48,10 @@ class Direction(AstNode):
 
 
 class DType(AstNode):
+    __slots__ = ('value', 'lineno')
+
     def __init__(self, value, lineno=None):
-        self.value = value
+        self.value = intern(value)
         self.lineno = lineno
 
     def __repr__(self):
@@ -44,8 +59,10 @@ class DType(AstNode):
 
 
 class Identifier(AstNode):
+    __slots__ = ('value', 'lineno')
+
     def __init__(self, value, lineno=None):
-        self.value = value
+        self.value = intern(value)
         self.lineno = lineno
 
     def __repr__(self):
@@ -53,6 +70,9 @@ class Identifier(AstNode):
 
 
 class Ifs(AstNode):
+    __slots__ = ('nodes', 'name_table', 'parameter_table', 'port_table',
+                 'static_var_table', 'lineno')
+
     def __init__(self, nodes, name_table=None, parameter_table=None,
                  port_table=None, static_var_table=None):
         self.nodes = nodes
@@ -73,6 +93,8 @@ class Ifs(AstNode):
 
 
 class Range(AstNode):
+    __slots__ = ('low', 'high', 'lineno')
+
     def __init__(self, low=None, high=None, lineno=None):
         self.low = Dash(lineno=lineno) if low is None else low
         self.high = Dash(lineno=lineno) if high is None else high
@@ -83,13 +105,47 @@ class Range(AstNode):
 
 
 class Table(AstNode):
+    """ A table from an .ifs file.
+
+    Each `TableRow` holds one value per column, so the rows can be looked up
+    by type with `row` and a single column can be viewed with `column`
+    without transposing the whole table.
+    """
+    __slots__ = ('type', 'nodes', 'lineno', '_rows')
+
     def __init__(self, type_, nodes, lineno=None):
         self.type = type_
         self.nodes = nodes
         self.lineno = lineno
+        self._rows = {row.type: row for row in (nodes or ())}
 
     def get_children(self):
-        return self.nodes
+        return self.nodes or ()
+
+    def column(self, index):
+        """ Return a view of the column at `index`.
+        """
+        return Column(self, index)
+
+    def columns(self):
+        """ Iterate over views of all of the columns of the table.
+        """
+        for i in range(self.num_columns):
+            yield Column(self, i)
+
+    @property
+    def num_columns(self):
+        if not self.nodes:
+            return 0
+        return len(self.nodes[0].value)
+
+    def row(self, type_, default=None):
+        """ Return the list of values of the row named `type_`.
+        """
+        row = self._rows.get(type_)
+        if row is None:
+            return default
+        return row.value
 
     def __repr__(self):
         nodes = '\n'.join('\t{!r}'.format(n) for n in self)
@@ -99,6 +155,8 @@ class Table(AstNode):
 
 
 class TableRow(AstNode):
+    __slots__ = ('type', 'value', 'lineno')
+
     def __init__(self, type_, value, lineno=None):
         self.type = type_
         self.value = value
@@ -106,3 +164,27 @@ class TableRow(AstNode):
 
     def __repr__(self):
         return '{}({!r})'.format(self.type, self.value)
+
+
+class Column(object):
+    """ A read-only view of a single column of a `Table`.
+
+    Row values are available as attributes named after the row type, e.g.
+    ``column.PORT_NAME``.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getattr__(self, name):
+        if name in Column.__slots__:
+            raise AttributeError(name)
+        row = self.table._rows.get(name)
+        if row is None:
+            raise AttributeError(name)
+        return row.value[self.index]
+
+    def __repr__(self):
+        return 'Column({}, {})'.format(self.table.type, self.index)
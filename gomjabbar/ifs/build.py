@@ -1,12 +1,15 @@
 from __future__ import print_function
 
+import math
+import numbers
+
 from gomjabbar.const import (
     NAME_TABLE, PARAMETER_TABLE, PORT_TABLE, STATIC_VAR_TABLE,
     ALLOWED_TYPES, ARRAY, ARRAY_BOUNDS, DATA_TYPE, DEFAULT_TYPE, DEFAULT_VALUE,
     DESCRIPTION, DIRECTION, LIMITS, NULL_ALLOWED, PARAMETER_NAME, PORT_NAME,
     STATIC_VAR_NAME
 )
-from .ast import Dash, Ifs, Table, TableRow
+from .ast import Dash, Identifier, Ifs, Range, Table, TableRow
 from .lexer import IfsLexer
 from .parser import IfsParser
 
@@ -22,20 +25,31 @@ PORT_TYPES = {
     'hd': 'MIF_DIFF_RESISTANCE',
     'd': 'MIF_DIGITAL',
 }
+# Each data type maps to a function which converts a value to a C expression
+# (except strings, which the templates quote with the c_string filter) and to
+# the member of Mif_Value_t which holds it
 VALUE_UNION_NAMES = {
-    'boolean': (bool, 'bvalue'),
+    'boolean': (lambda x: 'MIF_TRUE' if x else 'MIF_FALSE', 'bvalue'),
     'int': (int, 'ivalue'),
-    'real': (float, 'rvalue'),
-    'complex': (lambda x: x, 'cvalue'),
-    'string': (lambda x: '"{}"'.format(x), 'svalue'),
+    'real': (lambda x: _c_real(x), 'rvalue'),
+    'complex': (lambda x: '{{{}, {}}}'.format(
+        _c_real(complex(x).real), _c_real(complex(x).imag)), 'cvalue'),
+    'string': (lambda x: x, 'svalue'),
     'pointer': (lambda x: x, 'pvalue'),
 }
+_STRING_TYPES = (str, type(u''))
+
 
+class ParameterError(ValueError):
+    """ Raised by `validate_parameters` when parameter values do not match
+    the PARAMETER_TABLE.
 
-class _Namespace(object):
-    def __init__(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+    `errors` is the list of messages, one for each problem found.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        ValueError.__init__(self, 'Invalid parameters:\n    {}'.format(
+            '\n    '.join(errors)))
 
 
 def build_connections_list(port_table):
@@ -43,13 +57,15 @@ def build_connections_list(port_table):
     connections code template.
     """
     connections = []
-    for item in transpose_table(port_table):
+    columns = zip(port_table.row(PORT_NAME), port_table.row(DIRECTION),
+                  port_table.row(DEFAULT_TYPE))
+    for name, direction, default_type in columns:
         conn = {
-            'name': item.PORT_NAME.value,
-            'is_input': item.DIRECTION.value in ('in', 'inout'),
-            'is_output': item.DIRECTION.value in ('out', 'inout'),
+            'name': name.value,
+            'is_input': direction.value in ('in', 'inout'),
+            'is_output': direction.value in ('out', 'inout'),
             'ports': [
-                {'type': PORT_TYPES.get(item.DEFAULT_TYPE.value,
+                {'type': PORT_TYPES.get(default_type.value,
                                         'MIF_USER_DEFINED')}
             ],
         }
@@ -62,15 +78,19 @@ def build_parameters_list(parameter_table, parameter_values):
     the params code template.
     """
     parameters = []
-    for item in transpose_table(parameter_table):
-        param_name = item.PARAMETER_NAME.value
-        cast, unionmember = VALUE_UNION_NAMES[item.DATA_TYPE.value]
+    columns = zip(parameter_table.row(PARAMETER_NAME),
+                  parameter_table.row(DATA_TYPE),
+                  parameter_table.row(DEFAULT_VALUE))
+    for name, data_type, default_value in columns:
+        param_name = name.value
+        cast, unionmember = VALUE_UNION_NAMES[data_type.value]
         param = {
             'name': param_name,
             'unionmember': unionmember,
+            'values': [],
         }
-        value = parameter_values.get(param_name, item.DEFAULT_VALUE)
-        if not isinstance(value, Dash):
+        value = parameter_values.get(param_name, default_value)
+        if not isinstance(value, Dash) and value is not None:
             if isinstance(value, list):
                 value = [cast(v) for v in value]
             else:
@@ -80,6 +100,34 @@ def build_parameters_list(parameter_table, parameter_values):
     return parameters
 
 
+def build_parameter_specs(parameter_table):
+    """ Convert the PARAMETER_TABLE items into a list of dictionaries which
+    describe the constraints on each parameter's values.
+
+    Missing limits and bounds are None.
+    """
+    specs = []
+    columns = zip(parameter_table.row(PARAMETER_NAME),
+                  parameter_table.row(DATA_TYPE),
+                  parameter_table.row(DEFAULT_VALUE),
+                  parameter_table.row(LIMITS),
+                  parameter_table.row(ARRAY),
+                  parameter_table.row(ARRAY_BOUNDS),
+                  parameter_table.row(NULL_ALLOWED))
+    for name, data_type, default, limits, array, bounds, null in columns:
+        spec = {
+            'name': name.value,
+            'type': data_type.value,
+            'default': None if isinstance(default, Dash) else default,
+            'limits': _range_values(limits),
+            'is_array': bool(array),
+            'bounds': _range_values(bounds) if array else (None, None),
+            'null_allowed': bool(null),
+        }
+        specs.append(spec)
+    return specs
+
+
 def compact_ast(ifs_ast):
     """ Group all tables in an `Ifs` object by their type.
 
@@ -128,7 +176,7 @@ def compact_tables(table_type, tables, expected_row_names):
 
         for typename in expected_rows:
             value = [None] * col_count
-            rows.setdefault(row.type, []).extend(value)
+            rows.setdefault(typename, []).extend(value)
 
     return Table(table_type, [TableRow(k, v) for k, v in rows.items()])
 
@@ -165,11 +213,135 @@ def tokenize_file(path):
 def transpose_table(table):
     """ Convert a `Table` to a list of objects which represent the "columns".
     """
-    items = [{} for _ in range(len(table.nodes[0].value))]
-    for row in table:
-        for i, value in enumerate(row.value):
-            items[i][row.type] = value
-    return [_Namespace(**d) for d in items]
+    return list(table.columns())
+
+
+def validate_parameters(parameter_table, parameter_values, required=True):
+    """ Check parameter values against the PARAMETER_TABLE.
+
+    Parameters
+    ----------
+    parameter_table : Table or None
+        The PARAMETER_TABLE of a code model.
+    parameter_values : dict
+        The values given for the parameters. None stands for a null value.
+    required : bool
+        If False, parameters which have no default value may be missing.
+
+    Raises `ParameterError` listing every unknown name, value of the wrong
+    type, value outside of the limits, vector outside of its bounds and
+    missing required value.
+    """
+    specs = {}
+    if parameter_table is not None:
+        specs = {spec['name']: spec
+                 for spec in build_parameter_specs(parameter_table)}
+
+    errors = ['{}: unknown parameter'.format(name)
+              for name in sorted(set(parameter_values) - set(specs))]
+    for name, spec in sorted(specs.items()):
+        if name not in parameter_values:
+            if required and spec['default'] is None and \
+                    not spec['null_allowed']:
+                errors.append('{}: a value is required'.format(name))
+            continue
+        errors.extend(_check_parameter(spec, parameter_values[name]))
+
+    if errors:
+        raise ParameterError(errors)
+
+
+def _bound_text(value):
+    return '-' if value is None else value
+
+
+def _c_real(value):
+    """ Return a C expression for a real `value`, using the <math.h> macros
+    for infinities and NaN.
+    """
+    value = float(value)
+    if math.isnan(value):
+        return 'NAN'
+    if math.isinf(value):
+        return 'HUGE_VAL' if value > 0 else '-HUGE_VAL'
+    return repr(value)
+
+
+def _check_parameter(spec, value):
+    name = spec['name']
+    if value is None:
+        if spec['null_allowed']:
+            return []
+        return ['{}: may not be null'.format(name)]
+
+    if isinstance(value, (list, tuple)):
+        if not spec['is_array']:
+            return ['{}: expected a single value, got a list'.format(name)]
+        values = value
+    else:
+        # The harness passes a single value to a vector parameter as a
+        # vector of one
+        values = [value]
+    if spec['is_array']:
+        low, high = spec['bounds']
+        if (low is not None and len(values) < low or
+                high is not None and len(values) > high):
+            msg = '{}: got {} values, outside of the vector bounds [{} {}]'
+            return [msg.format(name, len(values), _bound_text(low),
+                               _bound_text(high))]
+
+    check = _VALUE_CHECKS.get(spec['type'])
+    if check is None:
+        return []
+    low, high = (None, None)
+    if spec['type'] in ('int', 'real'):
+        low, high = spec['limits']
+    errors = []
+    for element in values:
+        if not check(element):
+            msg = '{}: {!r} is not a valid {} value'
+            errors.append(msg.format(name, element, spec['type']))
+        elif (low is not None and element < low or
+                high is not None and element > high):
+            msg = '{}: {!r} is outside of the limits [{} {}]'
+            errors.append(msg.format(name, element, _bound_text(low),
+                                     _bound_text(high)))
+    return errors
+
+
+def _is_int(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, numbers.Integral):
+        return True
+    return isinstance(value, float) and value.is_integer()
+
+
+def _is_number(value, kind):
+    return isinstance(value, kind) and not isinstance(value, bool)
+
+
+def _range_values(value):
+    """ Return the (low, high) of a `Range`, with None for unbounded ends.
+    Bounds which name a port (and so are only known at runtime) are
+    unbounded.
+    """
+    if not isinstance(value, Range):
+        return None, None
+    return tuple(
+        None if v is None or isinstance(v, (Dash, Identifier)) else v
+        for v in (value.low, value.high)
+    )
+
+
+# Type checks of single parameter values. Limits only apply to int and real.
+_VALUE_CHECKS = {
+    'boolean': lambda x: isinstance(x, bool) or x in (0, 1),
+    'int': _is_int,
+    'real': lambda x: _is_number(x, numbers.Real),
+    'complex': lambda x: _is_number(x, numbers.Complex),
+    'string': lambda x: isinstance(x, _STRING_TYPES),
+}
 
 
 if __name__ == '__main__':
@@ -178,9 +350,13 @@ if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     argparser.add_argument('-l', '--lex', type=str, default='')
     argparser.add_argument('-p', '--parse', type=str, default='')
+    argparser.add_argument('-e', '--export', type=str, default='')
     args = argparser.parse_args()
 
     if args.lex:
         tokenize_file(args.lex)
     elif args.parse:
         print(parse_file(args.parse))
+    elif args.export:
+        from .model import export_model
+        export_model(args.export)
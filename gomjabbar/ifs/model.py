@@ -0,0 +1,198 @@
+""" A compiled, serialized form of a parsed .ifs file.
+
+A model descriptor holds the compacted `Ifs` AST of an .ifs file along with
+a hash of the source it was built from. Loading a descriptor rebuilds the AST
+without running the lexer or the parser, which makes it cheap for short-lived
+processes to learn the port and parameter layout of a code model.
+"""
+import hashlib
+import json
+import os
+import os.path as op
+import uuid
+import zlib
+
+from .ast import (
+    CType, Dash, Direction, DType, Identifier, Ifs, Range, Table, TableRow
+)
+
+FORMAT_NAME = 'gomjabbar-ifs'
+FORMAT_VERSION = 1
+DESCRIPTOR_SUFFIX = '.gjm'
+
+_NODE_TAGS = {
+    CType: 'C',
+    Direction: 'D',
+    DType: 'T',
+    Identifier: 'I',
+}
+_TAG_NODES = {tag: cls for cls, tag in _NODE_TAGS.items()}
+
+# Models which have already been loaded by this process, keyed by the path
+# and content hash of their .ifs file.
+_LOADED_MODELS = {}
+
+
+class StaleModelError(ValueError):
+    """ Raised when a model descriptor does not match its .ifs source.
+    """
+
+
+def descriptor_path(ifs_path):
+    """ Return the path of the model descriptor which belongs to `ifs_path`.
+    """
+    return ifs_path + DESCRIPTOR_SUFFIX
+
+
+def dump_model(ifs_ast, source_hash):
+    """ Serialize a compacted `Ifs` object to bytes.
+    """
+    tables = []
+    for table in ifs_ast:
+        rows = [[row.type, _encode_value(row.value)] for row in table]
+        tables.append([table.type, rows])
+
+    data = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'source_hash': source_hash,
+        'tables': tables,
+    }
+    text = json.dumps(data, separators=(',', ':'), sort_keys=True)
+    return zlib.compress(text.encode('utf8'))
+
+
+def export_model(ifs_path, ifs_ast=None):
+    """ Write the model descriptor for the .ifs file at `ifs_path`.
+
+    If `ifs_ast` is not given, the file is parsed. Returns the AST.
+    """
+    source_hash = hash_source(ifs_path)
+    if ifs_ast is None:
+        from .build import parse_file
+        ifs_ast = parse_file(ifs_path)
+
+    _atomic_write(descriptor_path(ifs_path), dump_model(ifs_ast, source_hash))
+    return ifs_ast
+
+
+def hash_source(ifs_path):
+    """ Compute the content hash which identifies an .ifs source file.
+    """
+    with open(ifs_path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def import_model(ifs_path, source_hash=None):
+    """ Read the model descriptor for `ifs_path` and return its `Ifs` AST.
+
+    Raises `StaleModelError` if the descriptor was built from a different
+    version of the .ifs file, or was written by an incompatible version of
+    gomjabbar.
+    """
+    if source_hash is None:
+        source_hash = hash_source(ifs_path)
+    with open(descriptor_path(ifs_path), 'rb') as fp:
+        return load_model_bytes(fp.read(), source_hash=source_hash)
+
+
+def load_model(ifs_path, update=False):
+    """ Return the compacted `Ifs` AST for `ifs_path`, preferring its model
+    descriptor when it is up to date.
+
+    When the descriptor is missing or stale the .ifs file is parsed and, only
+    if `update` is True, a fresh descriptor is written next to it. Failure to
+    write the descriptor (e.g. a read-only source tree) is not an error. By
+    default nothing is written to the source tree; descriptors are written by
+    `export_model` or ``gomjabbar index``.
+    Models are also kept in memory, so loading an unchanged file a second
+    time only costs a hash of its contents. The returned AST must therefore
+    not be modified.
+    """
+    source_hash = hash_source(ifs_path)
+    key = (op.abspath(ifs_path), source_hash)
+    if key in _LOADED_MODELS:
+        return _LOADED_MODELS[key]
+
+    try:
+        ifs_ast = import_model(ifs_path, source_hash=source_hash)
+    except (IOError, OSError, StaleModelError):
+        from .build import parse_file
+        ifs_ast = parse_file(ifs_path)
+        if update:
+            try:
+                _atomic_write(descriptor_path(ifs_path),
+                              dump_model(ifs_ast, source_hash))
+            except (IOError, OSError):
+                pass
+
+    _LOADED_MODELS[key] = ifs_ast
+    return ifs_ast
+
+
+def load_model_bytes(data, source_hash=None):
+    """ Deserialize the output of `dump_model`.
+
+    If `source_hash` is given, it must match the hash stored in `data`.
+    """
+    try:
+        data = json.loads(zlib.decompress(data).decode('utf8'))
+    except (ValueError, zlib.error):
+        raise StaleModelError('Unreadable model descriptor')
+
+    if (data.get('format') != FORMAT_NAME or
+            data.get('version') != FORMAT_VERSION):
+        raise StaleModelError('Unsupported model descriptor version')
+    if source_hash is not None and data['source_hash'] != source_hash:
+        raise StaleModelError('Model descriptor is out of date')
+
+    tables, ifs_kwargs = [], {}
+    for table_type, rows in data['tables']:
+        rows = [TableRow(t, _decode_value(v)) for t, v in rows]
+        table = Table(table_type, rows)
+        tables.append(table)
+        ifs_kwargs[table_type.lower()] = table
+    return Ifs(tables, **ifs_kwargs)
+
+
+def _atomic_write(path, data):
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
+    try:
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_path, path)
+    finally:
+        if op.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _decode_value(value):
+    if isinstance(value, list):
+        return [_decode_value(v) for v in value]
+    if isinstance(value, dict):
+        (tag, content), = value.items()
+        if tag in _TAG_NODES:
+            return _TAG_NODES[tag](content)
+        elif tag == '-':
+            return Dash()
+        elif tag == 'R':
+            return Range(_decode_value(content[0]), _decode_value(content[1]))
+        elif tag == 'J':
+            return complex(content[0], content[1])
+        raise StaleModelError('Unknown node tag: {}'.format(tag))
+    return value
+
+
+def _encode_value(value):
+    if isinstance(value, list):
+        return [_encode_value(v) for v in value]
+    cls = type(value)
+    if cls in _NODE_TAGS:
+        return {_NODE_TAGS[cls]: value.value}
+    elif cls is Dash:
+        return {'-': 0}
+    elif cls is Range:
+        return {'R': [_encode_value(value.low), _encode_value(value.high)]}
+    elif cls is complex:
+        return {'J': [value.real, value.imag]}
+    return value
@@ -0,0 +1,204 @@
+""" Benchmark many instances of a code model at once.
+
+Real circuits instantiate the same code model thousands of times.
+`build_instance_library` builds a code model into an `InstanceArray`, which
+allocates `num_instances` instances of its `Mif_Private_t` and evaluates all
+of them at every timestep of a transient analysis in a C loop. By default
+the data of the instances is laid out contiguously in one arena; with
+``contiguous=False`` each piece is allocated separately on the heap, so the
+cost of the two layouts can be compared::
+
+    with build_instance_library('examples/dummy', {'d': 42.0}, 10000) as array:
+        array.set_inputs(np.random.rand(10000, array.num_inputs))
+        timing = array.run(1000, 1e-9, timed=True)
+    print(timing.seconds_per_call, timing.instance_seconds.max())
+
+Test code can do the same with the ``GJ_SETUP_INSTANCES`` and
+``GJ_STEP_INSTANCES`` macros of the harness.
+
+Requires NumPy.
+"""
+import collections
+import contextlib
+import ctypes
+import functools
+
+import numpy as np
+
+from gomjabbar.library import (
+    CodeModelLibrary, _DOUBLE_P, _build_library, _check_output, _pointer
+)
+
+#: The cost of `InstanceArray.run`. `seconds` is the elapsed time of the
+#: whole run and `num_calls` the number of calls of the entry point.
+#: `instance_seconds` is the time spent in the calls of each instance, or
+#: None if the run was not timed.
+InstanceTiming = collections.namedtuple('InstanceTiming', [
+    'seconds', 'num_calls', 'seconds_per_call', 'instance_seconds'
+])
+
+
+@contextlib.contextmanager
+def build_instance_library(code_model_dir, parameters, num_instances,
+                           contiguous=True, build_root=None, keep_failed=None,
+                           sources=None):
+    """ Build a code model into an `InstanceArray`.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model.
+    parameters : dict
+        A dictionary of values which will be assigned to the PARAMETER_TABLE
+        variables defined by the code model, in every instance.
+    num_instances : int
+        The number of instances.
+    contiguous : bool, optional
+        Whether the instances are allocated from one arena, in order, rather
+        than piece by piece from the heap. Defaults to True.
+    build_root : str, optional
+        See `gomjabbar.generate.build_test`.
+    keep_failed : bool, optional
+        See `gomjabbar.generate.build_test`.
+    sources : list of str, optional
+        See `gomjabbar.generate.build_test`.
+    """
+    library_class = functools.partial(InstanceArray,
+                                      num_instances=num_instances,
+                                      contiguous=contiguous)
+    with _build_library(code_model_dir, parameters, library_class,
+                        ('instances.c.jinja',), instances=True,
+                        build_root=build_root, keep_failed=keep_failed,
+                        sources=sources) as library:
+        yield library
+
+
+class InstanceArray(CodeModelLibrary):
+    """ A code model loaded into this process, with `num_instances`
+    instances of its `Mif_Private_t`.
+
+    Instance ``i`` is row ``i`` of the inputs and outputs. The instances are
+    separate from the single instance used by the `CodeModelLibrary`
+    methods.
+    """
+    def __init__(self, path, connections, num_instances=1, contiguous=True):
+        super(InstanceArray, self).__init__(path, connections)
+        self.num_instances = num_instances
+        self.contiguous = contiguous
+
+        lib = self._lib
+        lib.gj_instances_create.argtypes = [ctypes.c_int, ctypes.c_int]
+        lib.gj_instances_create.restype = ctypes.c_void_p
+        lib.gj_instances_destroy.argtypes = [ctypes.c_void_p]
+        lib.gj_instances_destroy.restype = None
+        lib.gj_instances_run.argtypes = [
+            ctypes.c_void_p, ctypes.c_long, ctypes.c_double, ctypes.c_double,
+            ctypes.c_int
+        ]
+        lib.gj_instances_run.restype = ctypes.c_longlong
+        lib.gj_instances_set_inputs.argtypes = [
+            ctypes.c_void_p, _DOUBLE_P, ctypes.c_int
+        ]
+        lib.gj_instances_set_inputs.restype = None
+        lib.gj_instances_get_outputs.argtypes = [ctypes.c_void_p, _DOUBLE_P]
+        lib.gj_instances_get_outputs.restype = None
+        lib.gj_instances_get_nanoseconds.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_longlong)
+        ]
+        lib.gj_instances_get_nanoseconds.restype = None
+        lib.gj_instances_arena_size.argtypes = [ctypes.c_void_p]
+        lib.gj_instances_arena_size.restype = ctypes.c_size_t
+
+        self._instances = lib.gj_instances_create(num_instances,
+                                                  int(contiguous))
+        if not self._instances:
+            self.close()
+            raise MemoryError('Out of memory allocating the instances')
+
+    @property
+    def arena_bytes(self):
+        """ The bytes of instance data in the arena of a contiguous array.
+        """
+        self._check_open()
+        return self._lib.gj_instances_arena_size(self._instances)
+
+    def close(self):
+        """ Free the instances and the code model's single instance.
+        """
+        if getattr(self, '_instances', None) is not None:
+            self._lib.gj_instances_destroy(self._instances)
+            self._instances = None
+        super(InstanceArray, self).close()
+
+    def get_outputs(self, out=None):
+        """ Return the outputs of every instance, as an array of shape
+        ``(num_instances, num_outputs)``.
+        """
+        self._check_open()
+        out = _check_output(out, (self.num_instances, self.num_outputs),
+                            'out')
+        self._lib.gj_instances_get_outputs(self._instances, _pointer(out))
+        return out
+
+    def run(self, num_steps, step, start=0.0, timed=False):
+        """ Call every instance at `num_steps` timepoints.
+
+        The instances are called at a DC operating point at `start` the
+        first time they are run, and at the following timepoints of a
+        transient analysis otherwise; each timepoint is `step` after the
+        previous one. Inputs keep the values of `set_inputs`.
+
+        Parameters
+        ----------
+        num_steps : int
+            The number of timepoints.
+        step : float
+            The time between timepoints.
+        start : float, optional
+            The first timepoint. Defaults to 0.
+        timed : bool, optional
+            Whether to time every call, which costs two clock reads per
+            call. The elapsed time of the run is always measured.
+
+        Returns an `InstanceTiming`.
+        """
+        self._check_open()
+        nanoseconds = self._lib.gj_instances_run(self._instances, num_steps,
+                                                 start, step, int(timed))
+        num_calls = num_steps * self.num_instances
+        seconds = nanoseconds * 1e-9
+        instance_seconds = None
+        if timed:
+            instance_ns = np.empty(self.num_instances, dtype=np.int64)
+            self._lib.gj_instances_get_nanoseconds(
+                self._instances,
+                instance_ns.ctypes.data_as(ctypes.POINTER(ctypes.c_longlong))
+            )
+            instance_seconds = instance_ns * 1e-9
+        return InstanceTiming(
+            seconds=seconds,
+            num_calls=num_calls,
+            seconds_per_call=seconds / num_calls if num_calls else 0.0,
+            instance_seconds=instance_seconds,
+        )
+
+    def set_inputs(self, inputs):
+        """ Set the inputs of the instances.
+
+        `inputs` has one row of `num_inputs` values for each instance, or a
+        single row which is given to all of them.
+        """
+        self._check_open()
+        inputs = np.ascontiguousarray(inputs, dtype=np.float64)
+        if self.num_inputs == 1 and inputs.shape == (self.num_instances,):
+            inputs = inputs.reshape(-1, 1)
+        if inputs.shape == (self.num_inputs,):
+            broadcast = 1
+        elif inputs.shape == (self.num_instances, self.num_inputs):
+            broadcast = 0
+        else:
+            msg = 'inputs must have shape ({}, {}) or ({},), not {}'
+            raise ValueError(msg.format(self.num_instances, self.num_inputs,
+                                        self.num_inputs, inputs.shape))
+        self._lib.gj_instances_set_inputs(self._instances, _pointer(inputs),
+                                          broadcast)
@@ -0,0 +1,347 @@
+""" In-process, batched evaluation of a code model with NumPy.
+
+`build_library` builds the harness, the code model and a small C driver into
+a shared library and loads it with `ctypes`. The driver evaluates the code
+model's entry point for every row of an array of port inputs in a tight C
+loop over a single `Mif_Private_t`, so characterizing a model over millions
+of operating points costs one call from Python::
+
+    with build_library('examples/dummy', {'d': 42.0}) as model:
+        outputs, partials = model.evaluate_partials(inputs)
+        gains = model.ac_sweep(np.logspace(0, 9, 1000))
+
+AC sweeps likewise loop over all frequencies in C.
+
+Requires NumPy.
+"""
+import contextlib
+import ctypes
+import os.path as op
+
+import numpy as np
+
+from gomjabbar.const import C_FUNCTION_NAME
+from gomjabbar.generate import (
+    TEMPLATE_ENV, _build_source, _get_template_context, _harness_options,
+    _render_harness
+)
+from gomjabbar.ifs.model import load_model
+
+_DOUBLE_P = ctypes.POINTER(ctypes.c_double)
+# The kinds of breakpoints recorded by the harness, by their codes
+_BREAKPOINT_KINDS = ('temporary', 'permanent', 'event')
+# Ports whose values are not doubles
+_NON_ANALOG_TYPES = ('MIF_DIGITAL', 'MIF_USER_DEFINED')
+
+
+@contextlib.contextmanager
+def build_library(code_model_dir, parameters, build_root=None,
+                  keep_failed=None, sources=None):
+    """ Build a code model into a `CodeModelLibrary`.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model.
+    parameters : dict
+        A dictionary of values which will be assigned to the PARAMETER_TABLE
+        variables defined by the code model.
+    build_root : str, optional
+        See `gomjabbar.generate.build_test`.
+    keep_failed : bool, optional
+        See `gomjabbar.generate.build_test`.
+    sources : list of str, optional
+        See `gomjabbar.generate.build_test`.
+    """
+    with _build_library(code_model_dir, parameters, CodeModelLibrary, (),
+                        build_root=build_root, keep_failed=keep_failed,
+                        sources=sources) as library:
+        yield library
+
+
+class CodeModelLibrary(object):
+    """ A code model loaded into this process, with a single instance of
+    its `Mif_Private_t`.
+
+    Input and output ports are numbered in PORT_TABLE order; ``inout`` ports
+    are both. Digital and user-defined ports are not exchanged. The instance
+    keeps its state (e.g. static variables) between calls and is not
+    thread-safe.
+
+    Parameters
+    ----------
+    path : str
+        The path of a shared library built by `build_library`.
+    connections : list of dict
+        The connections of the code model, from
+        `gomjabbar.ifs.build.build_connections_list`.
+    """
+    def __init__(self, path, connections):
+        self.path = path
+        self.input_names = _port_names(connections, 'is_input')
+        self.output_names = _port_names(connections, 'is_output')
+
+        self._lib = lib = ctypes.CDLL(path)
+        lib.gj_library_create.argtypes = []
+        lib.gj_library_create.restype = ctypes.c_void_p
+        lib.gj_library_destroy.argtypes = [ctypes.c_void_p]
+        lib.gj_library_destroy.restype = None
+        lib.gj_eval_batch.argtypes = [
+            ctypes.c_void_p, ctypes.c_long, _DOUBLE_P, _DOUBLE_P, _DOUBLE_P
+        ]
+        lib.gj_eval_batch.restype = ctypes.c_long
+        lib.gj_eval_ac.argtypes = [
+            ctypes.c_void_p, ctypes.c_long, _DOUBLE_P, _DOUBLE_P, _DOUBLE_P
+        ]
+        lib.gj_eval_ac.restype = ctypes.c_long
+        lib.gj_state_size.argtypes = [ctypes.c_void_p]
+        lib.gj_state_size.restype = ctypes.c_size_t
+        lib.gj_state_save.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        lib.gj_state_save.restype = ctypes.c_size_t
+        lib.gj_state_load.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t
+        ]
+        lib.gj_state_load.restype = ctypes.c_int
+        lib.gj_runtime_num_messages.argtypes = [ctypes.c_void_p]
+        lib.gj_runtime_num_messages.restype = ctypes.c_int
+        lib.gj_runtime_message.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.gj_runtime_message.restype = ctypes.c_char_p
+        lib.gj_runtime_num_breakpoints.argtypes = [ctypes.c_void_p]
+        lib.gj_runtime_num_breakpoints.restype = ctypes.c_int
+        lib.gj_runtime_breakpoint.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.gj_runtime_breakpoint.restype = _Breakpoint
+        self._data = lib.gj_library_create()
+
+    @property
+    def num_inputs(self):
+        return len(self.input_names)
+
+    @property
+    def num_outputs(self):
+        return len(self.output_names)
+
+    def ac_sweep(self, frequencies, inputs=None, out=None):
+        """ Run the code model's AC analysis over many frequencies.
+
+        The model is first called at DC at the operating point given by
+        `inputs`, then once with ``ANALYSIS`` set to AC for each frequency.
+
+        Parameters
+        ----------
+        frequencies : array_like
+            The frequencies, in Hz. ``RAD_FREQ`` is ``2 * pi`` times these.
+        inputs : array_like, optional
+            The input port values of the operating point, one per input.
+            Defaults to zeros.
+        out : ndarray, optional
+            A C-contiguous complex128 array of shape
+            ``(n, num_outputs, num_inputs)`` which receives the gains.
+
+        Returns the gains, where ``gains[f, i, j]`` is ``AC_GAIN`` of output
+        `i` with respect to input `j` at frequency `f`.
+        """
+        if inputs is None:
+            inputs = np.zeros(self.num_inputs)
+        inputs = self._check_inputs(np.reshape(inputs, (1, -1)))
+        rad_freqs = 2 * np.pi * np.ascontiguousarray(frequencies,
+                                                     dtype=np.float64)
+        rad_freqs = rad_freqs.ravel()
+        shape = (len(rad_freqs), self.num_outputs, self.num_inputs)
+        out = _check_output(out, shape, 'out', dtype=np.complex128)
+        self._lib.gj_eval_ac(self._data, len(rad_freqs), _pointer(rad_freqs),
+                             _pointer(inputs), _pointer(out))
+        return out
+
+    def breakpoints(self):
+        """ Return the breakpoints which the code model has set, as a list
+        of (time, kind) where kind is 'temporary', 'permanent' or 'event'.
+        """
+        self._check_open()
+        breakpoints = []
+        for i in range(self._lib.gj_runtime_num_breakpoints(self._data)):
+            bkpt = self._lib.gj_runtime_breakpoint(self._data, i)
+            breakpoints.append((bkpt.time, _BREAKPOINT_KINDS[bkpt.kind]))
+        return breakpoints
+
+    def close(self):
+        """ Free the code model instance. The library can not be used
+        afterwards.
+        """
+        if self._data is not None:
+            self._lib.gj_library_destroy(self._data)
+            self._data = None
+
+    def evaluate(self, inputs, out=None):
+        """ Evaluate the code model at DC for every row of `inputs`.
+
+        Parameters
+        ----------
+        inputs : array_like
+            The input port values, with shape ``(n, num_inputs)``. A 1-D
+            array is one value per point for models with a single input.
+        out : ndarray, optional
+            A C-contiguous float64 array of shape ``(n, num_outputs)`` which
+            receives the outputs.
+
+        Returns the output port values, with shape ``(n, num_outputs)``.
+        """
+        inputs = self._check_inputs(inputs)
+        num_points = inputs.shape[0]
+        out = _check_output(out, (num_points, self.num_outputs), 'out')
+        self._eval(inputs, out, None)
+        return out
+
+    def evaluate_partials(self, inputs, out=None, partials=None):
+        """ Evaluate the code model at DC for every row of `inputs`, also
+        collecting the partial derivatives of the outputs.
+
+        Parameters
+        ----------
+        inputs : array_like
+            See `evaluate`.
+        out : ndarray, optional
+            See `evaluate`.
+        partials : ndarray, optional
+            A C-contiguous float64 array of shape
+            ``(n, num_outputs, num_inputs)`` which receives the partials.
+
+        Returns the outputs and the partials, where ``partials[p, i, j]`` is
+        ``PARTIAL`` of output `i` with respect to input `j` at point `p`.
+        """
+        inputs = self._check_inputs(inputs)
+        num_points = inputs.shape[0]
+        out = _check_output(out, (num_points, self.num_outputs), 'out')
+        shape = (num_points, self.num_outputs, self.num_inputs)
+        partials = _check_output(partials, shape, 'partials')
+        self._eval(inputs, out, partials)
+        return out, partials
+
+    def messages(self):
+        """ Return the messages which the code model has sent with
+        ``cm_message_send``.
+        """
+        self._check_open()
+        return [
+            self._lib.gj_runtime_message(self._data, i).decode('utf8',
+                                                               'replace')
+            for i in range(self._lib.gj_runtime_num_messages(self._data))
+        ]
+
+    def restore_state(self, state):
+        """ Restore the state of the code model instance from a snapshot
+        taken by `save_state`, e.g. to branch several scenarios off one
+        warm-up. The snapshot may come from another instance of the same
+        code model; states which the code model allocates in ``INIT`` are
+        allocated by the restore if it has not run yet.
+
+        Parameters
+        ----------
+        state : bytes
+            The snapshot.
+        """
+        self._check_open()
+        state = bytes(state)
+        if self._lib.gj_state_load(self._data, state, len(state)) != 0:
+            raise ValueError('The state does not belong to this code model')
+
+    def save_state(self):
+        """ Return a snapshot of the state of the code model instance.
+
+        The snapshot holds the circuit data (``INIT``, ``TIME``, etc.), the
+        static variables, the states allocated with ``cm_analog_alloc`` and
+        ``cm_event_alloc`` and the values of all ports, including partials
+        and AC gains. Static variables which hold pointers are saved as the
+        pointers, not what they point to.
+        """
+        self._check_open()
+        buffer = ctypes.create_string_buffer(
+            self._lib.gj_state_size(self._data)
+        )
+        size = self._lib.gj_state_save(self._data, buffer)
+        return buffer.raw[:size]
+
+    def _check_inputs(self, inputs):
+        self._check_open()
+        inputs = np.ascontiguousarray(inputs, dtype=np.float64)
+        if inputs.ndim == 1 and self.num_inputs == 1:
+            inputs = inputs.reshape(-1, 1)
+        if inputs.ndim != 2 or inputs.shape[1] != self.num_inputs:
+            msg = 'inputs must have shape (n, {}), not {}'
+            raise ValueError(msg.format(self.num_inputs, inputs.shape))
+        return inputs
+
+    def _check_open(self):
+        if self._data is None:
+            raise ValueError('The code model library has been closed')
+
+    def _eval(self, inputs, out, partials):
+        partials_p = None if partials is None else _pointer(partials)
+        self._lib.gj_eval_batch(self._data, inputs.shape[0], _pointer(inputs),
+                                _pointer(out), partials_p)
+
+
+class _Breakpoint(ctypes.Structure):
+    _fields_ = [('time', ctypes.c_double), ('kind', ctypes.c_int)]
+
+
+@contextlib.contextmanager
+def _build_library(code_model_dir, parameters, library_class, templates,
+                   instances=False, **kwargs):
+    """ Build a shared library from the harness, the library driver and
+    any additional driver `templates`, and load it as a `library_class`.
+    `instances` includes the multi-instance code in the harness.
+    """
+    conns, params, num_vars = _get_template_context(code_model_dir, parameters)
+    options = dict(_harness_options(code_model_dir), state=True,
+                   instances=instances)
+    harness = _render_harness(conns, params, num_vars, **options)
+    source = harness + _render_library(code_model_dir, templates)
+    with _build_source(code_model_dir, source, shared=True, **kwargs) as path:
+        library = library_class(path, conns)
+        try:
+            yield library
+        finally:
+            library.close()
+
+
+def _check_output(array, shape, name, dtype=np.float64):
+    if array is None:
+        return np.empty(shape, dtype=dtype)
+    dtype = np.dtype(dtype)
+    if (array.shape != shape or array.dtype != dtype or
+            not array.flags.c_contiguous or not array.flags.writeable):
+        msg = '{} must be a writeable C-contiguous {} array of shape {}'
+        raise ValueError(msg.format(name, dtype.name, shape))
+    return array
+
+
+def _pointer(array):
+    return array.ctypes.data_as(_DOUBLE_P)
+
+
+def _port_names(connections, direction, analog=True):
+    """ Return the names of the ports of `connections` in `direction`. With
+    `analog`, digital and user-defined ports are left out, as the drivers
+    only exchange doubles.
+    """
+    names = []
+    for conn in connections:
+        if not conn[direction]:
+            continue
+        for i, port in enumerate(conn['ports']):
+            if analog and port['type'] in _NON_ANALOG_TYPES:
+                continue
+            if len(conn['ports']) == 1:
+                names.append(conn['name'])
+            else:
+                names.append('{}[{}]'.format(conn['name'], i))
+    return names
+
+
+def _render_library(code_model_dir, templates=()):
+    ast = load_model(op.join(code_model_dir, 'ifspec.ifs'))
+    context = {'function': ast.name_table.row(C_FUNCTION_NAME).value}
+    return ''.join(
+        TEMPLATE_ENV.get_template(name).render(context)
+        for name in ('library.c.jinja',) + tuple(templates)
+    )
@@ -0,0 +1,118 @@
+""" Track the memory allocations of a code model test.
+
+`build_memory_test` builds test code like `gomjabbar.generate.build_test`,
+but links the program so that ``malloc``, ``calloc``, ``realloc`` and
+``free`` and the code model's entry point are interposed. `run_memory_test`
+runs it and returns an `AllocationReport` with the allocations made by each
+call of the entry point, the peak number of live bytes and what was still
+allocated after ``GJ_TEARDOWN``::
+
+    with build_memory_test(code_model_dir, code, parameters) as path:
+        report = run_memory_test(path)
+    assert not report.failed
+    assert not any(call.allocations for call in report.calls
+                   if not call.init)
+    assert report.leaked_bytes == 0
+
+Only calls made directly by the harness, the test code and the code model's
+sources are seen; allocations made inside the C library (e.g. by
+``strdup``) are not. Requires the GNU linker's ``--wrap`` option.
+"""
+import collections
+import contextlib
+import json
+import os
+import os.path as op
+from subprocess import PIPE, CalledProcessError, Popen
+
+from gomjabbar.const import C_FUNCTION_NAME
+from gomjabbar.generate import (
+    TEMPLATE_ENV, _build_source, _get_template_context, _harness_options,
+    _render_harness
+)
+from gomjabbar.ifs.model import load_model
+
+#: The environment variable which names the file the report is written to
+REPORT_ENV_VAR = 'GOMJABBAR_ALLOC_REPORT'
+_WRAPPED_FUNCTIONS = ('malloc', 'calloc', 'realloc', 'free')
+
+#: The allocations made by a single call of the entry point. `init` is True
+#: if INIT was set; `net_bytes` is the change in live bytes during the call.
+CallAllocations = collections.namedtuple('CallAllocations', [
+    'init', 'allocations', 'reallocations', 'frees', 'allocated_bytes',
+    'net_bytes'
+])
+#: A block which was still allocated after GJ_TEARDOWN. `call` is the index
+#: of the call of the entry point which allocated it, or None.
+Leak = collections.namedtuple('Leak', ['size', 'call'])
+#: The allocations of a whole test program. `leaks` lists at most 100
+#: blocks. `teardown` is False if the program exited without reaching
+#: GJ_TEARDOWN, in which case everything still allocated at exit is counted
+#: as leaked. `failed` is True if the tracker could not allocate memory for
+#: its own records, in which case the counts are incomplete and must not be
+#: trusted. `output` is the program's standard output.
+AllocationReport = collections.namedtuple('AllocationReport', [
+    'calls', 'allocations', 'reallocations', 'frees', 'peak_bytes',
+    'leaked_bytes', 'num_leaks', 'leaks', 'teardown', 'failed', 'output'
+])
+
+
+@contextlib.contextmanager
+def build_memory_test(code_model_dir, code, parameters, build_root=None,
+                      keep_failed=None, sources=None):
+    """ Build test code into a program which tracks its allocations.
+
+    The arguments are the same as those of `gomjabbar.generate.build_test`.
+    Yields the path of the program, which is run with `run_memory_test`.
+    """
+    ast = load_model(op.join(code_model_dir, 'ifspec.ifs'))
+    function = ast.name_table.row(C_FUNCTION_NAME).value
+    conns, params, num_vars = _get_template_context(code_model_dir, parameters)
+    template = TEMPLATE_ENV.get_template('memory.c.jinja')
+    source = (_render_harness(conns, params, num_vars,
+                              **_harness_options(code_model_dir, [code])) +
+              template.render({'function': function}) + code)
+
+    wrapped = _WRAPPED_FUNCTIONS + (function,)
+    link_flags = ['-Wl,' + ','.join('--wrap=' + name for name in wrapped)]
+    with _build_source(code_model_dir, source, build_root=build_root,
+                       keep_failed=keep_failed, sources=sources,
+                       link_flags=link_flags) as path:
+        yield path
+
+
+def run_memory_test(path, args=()):
+    """ Run a program built by `build_memory_test` and return its
+    `AllocationReport`.
+
+    Raises `subprocess.CalledProcessError` if the program fails.
+    """
+    report_path = path + '.alloc.json'
+    env = dict(os.environ)
+    env[REPORT_ENV_VAR] = report_path
+    cmd = [path] + list(args)
+    proc = Popen(cmd, stdout=PIPE, env=env)
+    output = proc.communicate()[0]
+    try:
+        if proc.returncode != 0:
+            raise CalledProcessError(proc.returncode, cmd, output=output)
+        with open(report_path, 'r') as fp:
+            report = json.load(fp)
+    finally:
+        if op.exists(report_path):
+            os.remove(report_path)
+
+    return AllocationReport(
+        calls=list(map(CallAllocations._make, report['calls'])),
+        allocations=report['allocations'],
+        reallocations=report['reallocations'],
+        frees=report['frees'],
+        peak_bytes=report['peak_bytes'],
+        leaked_bytes=report['leaked_bytes'],
+        num_leaks=report['num_leaks'],
+        leaks=[Leak(size, None if call < 0 else call)
+               for size, call in report['leaks']],
+        teardown=report['teardown'],
+        failed=report['failed'],
+        output=output,
+    )
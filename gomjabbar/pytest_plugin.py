@@ -0,0 +1,358 @@
+""" A pytest plugin for testing ngspice code models.
+
+Mark a test with the code model it exercises, the parameters to use and,
+optionally, its test code::
+
+    @pytest.mark.code_model('dummy', parameters={'d': 42.0}, code=MAIN)
+    def test_dummy(code_model_command):
+        assert check_output(code_model_command) == b'42.0\\n'
+
+Relative paths are resolved against the directory of the test file. Tests
+which put their test code in the marker are built in batches: the first such
+test which runs builds the code of every collected test which shares its code
+model and parameters into a single unity program (see
+`gomjabbar.generate.build_unity_test`). The `code_model_command` fixture is
+the command line which runs the test's snippet of that program. Snippets
+which fail to compile are left out of the batch and only fail their own tests.
+
+The `code_model_program` fixture instead builds the marker's code into a
+program of its own, and the `code_model` fixture can build and run arbitrary
+code for the test's code model.
+
+The `golden` fixture compares outputs of the test with a baseline stored
+beside the code model (see `gomjabbar.golden`); pass
+``--gomjabbar-update-golden`` to rewrite the baselines.
+
+Programs run by the `code_model` fixture can be given wall-clock, CPU time
+and memory budgets with ``--gomjabbar-timeout``, ``--gomjabbar-cpu-time`` and
+``--gomjabbar-memory`` (see `gomjabbar.watchdog`).
+
+Programs are stored in a cache which is shared by all pytest-xdist workers
+and persists between sessions, so each distinct program is only built once.
+Build and run timings are reported in the terminal summary.
+"""
+from __future__ import print_function
+
+import hashlib
+import os.path as op
+import re
+import subprocess
+import threading
+import time
+
+import pytest
+
+MARKER = 'code_model'
+
+
+class CodeModel(object):
+    """ Builds and runs test programs for one code model.
+
+    Returned by the `code_model` fixture.
+    """
+    def __init__(self, path, parameters, session):
+        self.path = path
+        self.parameters = parameters
+        self._session = session
+
+    def build(self, code):
+        """ Return the path of a program built from `code`.
+        """
+        return self._session.build(self.path, code, self.parameters)
+
+    def run(self, code, args=(), input=None):
+        """ Build a program from `code`, run it and return its output.
+        """
+        return self._session.run(self.build(code), args=args, input=input)
+
+
+class _Session(object):
+    """ Per-process state of the plugin.
+    """
+    def __init__(self, config):
+        self.config = config
+        self._cache = None
+        self._lock = threading.Lock()
+        self.batches = {}
+        self.batch_commands = {}
+        self.run_count = 0
+        self.run_time = 0.0
+
+    @property
+    def cache(self):
+        # Created on first use so that sessions without code model tests
+        # never import jinja2 or ply.
+        if self._cache is None:
+            from gomjabbar.cache import ProgramCache
+
+            cache_dir = self.config.getoption('gomjabbar_cache')
+            if not cache_dir:
+                cache_dir = str(self.config.cache.makedir('gomjabbar'))
+            self._cache = ProgramCache(cache_dir)
+        return self._cache
+
+    def build(self, path, code, parameters):
+        return self.cache.build(path, code, parameters)
+
+    def command(self, path, parameters, code):
+        """ Return the command line which runs `code` as a snippet of the
+        unity program of its batch.
+        """
+        key = _batch_key(path, parameters)
+        if key not in self.batch_commands:
+            codes = self.batches.get(key, set()) | {code}
+            self.batch_commands[key] = self._build_batch(path, parameters,
+                                                         codes)
+        commands = self.batch_commands[key]
+        if code not in commands:
+            # Not seen during collection
+            commands.update(self._build_batch(path, parameters, {code}))
+
+        result = commands[code]
+        if isinstance(result, Exception):
+            raise result
+        return list(result)
+
+    def run(self, program, args=(), input=None):
+        start = time.time()
+        try:
+            if self.limits:
+                output = self._run_limited([program] + list(args), input)
+            else:
+                output = subprocess.check_output([program] + list(args),
+                                                 input=input)
+        finally:
+            with self._lock:
+                self.run_count += 1
+                self.run_time += time.time() - start
+        return output.decode('utf8')
+
+    @property
+    def limits(self):
+        limits = {
+            'timeout': self.config.getoption('gomjabbar_timeout'),
+            'cpu_time': self.config.getoption('gomjabbar_cpu_time'),
+            'memory': self.config.getoption('gomjabbar_memory'),
+        }
+        return {key: value for key, value in limits.items()
+                if value is not None}
+
+    def stats(self):
+        stats = {'runs': self.run_count, 'run_time': self.run_time}
+        if self._cache is not None:
+            stats.update(self._cache.stats)
+        return stats
+
+    def _run_limited(self, cmd, input):
+        from gomjabbar.watchdog import run_program
+
+        result = run_program(cmd, input=input, **self.limits)
+        if result.timed_out:
+            pytest.fail('{} was killed after {:.1f}s'.format(cmd[0],
+                                                            result.elapsed))
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, cmd,
+                                                output=result.stdout)
+        return result.stdout
+
+    def _build_batch(self, path, parameters, codes):
+        from gomjabbar.generate import UnityBuildError
+
+        snippets = {_snippet_name(code): code for code in codes}
+        results = {}
+        while snippets:
+            try:
+                program = self.cache.build_unity(path, snippets, parameters)
+            except UnityBuildError as exc:
+                if not exc.snippet_errors:
+                    results.update((code, exc) for code in snippets.values())
+                    break
+                # Retry without the snippets which broke the build
+                for name in exc.snippet_errors:
+                    results[snippets.pop(name)] = exc
+                continue
+
+            for name, code in snippets.items():
+                results[code] = (program, name)
+            break
+        return results
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('gomjabbar')
+    group.addoption(
+        '--gomjabbar-cache', dest='gomjabbar_cache', default=None,
+        help='Directory where compiled code model test programs are cached. '
+             'Defaults to a directory in the pytest cache.'
+    )
+    group.addoption(
+        '--gomjabbar-update-golden', dest='gomjabbar_update_golden',
+        action='store_true', default=False,
+        help='Rewrite the golden baselines used by the golden fixture '
+             'instead of comparing with them.'
+    )
+    group.addoption(
+        '--gomjabbar-timeout', dest='gomjabbar_timeout', type=float,
+        default=None, metavar='SECONDS',
+        help='Kill test programs run by the code_model fixture after this '
+             'wall-clock time.'
+    )
+    group.addoption(
+        '--gomjabbar-cpu-time', dest='gomjabbar_cpu_time', type=int,
+        default=None, metavar='SECONDS',
+        help='Limit the CPU time of test programs run by the code_model '
+             'fixture.'
+    )
+    group.addoption(
+        '--gomjabbar-memory', dest='gomjabbar_memory', type=int,
+        default=None, metavar='BYTES',
+        help='Limit the address space of test programs run by the '
+             'code_model fixture.'
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers',
+        '{}(path, parameters=None, code=None): the code model directory, '
+        'PARAMETER_TABLE values and (optional) test code used by the '
+        'code_model fixtures'.format(MARKER)
+    )
+    config._gomjabbar = _Session(config)
+    config._gomjabbar_worker_stats = []
+
+
+def pytest_collection_modifyitems(session, config, items):
+    plugin = config._gomjabbar
+    for item in items:
+        marker = item.get_closest_marker(MARKER)
+        if marker is None:
+            continue
+        path, parameters, code = _marker_args(item, marker)
+        if code is not None:
+            key = _batch_key(path, parameters)
+            plugin.batches.setdefault(key, set()).add(code)
+
+
+def pytest_sessionfinish(session):
+    config = session.config
+    if hasattr(config, 'workeroutput'):
+        # Running in a pytest-xdist worker: hand the stats to the controller
+        config.workeroutput['gomjabbar'] = config._gomjabbar.stats()
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    stats = getattr(node, 'workeroutput', {}).get('gomjabbar')
+    if stats is not None:
+        node.config._gomjabbar_worker_stats.append(stats)
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    all_stats = [config._gomjabbar.stats()]
+    all_stats.extend(config._gomjabbar_worker_stats)
+
+    totals = {}
+    for stats in all_stats:
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+    if not (totals.get('builds') or totals.get('hits') or totals.get('runs')):
+        return
+
+    write = terminalreporter.write_line
+    terminalreporter.write_sep('=', 'gomjabbar')
+    write('programs built: {} in {:.2f}s'.format(totals.get('builds', 0),
+                                                 totals.get('build_time', 0)))
+    write('program cache hits: {}'.format(totals.get('hits', 0)))
+    write('program runs: {} in {:.2f}s'.format(totals.get('runs', 0),
+                                               totals.get('run_time', 0)))
+
+
+@pytest.fixture(scope='session')
+def gomjabbar_cache(pytestconfig):
+    """ The `gomjabbar.cache.ProgramCache` shared by the session.
+    """
+    return pytestconfig._gomjabbar.cache
+
+
+@pytest.fixture
+def code_model(request):
+    """ A `CodeModel` for the code model named by the test's marker.
+    """
+    marker = request.node.get_closest_marker(MARKER)
+    if marker is None:
+        msg = 'The code_model fixture requires a @pytest.mark.{} marker'
+        raise pytest.UsageError(msg.format(MARKER))
+    path, parameters, _ = _marker_args(request.node, marker)
+    return CodeModel(path, parameters, request.config._gomjabbar)
+
+
+@pytest.fixture
+def code_model_command(request, code_model):
+    """ The command line which runs the code given to the test's marker.
+
+    The code is built in a batch with the code of all other tests for the
+    same code model and parameters.
+    """
+    code = _marker_code(request)
+    plugin = request.config._gomjabbar
+    return plugin.command(code_model.path, code_model.parameters, code)
+
+
+@pytest.fixture
+def code_model_program(request, code_model):
+    """ The path of a program built from the code given to the test's marker.
+    """
+    return code_model.build(_marker_code(request))
+
+
+@pytest.fixture
+def golden(request, code_model):
+    """ A function which compares a dictionary of outputs with the golden
+    baseline of the test. See `gomjabbar.golden.check_golden`.
+    """
+    from gomjabbar.golden import check_golden
+
+    update = request.config.getoption('gomjabbar_update_golden') or None
+    name = _golden_name(request.node)
+
+    def check(outputs, **kwargs):
+        kwargs.setdefault('update', update)
+        return check_golden(code_model.path, name, outputs, **kwargs)
+
+    return check
+
+
+def _batch_key(path, parameters):
+    return path, tuple(sorted((k, repr(v)) for k, v in parameters.items()))
+
+
+def _golden_name(item):
+    module, _, rest = item.nodeid.partition('::')
+    name = op.splitext(op.basename(module))[0] + '.' + rest.replace('::', '.')
+    return re.sub(r'[^\w.-]+', '_', name).strip('_')
+
+
+def _marker_args(item, marker):
+    kwargs = dict(marker.kwargs)
+    args = list(marker.args)
+    path = args.pop(0) if args else kwargs.pop('path')
+    parameters = args.pop(0) if args else kwargs.pop('parameters', None)
+    code = args.pop(0) if args else kwargs.pop('code', None)
+
+    if not op.isabs(path):
+        path = op.join(op.dirname(str(item.fspath)), path)
+    return op.abspath(path), parameters or {}, code
+
+
+def _marker_code(request):
+    marker = request.node.get_closest_marker(MARKER)
+    _, _, code = _marker_args(request.node, marker)
+    if code is None:
+        msg = 'The code given to the {} marker is required here'
+        raise pytest.UsageError(msg.format(MARKER))
+    return code
+
+
+def _snippet_name(code):
+    return hashlib.sha1(code.encode('utf8')).hexdigest()[:12]
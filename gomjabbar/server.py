@@ -0,0 +1,354 @@
+""" A long-lived build server which keeps gomjabbar's caches warm.
+
+The server listens on a Unix socket and serves build and run requests from
+thin clients. It keeps parsed models, rendered harnesses and compiled test
+programs in memory or in its cache directory, so the cost of importing
+jinja2 and ply, building the parser tables and compiling a given test is paid
+once per server rather than once per client process.
+
+The protocol is one JSON object per line in each direction. Start a server
+with ``python -m gomjabbar.server`` and talk to it with `BuildClient`. Tests
+can use `start_server` to run a server in a background thread.
+"""
+from __future__ import print_function
+
+import errno
+import json
+import os
+import os.path as op
+import shutil
+import socket
+import stat
+import struct
+import tempfile
+import threading
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+SOCKET_ENV_VAR = 'GOMJABBAR_SERVER'
+# The default wall-clock budget of a run, in seconds
+RUN_TIMEOUT = 300.0
+
+
+class BuildServerError(RuntimeError):
+    """ Raised by `BuildClient` when the server could not handle a request.
+    """
+
+
+def default_socket_path():
+    """ Return the socket path used when none is given explicitly.
+
+    This is the value of the ``GOMJABBAR_SERVER`` environment variable, or a
+    socket in a directory which only the user can access: a ``gomjabbar``
+    subdirectory of ``XDG_RUNTIME_DIR`` or, without it, a per-user directory
+    in the temporary directory. The directory is created if needed, and an
+    `OSError` is raised if it belongs to another user or is accessible to
+    others.
+    """
+    if SOCKET_ENV_VAR in os.environ:
+        return os.environ[SOCKET_ENV_VAR]
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and op.isdir(runtime_dir):
+        directory = op.join(runtime_dir, 'gomjabbar')
+    else:
+        name = 'gomjabbar-server-{}'.format(os.getuid())
+        directory = op.join(tempfile.gettempdir(), name)
+    _make_private_dir(directory)
+    return op.join(directory, 'server.sock')
+
+
+class BuildClient(object):
+    """ A thin client for a `BuildServer`.
+
+    Importing and using the client does not import jinja2 or ply.
+    """
+    def __init__(self, socket_path=None, timeout=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.timeout = timeout
+
+    def build(self, code_model_dir, code, parameters):
+        """ Build a test program on the server and return its path.
+
+        The program is owned by the server and stays valid until the server
+        shuts down.
+        """
+        reply = self._request('build', code_model_dir=code_model_dir,
+                              code=code, parameters=parameters)
+        return reply['path']
+
+    def ping(self):
+        """ Return True if a server is listening on the socket.
+        """
+        try:
+            self._request('ping')
+        except (IOError, OSError, BuildServerError):
+            return False
+        return True
+
+    def run(self, code_model_dir, code, parameters, args=(), input=None,
+            timeout=None):
+        """ Build (if needed) and run a test program on the server.
+
+        The program is killed after `timeout` seconds, which defaults to the
+        server's. Returns a dictionary with the keys ``returncode``,
+        ``timed_out``, ``stdout`` and ``stderr``.
+        """
+        reply = self._request('run', code_model_dir=code_model_dir,
+                              code=code, parameters=parameters,
+                              args=list(args), input=input, timeout=timeout)
+        return reply['result']
+
+    def shutdown(self):
+        """ Ask the server to stop.
+        """
+        self._request('shutdown')
+
+    def stats(self):
+        """ Return the cache statistics of the server.
+        """
+        return self._request('stats')['stats']
+
+    def _request(self, op_name, **kwargs):
+        kwargs['op'] = op_name
+        if 'code_model_dir' in kwargs:
+            kwargs['code_model_dir'] = op.abspath(kwargs['code_model_dir'])
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            fp = sock.makefile('rwb')
+            fp.write(json.dumps(kwargs).encode('utf8') + b'\n')
+            fp.flush()
+            line = fp.readline()
+            fp.close()
+        finally:
+            sock.close()
+
+        if not line:
+            raise BuildServerError('No reply from the build server')
+        reply = json.loads(line.decode('utf8'))
+        if 'error' in reply:
+            raise BuildServerError(reply['error'])
+        return reply
+
+
+class BuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ A server which builds and runs code model tests for `BuildClient`.
+
+    Parameters
+    ----------
+    socket_path : str, optional
+        The path of the Unix socket to listen on.
+    max_jobs : int, optional
+        The number of builds and runs which may execute at once.
+    cache_dir : str, optional
+        Where compiled test programs are kept. A temporary directory, which
+        is removed by `server_close`, is used by default.
+    timeout : float, optional
+        The wall-clock budget in seconds of runs which do not give their
+        own. Defaults to `RUN_TIMEOUT`.
+
+    A socket left behind by a server which died is replaced, but an
+    `OSError` is raised if another server is still listening on it. Only
+    the user running the server may connect to the socket.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, max_jobs=None, cache_dir=None,
+                 timeout=RUN_TIMEOUT):
+        # Deferred so that clients do not pay for jinja2 and ply
+        from gomjabbar.cache import ProgramCache
+
+        self._owns_cache_dir = cache_dir is None
+        self.cache_dir = cache_dir or tempfile.mkdtemp(prefix='gomjabbar-')
+        self.socket_path = socket_path or default_socket_path()
+        self._programs = ProgramCache(self.cache_dir)
+        self._jobs = threading.BoundedSemaphore(max_jobs or _cpu_count())
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._runs = 0
+
+        try:
+            _remove_stale_socket(self.socket_path)
+        except Exception:
+            if self._owns_cache_dir:
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+            raise
+        socketserver.UnixStreamServer.__init__(self, self.socket_path,
+                                               _RequestHandler)
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.socket_path, stat.S_IRUSR | stat.S_IWUSR)
+
+    def verify_request(self, request, client_address):
+        # Where the platform tells, refuse clients of other users
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        credentials = request.getsockopt(socket.SOL_SOCKET,
+                                         socket.SO_PEERCRED,
+                                         struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if op.exists(self.socket_path):
+            os.remove(self.socket_path)
+        if self._owns_cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def build(self, code_model_dir, code, parameters):
+        """ Return the path of a compiled test program, building it only if
+        an identical program has not been built already.
+        """
+        with self._jobs:
+            return self._programs.build(code_model_dir, code, parameters)
+
+    def run(self, code_model_dir, code, parameters, args=(), input=None,
+            timeout=None):
+        """ Build (if needed) and run a test program under a watchdog.
+        """
+        from gomjabbar.watchdog import run_program
+
+        program = self.build(code_model_dir, code, parameters)
+        with self._jobs:
+            with self._lock:
+                self._runs += 1
+            result = run_program(
+                [program] + list(args),
+                timeout=self.timeout if timeout is None else timeout,
+                input=(input or '').encode('utf8'),
+            )
+        return {
+            'returncode': result.returncode,
+            'timed_out': result.timed_out,
+            'stdout': result.stdout.decode('utf8', 'replace'),
+            'stderr': result.stderr.decode('utf8', 'replace'),
+        }
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._programs.stats)
+            stats['runs'] = self._runs
+        return stats
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            reply = self._dispatch(json.loads(line.decode('utf8')))
+        except Exception as exc:
+            reply = {'error': '{}: {}'.format(type(exc).__name__, exc)}
+        self.wfile.write(json.dumps(reply).encode('utf8') + b'\n')
+        self.wfile.flush()
+
+        if reply.get('shutdown'):
+            # shutdown() blocks until serve_forever() returns, so it must not
+            # be called from a handler thread directly.
+            threading.Thread(target=self.server.shutdown).start()
+
+    def _dispatch(self, request):
+        server = self.server
+        op_name = request.pop('op')
+        if op_name == 'ping':
+            return {'ok': True}
+        elif op_name == 'build':
+            return {'path': server.build(**request)}
+        elif op_name == 'run':
+            return {'result': server.run(**request)}
+        elif op_name == 'stats':
+            return {'stats': server.stats()}
+        elif op_name == 'shutdown':
+            return {'ok': True, 'shutdown': True}
+        raise ValueError('Unknown operation: {}'.format(op_name))
+
+
+def start_server(socket_path=None, **kwargs):
+    """ Start a `BuildServer` in a background thread of this process.
+
+    This is a stand-in for the daemon which is convenient in tests. Call
+    ``server.shutdown()`` and ``server.server_close()`` to stop it.
+    """
+    server = BuildServer(socket_path=socket_path, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _cpu_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+def _make_private_dir(path):
+    """ Create the directory `path` with permissions for the user only, or
+    check that an existing one has them.
+    """
+    try:
+        os.mkdir(path, stat.S_IRWXU)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        msg = '{} is not a directory of the current user'.format(path)
+        raise OSError(errno.EPERM, msg)
+    if stat.S_IMODE(info.st_mode) & (stat.S_IRWXG | stat.S_IRWXO):
+        msg = '{} is accessible to other users'.format(path)
+        raise OSError(errno.EPERM, msg)
+
+
+def _remove_stale_socket(path):
+    """ Remove the socket at `path` if no server is listening on it.
+
+    Raises an `OSError` with ``EADDRINUSE`` if a server answers.
+    """
+    if not op.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as exc:
+        if exc.errno != errno.ECONNREFUSED:
+            raise
+        # Left behind by a server which died
+        os.remove(path)
+    else:
+        msg = 'A server is already listening on {}'.format(path)
+        raise OSError(errno.EADDRINUSE, msg)
+    finally:
+        sock.close()
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('-s', '--socket', type=str, default=None)
+    argparser.add_argument('-j', '--jobs', type=int, default=None)
+    argparser.add_argument('--cache-dir', type=str, default=None)
+    argparser.add_argument('-t', '--timeout', type=float, default=RUN_TIMEOUT)
+    args = argparser.parse_args()
+
+    server = BuildServer(socket_path=args.socket, max_jobs=args.jobs,
+                         cache_dir=args.cache_dir, timeout=args.timeout)
+    print('gomjabbar build server listening on', server.socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+""" Spread builds and runs of test programs over many hosts through a shared
+spool directory.
+
+A coordinator submits jobs, each a code model directory, test code and
+parameters, to a `Spool` in a directory which every host can reach (e.g. over
+NFS). Any number of workers, on any host, run `run_worker` (or ``gomjabbar
+worker SPOOL``) against the same directory. A worker claims a job by
+renaming it from ``pending/`` to ``running/``, which only one worker can do,
+builds it with `gomjabbar.generate.build_test`, runs it under the budgets of
+the job (see `gomjabbar.watchdog`) and writes a `JobResult` to
+``results/``::
+
+    spool = Spool('/shared/spool')
+    job_ids = [spool.submit(model_dir, code, parameters)
+               for model_dir, code, parameters in suite]
+    for result in spool.iter_results(job_ids, timeout=3600):
+        assert result.error is None and result.returncode == 0
+    spool.stop()
+
+Code model directories must have the same path on every host. Files are
+written under a temporary name and renamed into place, so no process ever
+sees a partial job or result. While a worker runs a job, it touches the job's
+file in ``running/`` every `HEARTBEAT_INTERVAL` seconds, so `Spool.recover`
+only requeues the jobs of workers which died. POSIX only.
+"""
+import collections
+import contextlib
+import errno
+import json
+import os
+import os.path as op
+import socket
+import threading
+import time
+import uuid
+
+#: The outcome of a job. `worker` is the ``host:pid`` of the worker which ran
+#: it. `error` is None if the program was built and run; otherwise it
+#: describes why not and the other fields are None. The rest are the fields
+#: of `gomjabbar.watchdog.RunResult`, with the output decoded as UTF-8.
+JobResult = collections.namedtuple('JobResult', [
+    'job_id', 'worker', 'error', 'returncode', 'signal', 'timed_out',
+    'elapsed', 'cpu_time', 'peak_rss', 'stdout', 'stderr'
+])
+
+#: The seconds between touches of the file of a running job by its worker
+HEARTBEAT_INTERVAL = 10.0
+
+_SUBDIRS = ('tmp', 'pending', 'running', 'results')
+_STOP_FILENAME = 'stop'
+
+
+class SpoolTimeoutError(RuntimeError):
+    """ Raised when results do not arrive in time. `job_ids` are the jobs
+    without a result.
+    """
+    def __init__(self, msg, job_ids):
+        RuntimeError.__init__(self, msg)
+        self.job_ids = job_ids
+
+
+class Spool(object):
+    """ A shared directory of jobs and their results.
+
+    Parameters
+    ----------
+    path : str
+        The spool directory. It and its subdirectories are created if
+        needed.
+    """
+    def __init__(self, path):
+        self.path = path
+        for name in _SUBDIRS:
+            try:
+                os.makedirs(op.join(path, name))
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    @property
+    def stopped(self):
+        """ Whether `stop` was called; idle workers exit.
+        """
+        return op.exists(op.join(self.path, _STOP_FILENAME))
+
+    def claim(self):
+        """ Claim the oldest pending job and return it as a dictionary, or
+        return None if there is none.
+        """
+        pending = op.join(self.path, 'pending')
+        for name in sorted(os.listdir(pending)):
+            if not name.endswith('.json'):
+                continue
+            running = op.join(self.path, 'running', name)
+            try:
+                # The age of a running job counts from its claim. The file is
+                # touched before it is moved, so that a recovery never sees
+                # it in running/ with the age of its submission.
+                os.utime(op.join(pending, name), None)
+                os.rename(op.join(pending, name), running)
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    # Another worker claimed it first
+                    continue
+                raise
+            with open(running, 'r') as fp:
+                return json.load(fp)
+        return None
+
+    def complete(self, result):
+        """ Record the `JobResult` of a claimed job.
+        """
+        self._write('results', result.job_id, result._asdict())
+        try:
+            os.remove(op.join(self.path, 'running', result.job_id + '.json'))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def heartbeat(self, job_id):
+        """ Mark a claimed job as still running.
+        """
+        try:
+            os.utime(op.join(self.path, 'running', job_id + '.json'), None)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def iter_results(self, job_ids, timeout=None, poll_interval=0.2):
+        """ Yield the `JobResult` of each of `job_ids` as it arrives.
+
+        Raises `SpoolTimeoutError` if some are still missing after `timeout`
+        seconds.
+        """
+        waiting = set(job_ids)
+        deadline = None if timeout is None else time.time() + timeout
+        while waiting:
+            for job_id in sorted(waiting):
+                result = self.result(job_id)
+                if result is not None:
+                    waiting.discard(job_id)
+                    yield result
+            if not waiting:
+                break
+            if deadline is not None and time.time() >= deadline:
+                msg = '{} jobs have no result after {} s'
+                raise SpoolTimeoutError(msg.format(len(waiting), timeout),
+                                        sorted(waiting))
+            time.sleep(poll_interval)
+
+    def recover(self, older_than):
+        """ Put running jobs whose worker has given no heartbeat for
+        `older_than` seconds back in the queue, e.g. after the worker died.
+        `older_than` should be several times `HEARTBEAT_INTERVAL`. Returns
+        their ids.
+        """
+        running = op.join(self.path, 'running')
+        now = time.time()
+        job_ids = []
+        for name in sorted(os.listdir(running)):
+            path = op.join(running, name)
+            try:
+                if now - op.getmtime(path) < older_than:
+                    continue
+                os.rename(path, op.join(self.path, 'pending', name))
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    # Completed or recovered meanwhile
+                    continue
+                raise
+            job_ids.append(name[:-len('.json')])
+        return job_ids
+
+    def result(self, job_id):
+        """ Return the `JobResult` of `job_id`, or None if it has none yet.
+        """
+        path = op.join(self.path, 'results', job_id + '.json')
+        try:
+            with open(path, 'r') as fp:
+                return JobResult(**json.load(fp))
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+
+    def stop(self):
+        """ Tell the workers to exit once there are no pending jobs.
+        """
+        open(op.join(self.path, _STOP_FILENAME), 'a').close()
+
+    def submit(self, code_model_dir, code, parameters, args=(), input=None,
+               timeout=None, cpu_time=None, memory=None):
+        """ Queue a job and return its id.
+
+        Parameters
+        ----------
+        code_model_dir : str
+            The path of the directory of the code model, which is made
+            absolute.
+        code : str
+            The test code.
+        parameters : dict
+            The PARAMETER_TABLE values, which must be JSON serializable.
+        args : list of str, optional
+            The arguments of the test program.
+        input : str, optional
+            The standard input of the test program.
+        timeout, cpu_time, memory : optional
+            The budgets of the run; see `gomjabbar.watchdog.run_program`.
+        """
+        # Ids sort in the order of submission
+        job_id = '{:016x}-{}'.format(int(time.time() * 1e6),
+                                     uuid.uuid4().hex)
+        job = {
+            'job_id': job_id,
+            'code_model_dir': op.abspath(code_model_dir),
+            'code': code,
+            'parameters': parameters,
+            'args': list(args),
+            'input': input,
+            'timeout': timeout,
+            'cpu_time': cpu_time,
+            'memory': memory,
+        }
+        self._write('pending', job_id, job)
+        return job_id
+
+    def _write(self, subdir, job_id, obj):
+        tmp_path = op.join(self.path, 'tmp', uuid.uuid4().hex)
+        with open(tmp_path, 'w') as fp:
+            json.dump(obj, fp)
+        os.rename(tmp_path, op.join(self.path, subdir, job_id + '.json'))
+
+
+def run_job(job, worker=None, build_root=None, keep_failed=None):
+    """ Build and run a job claimed from a `Spool` and return its
+    `JobResult`.
+    """
+    from subprocess import CalledProcessError
+
+    from gomjabbar.generate import build_test
+    from gomjabbar.watchdog import run_program
+
+    if worker is None:
+        worker = _worker_name()
+    failed = dict.fromkeys(JobResult._fields)
+    failed.update(job_id=job['job_id'], worker=worker)
+    input = job.get('input')
+    try:
+        with build_test(job['code_model_dir'], job['code'],
+                        job['parameters'], build_root=build_root,
+                        keep_failed=keep_failed) as path:
+            run = run_program(
+                [path] + list(job.get('args', ())),
+                timeout=job.get('timeout'), cpu_time=job.get('cpu_time'),
+                memory=job.get('memory'),
+                input=None if input is None else input.encode('utf8'),
+            )
+    except CalledProcessError as exc:
+        output = exc.output or ''
+        if isinstance(output, bytes):
+            output = output.decode('utf8', 'replace')
+        failed['error'] = '{}\n{}'.format(exc, output)
+        return JobResult(**failed)
+    except Exception as exc:
+        # e.g. gomjabbar.ifs.build.ParameterError, a missing model or a
+        # template error, none of which may take the worker down
+        failed['error'] = '{}: {}'.format(type(exc).__name__, exc)
+        return JobResult(**failed)
+
+    return JobResult(
+        job_id=job['job_id'],
+        worker=worker,
+        error=None,
+        returncode=run.returncode,
+        signal=run.signal,
+        timed_out=run.timed_out,
+        elapsed=run.elapsed,
+        cpu_time=run.cpu_time,
+        peak_rss=run.peak_rss,
+        stdout=run.stdout.decode('utf8', 'replace'),
+        stderr=run.stderr.decode('utf8', 'replace'),
+    )
+
+
+def run_worker(spool_dir, max_jobs=None, idle_timeout=None, poll_interval=0.5,
+               build_root=None, keep_failed=None,
+               heartbeat_interval=HEARTBEAT_INTERVAL):
+    """ Run jobs from the spool in `spool_dir` until it is stopped.
+
+    Parameters
+    ----------
+    spool_dir : str
+        The spool directory.
+    max_jobs : int, optional
+        Exit after running this many jobs.
+    idle_timeout : float, optional
+        Exit after finding no pending job for this many seconds.
+    poll_interval : float, optional
+        The time between looks for pending jobs.
+    build_root : str, optional
+        See `gomjabbar.generate.build_test`.
+    keep_failed : bool, optional
+        See `gomjabbar.generate.build_test`.
+    heartbeat_interval : float, optional
+        The time between heartbeats of a running job. Defaults to
+        `HEARTBEAT_INTERVAL`.
+
+    Returns the number of jobs run.
+    """
+    spool = Spool(spool_dir)
+    worker = _worker_name()
+    num_jobs = 0
+    idle_since = time.time()
+    while max_jobs is None or num_jobs < max_jobs:
+        job = spool.claim()
+        if job is None:
+            if spool.stopped:
+                break
+            if (idle_timeout is not None and
+                    time.time() - idle_since >= idle_timeout):
+                break
+            time.sleep(poll_interval)
+            continue
+        with _heartbeat(spool, job['job_id'], heartbeat_interval):
+            result = run_job(job, worker, build_root=build_root,
+                             keep_failed=keep_failed)
+        spool.complete(result)
+        num_jobs += 1
+        idle_since = time.time()
+    return num_jobs
+
+
+@contextlib.contextmanager
+def _heartbeat(spool, job_id, interval):
+    """ Give heartbeats for `job_id` on a separate thread while the block
+    runs.
+    """
+    done = threading.Event()
+
+    def beat():
+        while not done.wait(interval):
+            spool.heartbeat(job_id)
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+
+def _worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
@@ -0,0 +1,189 @@
+""" Stream input waveforms through a code model in a running test program.
+
+`build_stream` builds a program which evaluates a code model sample by
+sample as chunks of samples arrive on a pipe and sends back the outputs of
+each chunk in the same way. `WaveformStream.run` feeds it from an iterable
+of chunks, e.g. a generator, on a separate thread and yields the outputs
+chunk by chunk. Neither side holds more than a few chunks at a time, so
+memory stays flat however long the transient run is, and generating the
+next chunk in Python overlaps with evaluating the previous one in C::
+
+    def sine(num_chunks, size=4096, step=1e-9):
+        for k in range(num_chunks):
+            t = (k * size + np.arange(size)) * step
+            yield np.column_stack([t, np.sin(2e6 * np.pi * t)])
+
+    with build_stream('my_filter', {}) as stream:
+        peak = max(out.max() for out in stream.run(sine(1000000)))
+
+Each row of a chunk is a sample: its time followed by the values of the
+input ports, numbered as in `gomjabbar.library.CodeModelLibrary`. The first
+sample of a run is the DC operating point, with ``INIT`` set; the others are
+timepoints of a transient analysis. POSIX only. Requires NumPy.
+"""
+import contextlib
+import os.path as op
+import struct
+import subprocess
+import threading
+
+import numpy as np
+
+from gomjabbar.const import C_FUNCTION_NAME
+from gomjabbar.generate import (
+    TEMPLATE_ENV, _build_source, _get_template_context, _harness_options,
+    _render_harness
+)
+from gomjabbar.ifs.model import load_model
+from gomjabbar.library import _port_names
+
+#: The largest number of samples sent to the program at once. Longer chunks
+#: are split.
+CHUNK_SIZE = 4096
+
+_HEADER = struct.Struct('=I')
+
+
+class StreamError(RuntimeError):
+    """ Raised when a stream program stops unexpectedly.
+    """
+
+
+@contextlib.contextmanager
+def build_stream(code_model_dir, parameters, build_root=None,
+                 keep_failed=None, sources=None):
+    """ Build a stream program for a code model and yield it as a
+    `WaveformStream`.
+
+    Parameters
+    ----------
+    code_model_dir : str
+        The path of the directory of the code model.
+    parameters : dict
+        A dictionary of values which will be assigned to the PARAMETER_TABLE
+        variables defined by the code model.
+    build_root : str, optional
+        See `gomjabbar.generate.build_test`.
+    keep_failed : bool, optional
+        See `gomjabbar.generate.build_test`.
+    sources : list of str, optional
+        See `gomjabbar.generate.build_test`.
+    """
+    ast = load_model(op.join(code_model_dir, 'ifspec.ifs'))
+    function = ast.name_table.row(C_FUNCTION_NAME).value
+    conns, params, num_vars = _get_template_context(code_model_dir, parameters)
+    template = TEMPLATE_ENV.get_template('stream.c.jinja')
+    options = dict(_harness_options(code_model_dir), runtime=True)
+    source = (_render_harness(conns, params, num_vars, **options) +
+              template.render({'function': function}))
+    with _build_source(code_model_dir, source, build_root=build_root,
+                       keep_failed=keep_failed, sources=sources) as path:
+        yield WaveformStream(path, conns)
+
+
+class WaveformStream(object):
+    """ A stream program, which is started afresh for every run.
+
+    Parameters
+    ----------
+    path : str
+        The path of a program built by `build_stream`.
+    connections : list of dict
+        The connections of the code model, from
+        `gomjabbar.ifs.build.build_connections_list`.
+    chunk_size : int, optional
+        The largest number of samples sent to the program at once. Defaults
+        to `CHUNK_SIZE`.
+    """
+    def __init__(self, path, connections, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.input_names = _port_names(connections, 'is_input')
+        self.output_names = _port_names(connections, 'is_output')
+        self.chunk_size = chunk_size
+
+    @property
+    def num_inputs(self):
+        return len(self.input_names)
+
+    @property
+    def num_outputs(self):
+        return len(self.output_names)
+
+    def run(self, chunks):
+        """ Stream `chunks` through the code model.
+
+        Parameters
+        ----------
+        chunks : iterable of array_like
+            Chunks of samples of shape ``(n, 1 + num_inputs)``, whose first
+            column is the time. The iterable is consumed on another thread.
+
+        Yields an array of shape ``(n, num_outputs)`` for each chunk of at
+        most `chunk_size` samples. Raises `StreamError` if the program
+        stops unexpectedly, or the exception raised by `chunks`.
+        """
+        process = subprocess.Popen([self.path], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        errors = []
+        feeder = threading.Thread(target=self._feed,
+                                  args=(process, chunks, errors))
+        feeder.daemon = True
+        feeder.start()
+        try:
+            while True:
+                header = process.stdout.read(_HEADER.size)
+                if not header:
+                    break
+                if len(header) != _HEADER.size:
+                    raise StreamError(self._died_message(process))
+                count, = _HEADER.unpack(header)
+                size = count * self.num_outputs * 8
+                data = process.stdout.read(size)
+                if len(data) != size:
+                    raise StreamError(self._died_message(process))
+                yield np.frombuffer(data, dtype=np.float64).reshape(
+                    count, self.num_outputs
+                )
+
+            feeder.join()
+            if errors:
+                raise errors[0]
+            if process.wait() != 0:
+                raise StreamError(self._died_message(process))
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+            feeder.join()
+
+    def _died_message(self, process):
+        returncode = process.poll()
+        return 'The stream program {} stopped (status {})'.format(self.path,
+                                                                  returncode)
+
+    def _feed(self, process, chunks, errors):
+        width = 1 + self.num_inputs
+        try:
+            for chunk in chunks:
+                chunk = np.ascontiguousarray(chunk, dtype=np.float64)
+                if chunk.ndim == 1 and width == 1:
+                    chunk = chunk.reshape(-1, 1)
+                if chunk.ndim != 2 or chunk.shape[1] != width:
+                    msg = 'chunks must have shape (n, {}), not {}'
+                    raise ValueError(msg.format(width, chunk.shape))
+                for start in range(0, len(chunk), self.chunk_size):
+                    frame = chunk[start:start + self.chunk_size]
+                    process.stdin.write(_HEADER.pack(len(frame)))
+                    process.stdin.write(frame.tobytes())
+                    process.stdin.flush()
+        except (IOError, OSError):
+            # The program stopped; the reader reports it
+            pass
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
@@ -0,0 +1,46 @@
+""" Helpers for files shared by the build and the cache of test programs.
+
+This module only uses the standard library, so that importing it stays cheap
+for thin clients.
+"""
+import contextlib
+import hashlib
+import os
+import os.path as op
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """ Hold an exclusive advisory lock on `path` which is shared between
+    processes. Does nothing where `fcntl` is not available.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def hash_files(paths):
+    """ Return a hash of the names and contents of the files at `paths`.
+
+    Only the base names of the files are hashed, so that the hash does not
+    change when a directory of sources is moved.
+    """
+    sha = hashlib.sha1()
+    for path in paths:
+        sha.update(op.basename(path).encode('utf8'))
+        with open(path, 'rb') as fp:
+            sha.update(fp.read())
+    return sha.hexdigest()
@@ -0,0 +1,210 @@
+""" Run test programs with wall-clock, CPU time and memory budgets.
+
+Generated programs otherwise run without limits, so a code model stuck in an
+infinite loop or allocating without bound stalls everything waiting for it.
+`run_program` runs a program in a session of its own under ``RLIMIT_CPU`` and
+``RLIMIT_AS`` and kills its whole process group if it outlives its
+wall-clock timeout::
+
+    result = run_program([path], timeout=10, cpu_time=5, memory=1 << 30)
+    if result.timed_out or result.returncode != 0:
+        ...
+
+POSIX only.
+"""
+import collections
+import errno
+import os
+import signal
+import sys
+import threading
+import time
+from subprocess import PIPE, Popen
+
+#: The outcome of `run_program`. `returncode` is the exit status or, as with
+#: `subprocess`, minus the signal which killed the program, which is also
+#: `signal` (None otherwise). `timed_out` is True if the program was killed
+#: at its wall-clock timeout. `elapsed` is the wall-clock time and
+#: `cpu_time` the user and system time in seconds; `peak_rss` is the peak
+#: resident set size in bytes. `stdout` and `stderr` are None unless
+#: captured.
+RunResult = collections.namedtuple('RunResult', [
+    'returncode', 'signal', 'timed_out', 'elapsed', 'cpu_time', 'peak_rss',
+    'stdout', 'stderr'
+])
+
+# ru_maxrss is in kilobytes on Linux but in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+# How Popen starts a program in a session of its own. Python 2 has no
+# start_new_session; os.setsid is the only code run in its preexec_fn.
+if sys.version_info[0] >= 3:
+    _NEW_SESSION = {'start_new_session': True}
+else:
+    _NEW_SESSION = {'preexec_fn': os.setsid}
+
+
+def run_program(cmd, timeout=None, cpu_time=None, memory=None, input=None,
+                capture=True, cwd=None, env=None):
+    """ Run a command under a watchdog and return its `RunResult`.
+
+    Parameters
+    ----------
+    cmd : list of str
+        The program and its arguments.
+    timeout : float, optional
+        The wall-clock budget in seconds. When it expires, the program's
+        whole process group is killed with SIGKILL.
+    cpu_time : int, optional
+        The CPU time budget in seconds (``RLIMIT_CPU``). The program gets
+        SIGXCPU when it is used up and SIGKILL a second later.
+    memory : int, optional
+        The address space budget in bytes (``RLIMIT_AS``), rounded down to
+        kilobytes. Allocations beyond it fail.
+    input : bytes, optional
+        Passed to the program's standard input, which is otherwise
+        inherited.
+    capture : bool, optional
+        Whether to capture standard output and standard error rather than
+        inherit them. Defaults to True.
+    cwd : str, optional
+        The working directory of the program.
+    env : dict, optional
+        The environment of the program.
+
+    With budgets of CPU time or memory, the program is started by a shell
+    which sets them and then execs it, so a program which cannot be
+    executed exits with status 126 or 127 instead of raising `OSError`.
+    """
+    output = PIPE if capture else None
+    start = time.time()
+    proc = Popen(_limit_cmd(cmd, cpu_time, memory),
+                 stdin=PIPE if input is not None else None,
+                 stdout=output, stderr=output, cwd=cwd, env=env,
+                 **_NEW_SESSION)
+
+    # The timer only kills the program while it has not been reaped
+    expired = []
+    reaped = []
+    lock = threading.Lock()
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _expire,
+                                (proc.pid, expired, reaped, lock))
+        timer.daemon = True
+        timer.start()
+
+    streams = {}
+    threads = []
+    if input is not None:
+        threads.append(_start(_write, proc.stdin, input))
+    for name in ('stdout', 'stderr'):
+        stream = getattr(proc, name)
+        if stream is not None:
+            threads.append(_start(_read, stream, streams, name))
+
+    try:
+        status, usage = _wait(proc.pid)
+    finally:
+        with lock:
+            reaped.append(True)
+        if timer is not None:
+            timer.cancel()
+        # Children left behind in the group would hold the pipes open
+        _kill_group(proc.pid)
+        for thread in threads:
+            thread.join()
+    elapsed = time.time() - start
+
+    if os.WIFSIGNALED(status):
+        signum = os.WTERMSIG(status)
+        returncode = -signum
+    else:
+        signum = None
+        returncode = os.WEXITSTATUS(status)
+    # Popen must not wait for the process which was already reaped
+    proc.returncode = returncode
+
+    return RunResult(
+        returncode=returncode,
+        signal=signum,
+        # The program may have exited on its own just as the timer fired
+        timed_out=bool(expired) and signum == signal.SIGKILL,
+        elapsed=elapsed,
+        cpu_time=usage.ru_utime + usage.ru_stime,
+        peak_rss=usage.ru_maxrss * _MAXRSS_UNIT,
+        stdout=streams.get('stdout'),
+        stderr=streams.get('stderr'),
+    )
+
+
+def _expire(pid, expired, reaped, lock):
+    with lock:
+        if reaped:
+            return
+        expired.append(True)
+        _kill_group(pid)
+
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError as exc:
+        if exc.errno not in (errno.ESRCH, errno.EPERM):
+            raise
+
+
+def _limit_cmd(cmd, cpu_time, memory):
+    """ Return `cmd` wrapped to run under the CPU time and memory budgets.
+
+    The limits are set in a shell which then execs the program, rather than
+    in a preexec_fn, which is unsafe while other threads are running.
+    """
+    limits = []
+    if cpu_time is not None:
+        seconds = int(max(1, cpu_time))
+        # SIGXCPU at the soft limit, SIGKILL a second later
+        limits += ['-S -t {}'.format(seconds), '-H -t {}'.format(seconds + 1)]
+    if memory is not None:
+        kilobytes = max(1, int(memory) // 1024)
+        limits += ['-S -v {}'.format(kilobytes), '-H -v {}'.format(kilobytes)]
+    if not limits:
+        return list(cmd)
+    script = ' && '.join('ulimit ' + limit for limit in limits)
+    return ['/bin/sh', '-c', script + ' && exec "$@"', 'sh'] + list(cmd)
+
+
+def _read(stream, streams, name):
+    try:
+        streams[name] = stream.read()
+    finally:
+        stream.close()
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _wait(pid):
+    while True:
+        try:
+            _, status, usage = os.wait4(pid, 0)
+            return status, usage
+        except OSError as exc:
+            if exc.errno != errno.EINTR:
+                raise
+
+
+def _write(stream, data):
+    try:
+        stream.write(data)
+    except (IOError, OSError):
+        # The program exited without reading all of its input
+        pass
+    finally:
+        try:
+            stream.close()
+        except (IOError, OSError):
+            pass